@@ -0,0 +1,115 @@
+"""
+benchmark of the time and memory it takes to import lehd, in a fresh interpreter each time
+
+    python benchmarks/imports.py --output imports.json
+    python benchmarks/imports.py --compare baseline.json imports.json
+
+besides timing, it checks that importing lehd does not import the geo stack (geopandas, shapely, and pyproj), which
+only to_geo needs, and exits with an error if it does, or if the import is slower than in a baseline result file
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that should only be imported on first use of to_geo
+lazy_modules = ["geopandas", "shapely", "pyproj"]
+
+# the import is timed inside the child process, so that the interpreter start up is not included
+script = """
+import sys, time, json
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+import lehd
+print(json.dumps({"seconds": seconds, "peak_memory": lehd.metrics.peak_memory(), "modules": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def measure(module):
+
+    """
+    imports @module in a fresh interpreter, and returns its import time, peak memory, and the lazy modules it imported
+    """
+
+    output = subprocess.run([sys.executable, "-c", script % (module, lazy_modules)], cwd = root, check = True, capture_output = True, text = True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(modules, repeat):
+
+    """
+    imports each module @repeat times, and returns their results
+    """
+
+    results = []
+    for module in modules:
+
+        runs = [measure(module) for i in range(repeat)]
+        seconds = [r["seconds"] for r in runs]
+        result = {
+            "module": module,
+            "repeat": repeat,
+            "min_seconds": min(seconds),
+            "median_seconds": statistics.median(seconds),
+            "peak_memory": statistics.median([r["peak_memory"] or 0 for r in runs]),
+            "lazy_modules_imported": runs[0]["modules"]
+        }
+
+        print("%-12s %8.3f s median %8.1f MB peak %s" % (module, result["median_seconds"], result["peak_memory"] / 1e6,
+            ("imports " + ", ".join(result["lazy_modules_imported"])) if result["lazy_modules_imported"] else ""), flush = True)
+        results.append(result)
+
+    return results
+
+
+def compare(old_path, new_path, threshold):
+
+    """
+    compares the median import time of each module in two result files, and returns the number that are slower by more than the @threshold
+    """
+
+    with open(old_path) as f:
+        old = dict((r["module"], r) for r in json.load(f)["results"])
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+
+    regressions = 0
+    for result in new:
+        if result["module"] not in old:
+            continue
+        ratio = result["median_seconds"] / old[result["module"]]["median_seconds"]
+        flag = ratio > 1 + threshold
+        regressions += flag
+        print("%-12s time x%.2f %s" % (result["module"], ratio, "REGRESSION" if flag else ""))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "benchmark of the import time of lehd")
+    parser.add_argument("--modules", nargs = "+", default = ["pandas", "lehd"])
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--output", default = "import_results.json")
+    parser.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"))
+    parser.add_argument("--threshold", type = float, default = 0.2)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) > 0 else 0)
+
+    results = run(args.modules, args.repeat)
+
+    with open(args.output, "w") as f:
+        json.dump({"results": results}, f, indent = 2)
+    print("Wrote", len(results), "results to", args.output)
+
+    if any(r["lazy_modules_imported"] for r in results if r["module"] == "lehd"):
+        sys.exit("importing lehd imports the geo stack, which should only be imported by to_geo")
@@ -0,0 +1,214 @@
+"""
+offline benchmarks of lehd, run against synthetic LODES files served from the local machine
+
+    python benchmarks/run.py --scales ri md --output results.json
+    python benchmarks/run.py --functions wac od --engines pandas pyarrow
+    python benchmarks/run.py --compare baseline.json results.json
+
+each case (a function at a geography level, for one scale) runs in a fresh process, so that its peak memory can be
+measured on its own. The case is first run once to warm up (downloading into a fresh cache, and loading any
+centroids), and then timed @repeat times. The results, with the per-stage timings of lehd.metrics, are written to a
+JSON file, and two result files can be compared to catch performance regressions between releases
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import multiprocessing
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lehd
+import numpy as np
+import pandas as pd
+
+import server
+import synthetic
+
+
+functions = ["wac", "rac", "od", "to_geo.wac", "to_geo.rac", "to_geo.od"]
+
+levels = ["B", "BG", "CT", "C", "S"]
+
+engines = ["pandas", "pyarrow"]
+
+
+def run_case(case, base_url, work_directory, repeat):
+
+    """
+    runs one benchmark case in the current (fresh) process, and returns its results
+    """
+
+    server.point(base_url)
+    lehd.cache.directory = os.path.join(work_directory, "cache")
+    lehd.cache.validate = False
+    lehd.blocks.directory = os.path.join(work_directory, "blocks")
+
+    fips = synthetic.scales[case["scale"]]["fips"]
+    function = case["function"]
+    geography = case["geography"]
+    engine = case["engine"]
+    kind = function.split(".")[-1]
+
+    def download():
+        if kind == "od":
+            return lehd.dl_lodes.od(2016, geography, origins = [fips], engine = engine)
+        return getattr(lehd.dl_lodes, kind)([fips], 2016, geography, engine = engine)
+
+    # the input of to_geo is downloaded before timing, so that only the join is measured
+    if function.startswith("to_geo"):
+        data = download()
+        call = lambda: getattr(lehd.to_geo, kind)(data.copy())
+    else:
+        call = download
+
+    baseline_memory = lehd.metrics.peak_memory()
+
+    start = time.perf_counter()
+    call()
+    first = time.perf_counter() - start
+
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = call()
+        latencies.append(time.perf_counter() - start)
+
+    summary = result.attrs["metrics"]
+    stages = summary["stages"]
+    rows = sum(stages[stage]["rows_out"] for stage in ["parse", "read"] if stage in stages) if not function.startswith("to_geo") else len(result)
+    median = statistics.median(latencies)
+
+    return dict(case, **{
+        "repeat": repeat,
+        "first_seconds": first,
+        "min_seconds": min(latencies),
+        "median_seconds": median,
+        "max_seconds": max(latencies),
+        "rows": int(rows),
+        "rows_per_second": rows / median if median > 0 else None,
+        "bytes_decompressed": summary["counters"]["bytes_decompressed"],
+        "mb_per_second": summary["counters"]["bytes_decompressed"] / median / 1e6 if median > 0 else None,
+        "output_rows": len(result),
+        "baseline_memory": baseline_memory,
+        "peak_memory": lehd.metrics.peak_memory(),
+        "stages": stages
+    })
+
+
+def run(scales, functions, levels, engines, data_directory, repeat):
+
+    """
+    generates (if needed) and serves the synthetic files of each scale, runs every case, and returns the results
+
+    the parse engines are only compared for downloads, to_geo cases are run with the pandas engine
+    """
+
+    work_directory = os.path.join(data_directory, "work")
+    shutil.rmtree(work_directory, ignore_errors = True)
+
+    httpd, base_url = server.serve(data_directory)
+    context = multiprocessing.get_context("spawn")
+
+    results = []
+    try:
+        for scale in scales:
+
+            print("Generating the", scale, "scale files ...", flush = True)
+            synthetic.generate(data_directory, scale)
+
+            for function in functions:
+                for geography in levels:
+                    for engine in (["pandas"] if function.startswith("to_geo") else engines):
+
+                        case = {"scale": scale, "function": function, "geography": geography, "engine": engine}
+                        with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = context) as executor:
+                            result = executor.submit(run_case, case, base_url, work_directory, repeat).result()
+
+                        print("%-4s %-11s %-4s %-7s %9.3f s median %12.0f rows/s %8.1f MB peak" % (
+                            scale, function, geography, engine, result["median_seconds"], result["rows_per_second"] or 0,
+                            (result["peak_memory"] or 0) / 1e6), flush = True)
+                        results.append(result)
+    finally:
+        httpd.shutdown()
+
+    return results
+
+
+def environment():
+
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "pyarrow": pyarrow_version()
+    }
+
+
+def pyarrow_version():
+
+    try:
+        import pyarrow
+    except ImportError:
+        return None
+    return pyarrow.__version__
+
+
+def compare(old_path, new_path, threshold):
+
+    """
+    compares the median latency and peak memory of each case in two result files, printing the ratios, and
+    returns the number of cases that are slower or use more memory than the @threshold (e.g. 0.2 for 20%)
+    """
+
+    with open(old_path) as f:
+        old = dict(((r["scale"], r["function"], r["geography"], r.get("engine", "pandas")), r) for r in json.load(f)["results"])
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+
+    regressions = 0
+    for result in new:
+        key = (result["scale"], result["function"], result["geography"], result.get("engine", "pandas"))
+        if key not in old:
+            continue
+        time_ratio = result["median_seconds"] / old[key]["median_seconds"] if old[key]["median_seconds"] > 0 else 1
+        memory_ratio = result["peak_memory"] / old[key]["peak_memory"] if old[key]["peak_memory"] else 1
+        flag = time_ratio > 1 + threshold or memory_ratio > 1 + threshold
+        regressions += flag
+        print("%-4s %-11s %-4s %-7s time x%.2f memory x%.2f %s" % (key + (time_ratio, memory_ratio, "REGRESSION" if flag else "")))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "offline benchmarks of lehd against synthetic LODES files")
+    parser.add_argument("--scales", nargs = "+", default = ["ri"], choices = list(synthetic.scales.keys()))
+    parser.add_argument("--functions", nargs = "+", default = functions, choices = functions)
+    parser.add_argument("--levels", nargs = "+", default = levels, choices = levels)
+    parser.add_argument("--engines", nargs = "+", default = ["pandas"], choices = engines)
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--data", default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    parser.add_argument("--output", default = "benchmark_results.json")
+    parser.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"))
+    parser.add_argument("--threshold", type = float, default = 0.2)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) > 0 else 0)
+
+    results = run(args.scales, args.functions, args.levels, args.engines, args.data, args.repeat)
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent = 2)
+    print("Wrote", len(results), "results to", args.output)
@@ -0,0 +1,40 @@
+"""
+serves a directory of synthetic files over HTTP on the local machine, as a stand-in for the Census servers
+"""
+
+import functools
+import threading
+import http.server
+
+import lehd
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    # the benchmarks make many requests, so they are not logged
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory, port = 0):
+
+    """
+    starts serving @directory on a local port (a free one if @port is 0) in a background thread, and returns the
+    server and its base URL. Stop it with server.shutdown()
+    """
+
+    handler = functools.partial(QuietHandler, directory = directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server, "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+
+
+def point(base_url):
+
+    """
+    points lehd at a server started with serve, for LODES files (dl_lodes) and centroid tables (to_geo)
+    """
+
+    lehd.dl_lodes.url_base = base_url + "lodes/"
+    lehd.centroids.url_base = base_url + "cenpop/"
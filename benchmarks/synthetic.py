@@ -0,0 +1,249 @@
+"""
+generates synthetic LODES files (WAC, RAC, OD, and the geography crosswalk) and population weighted centroid tables,
+laid out like the Census servers, so that the benchmarks can run offline against a local HTTP server
+
+the files have the same columns and types as the real ones, with a realistic nesting of blocks in block groups,
+tracts, and counties, skewed job counts, and commuting flows that mostly stay within the same county
+"""
+
+import os
+import json
+import gzip
+
+import lehd
+import numpy as np
+import pandas as pd
+
+
+# each scale is modelled on a real state: its numeric code, a neighbouring state for out of state (aux) flows,
+# its number of counties, and the approximate number of blocks and main OD rows in its files
+scales = {
+    "ri": {"state": "RI", "fips": "44", "neighbour": "25", "counties": 5, "blocks": 25000, "od_rows": 400000},
+    "md": {"state": "MD", "fips": "24", "neighbour": "51", "counties": 24, "blocks": 120000, "od_rows": 2500000},
+    "ca": {"state": "CA", "fips": "06", "neighbour": "32", "counties": 58, "blocks": 700000, "od_rows": 15000000}
+}
+
+wac_values = ['C000', 'CA01', 'CA02', 'CA03', 'CE01', 'CE02', 'CE03'] + ['CNS%02d' % i for i in range(1, 21)] + ['CR01', 'CR02', 'CR03', 'CR04', 'CR05', 'CR07', 'CT01', 'CT02', 'CD01', 'CD02', 'CD03', 'CD04', 'CS01', 'CS02']
+firm_values = ['CFA01', 'CFA02', 'CFA03', 'CFA04', 'CFA05', 'CFS01', 'CFS02', 'CFS03', 'CFS04', 'CFS05']
+od_values = ["S000", "SA01", "SA02", "SA03", "SE01", "SE02", "SE03", "SI01", "SI02", "SI03"]
+
+# groups of job count columns that each split the total jobs
+wac_groups = [["CA01", "CA02", "CA03"], ["CE01", "CE02", "CE03"], ['CNS%02d' % i for i in range(1, 21)], ['CR01', 'CR02', 'CR03', 'CR04', 'CR05', 'CR07'], ["CT01", "CT02"], ["CD01", "CD02", "CD03", "CD04"], ["CS01", "CS02"], firm_values[:5], firm_values[5:]]
+od_groups = [["SA01", "SA02", "SA03"], ["SE01", "SE02", "SE03"], ["SI01", "SI02", "SI03"]]
+
+createdate = 20190826
+
+
+def blocks(fips, counties, n, rng):
+
+    """
+    returns a sorted array of unique integer block codes in a state, nested in counties, tracts, and block groups,
+    along with their latitude and longitude
+    """
+
+    county = rng.integers(0, counties, n) * 2 + 1
+    tract = (rng.integers(0, max(n // counties // 150, 1), n) + 1) * 100
+    group = rng.integers(1, 5, n)
+    block = rng.integers(0, 100, n)
+
+    codes = np.unique(int(fips) * 10 ** 13 + county * 10 ** 10 + tract * 10 ** 4 + group * 1000 + block)
+
+    # coordinates clustered by county and tract around a point in the state
+    county_index = (codes // 10 ** 10) % 1000 // 2
+    tract_index = (codes // 10 ** 4) % 10 ** 6 // 100
+    lat = 30 + int(fips) % 15 + (county_index % 8) * 0.3 + (tract_index % 10) * 0.02 + rng.random(len(codes)) * 0.02
+    lon = -120 + int(fips) % 40 + (county_index // 8) * 0.3 + (tract_index // 10) * 0.02 + rng.random(len(codes)) * 0.02
+
+    return codes, lat, lon
+
+
+def split(totals, columns, rng):
+
+    """
+    returns a dict of job counts per column that randomly split the @totals
+    """
+
+    weights = rng.dirichlet(np.ones(len(columns)) * 2)
+    counts = rng.multinomial(totals, weights)
+    return dict((c, counts[:, i]) for i, c in enumerate(columns))
+
+
+def write_csv(df, path):
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with gzip.open(path + ".tmp", "wt", compresslevel = 6) as f:
+        df.to_csv(f, index = False)
+    os.replace(path + ".tmp", path)
+
+
+def characteristics(kind, codes, rng):
+
+    """
+    returns a synthetic WAC ("wac") or RAC ("rac") table for a state's blocks, with jobs in about half of the blocks
+    """
+
+    rows = np.sort(rng.choice(codes, len(codes) // 2, replace = False))
+    totals = np.maximum(rng.lognormal(1.5, 1.4, len(rows)).astype(np.int64), 1)
+
+    df = pd.DataFrame({("w" if kind == "wac" else "h") + "_geocode": rows, "C000": totals})
+    for group in wac_groups:
+        if kind == "rac" and group[0] in firm_values:
+            continue
+        df = df.assign(**split(totals, group, rng))
+
+    columns = [df.columns[0]] + wac_values + (firm_values if kind == "wac" else [])
+    df = df[columns]
+    df["createdate"] = createdate
+    return df
+
+
+def od(work, work_jobs, homes, n, rng, same_county = 0.6):
+
+    """
+    returns a synthetic OD table of about @n unique flows, from @homes blocks to @work blocks weighted by their jobs,
+    with a share of the flows staying within the same county when the homes and workplaces are in the same state
+    """
+
+    w = rng.choice(work, n, p = work_jobs / work_jobs.sum())
+    h = homes[rng.integers(0, len(homes), n)]
+
+    # moving a share of the homes into the county of the workplace, where the homes are in the same state
+    if homes[0] // 10 ** 13 == work[0] // 10 ** 13:
+        home_counties = homes // 10 ** 10
+        counties, starts = np.unique(home_counties, return_index = True)
+        ends = np.append(starts[1:], len(homes))
+        local = rng.random(n) < same_county
+        i = np.searchsorted(counties, w[local] // 10 ** 10)
+        i = np.minimum(i, len(counties) - 1)
+        picks = starts[i] + (rng.random(local.sum()) * (ends[i] - starts[i])).astype(np.int64)
+        h[local] = homes[picks]
+
+    df = pd.DataFrame({"w_geocode": w, "h_geocode": h})
+    df["S000"] = 1
+    df = df.groupby(["w_geocode", "h_geocode"], sort = True)["S000"].sum().reset_index()
+    df["S000"] = df["S000"] + (rng.geometric(0.6, len(df)) - 1)
+
+    for group in od_groups:
+        df = df.assign(**split(df["S000"].to_numpy(), group, rng))
+
+    df = df[["w_geocode", "h_geocode"] + od_values]
+    df["createdate"] = createdate
+    return df
+
+
+def xwalk(codes, lat, lon, rng):
+
+    """
+    returns a synthetic geography crosswalk for a state's blocks
+    """
+
+    geoids = pd.Series(codes).astype(str).str.zfill(15)
+    st = geoids.str[:2]
+
+    df = pd.DataFrame({"tabblk2010": geoids})
+    df["st"] = st
+    df["cty"] = geoids.str[:5]
+    df["trct"] = geoids.str[:11]
+    df["bgrp"] = geoids.str[:12]
+    df["stplc"] = st + pd.Series(rng.choice([10000, 20000, 30000, 99999], len(codes), p = [0.3, 0.2, 0.1, 0.4])).astype(str)
+    df["ctycsub"] = geoids.str[:5] + pd.Series(rng.choice([10000, 20000, 30000], len(codes))).astype(str)
+    df["cbsa"] = rng.choice(["10000", "20000", "99999"], len(codes), p = [0.6, 0.2, 0.2])
+    df["zcta"] = (pd.Series(rng.integers(0, 60, len(codes)) + int(st.iloc[0]) * 100)).astype(str).str.zfill(5)
+    df["blklatdd"] = np.round(lat, 7)
+    df["blklondd"] = np.round(lon, 7)
+    df["createdate"] = createdate
+    return df
+
+
+def centroid_tables(codes, lat, lon):
+
+    """
+    returns the block group, tract, and county centroid tables of a state's blocks, as means of the block coordinates
+    """
+
+    geoids = pd.Series(codes).astype(str).str.zfill(15)
+    df = pd.DataFrame({"geoid": geoids, "LATITUDE": lat, "LONGITUDE": lon})
+
+    tables = {}
+    for gtype, length in [("BG", 12), ("CT", 11), ("C", 5)]:
+        table = df.groupby(df["geoid"].str[:length]).agg(POPULATION = ("geoid", "size"), LATITUDE = ("LATITUDE", "mean"), LONGITUDE = ("LONGITUDE", "mean")).reset_index()
+        table.insert(0, "STATEFP", table["geoid"].str[:2])
+        table.insert(1, "COUNTYFP", table["geoid"].str[2:5])
+        if length >= 11:
+            table.insert(2, "TRACTCE", table["geoid"].str[5:11])
+        if length == 12:
+            table.insert(3, "BLKGRPCE", table["geoid"].str[11:12])
+        tables[gtype] = table.drop(columns = "geoid").round(6)
+    return tables
+
+
+def generate(directory, scale = "ri", years = [2016], seed = 0):
+
+    """
+    generates the synthetic files of a scale into @directory, with the LODES files under @directory/lodes/ and
+    the centroid tables under @directory/cenpop/, and returns a dict of their sizes. A scale that was already
+    generated into the directory is not generated again
+    """
+
+    manifest = os.path.join(directory, "manifest_" + scale + ".json")
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            return json.load(f)["files"]
+
+    settings = scales[scale]
+    state = settings["state"].lower()
+    fips = settings["fips"]
+    neighbour = settings["neighbour"]
+    rng = np.random.default_rng(seed)
+
+    lodes = os.path.join(directory, "lodes", state)
+    cenpop = os.path.join(directory, "cenpop")
+
+    codes, lat, lon = blocks(fips, settings["counties"], settings["blocks"], rng)
+    neighbour_codes, neighbour_lat, neighbour_lon = blocks(neighbour, max(settings["counties"] // 4, 1), settings["blocks"] // 10, rng)
+
+    written = {}
+
+    def write(df, path):
+        write_csv(df, path)
+        written[os.path.relpath(path, directory)] = os.path.getsize(path)
+
+    for year in years:
+
+        wac = characteristics("wac", codes, rng)
+        write(wac, os.path.join(lodes, "wac", state + "_wac_S000_JT00_" + str(year) + ".csv.gz"))
+        write(characteristics("rac", codes, rng), os.path.join(lodes, "rac", state + "_rac_S000_JT00_" + str(year) + ".csv.gz"))
+
+        work = wac["w_geocode"].to_numpy()
+        jobs = wac["C000"].to_numpy().astype(np.float64)
+        write(od(work, jobs, codes, settings["od_rows"], rng), os.path.join(lodes, "od", state + "_od_main_JT00_" + str(year) + ".csv.gz"))
+        write(od(work, jobs, neighbour_codes, max(settings["od_rows"] // 20, 1), rng), os.path.join(lodes, "od", state + "_od_aux_JT00_" + str(year) + ".csv.gz"))
+
+    # crosswalks and centroids, including the neighbouring state, for joining out of state origins
+    neighbour_state = lehd.utils.state_alpha(neighbour).lower()
+    for st, st_codes, st_lat, st_lon in [(state, codes, lat, lon), (neighbour_state, neighbour_codes, neighbour_lat, neighbour_lon)]:
+
+        write(xwalk(st_codes, st_lat, st_lon, rng), os.path.join(directory, "lodes", st, st + "_xwalk.csv.gz"))
+
+        tables = centroid_tables(st_codes, st_lat, st_lon)
+        st_fips = str(st_codes[0] // 10 ** 13).zfill(2)
+        for gtype, folder, prefix in [("BG", "blkgrp", "CenPop2010_Mean_BG"), ("CT", "tract", "CenPop2010_Mean_TR"), ("C", "county", "CenPop2010_Mean_CO")]:
+            path = os.path.join(cenpop, folder, prefix + st_fips + ".txt")
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            tables[gtype].to_csv(path, index = False)
+            written[os.path.relpath(path, directory)] = os.path.getsize(path)
+
+    # the national state centroid table covers every state generated into the directory
+    path = os.path.join(cenpop, "CenPop2010_Mean_ST.txt")
+    existing = pd.read_csv(path, dtype = {"STATEFP": str}) if os.path.exists(path) else pd.DataFrame(columns = ["STATEFP", "STNAME", "POPULATION", "LATITUDE", "LONGITUDE"])
+    rows = [{"STATEFP": f, "STNAME": f, "POPULATION": len(c), "LATITUDE": round(float(la.mean()), 6), "LONGITUDE": round(float(lo.mean()), 6)} for f, c, la, lo in [(fips, codes, lat, lon), (neighbour, neighbour_codes, neighbour_lat, neighbour_lon)]]
+    table = pd.concat([existing, pd.DataFrame(rows)]).drop_duplicates("STATEFP").sort_values("STATEFP")
+    os.makedirs(cenpop, exist_ok = True)
+    table.to_csv(path, index = False)
+    written[os.path.relpath(path, directory)] = os.path.getsize(path)
+
+    with open(manifest, "w") as f:
+        json.dump({"scale": scale, "settings": settings, "years": years, "files": written}, f, indent = 2)
+
+    return written
+
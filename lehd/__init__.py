@@ -4,3 +4,15 @@ a python library for downloading LEHD data
 
 from .lehd import *
 from .utils import *
+from .cache import *
+from .store import *
+from .centroids import *
+from .blocks import *
+from .xwalk import *
+from .polygons import *
+from .matrix import *
+from .cube import *
+from .metrics import *
+from .query import *
+from .aio import *
+from .service import *
@@ -0,0 +1,5 @@
+import sys
+
+from lehd.cli import main
+
+sys.exit(main())
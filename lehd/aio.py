@@ -0,0 +1,315 @@
+import os
+import time
+import random
+import asyncio
+import weakref
+import functools
+
+import lehd
+from .cache import _TransientError
+
+
+class aio:
+
+    """
+    asyncio versions of dl_lodes.wac, dl_lodes.rac, dl_lodes.od, and the to_geo joins, for use inside an event loop, e.g.
+
+        df = await lehd.aio.wac(["44"], 2016, "CT")
+        gdf = await lehd.aio.to_geo.wac(df)
+        await lehd.aio.close()
+
+    The files a call needs are first fetched into lehd.cache without blocking the event loop, with aiohttp if it is
+    installed (using one pooled session per event loop), or otherwise with the blocking downloader of lehd.cache run
+    in an executor. Concurrent calls that need the same file share a single in-flight download of it. The parsing and
+    aggregation of the files, which are CPU-bound, are then run in an executor.
+
+    executor : the concurrent.futures executor the blocking work is run in. Default is None, the default executor of the event loop
+
+    connections : maximum number of open connections of the aiohttp session of each event loop. Default is 8
+
+    use_aiohttp : if False, files are always downloaded with lehd.cache in the executor, even if aiohttp is installed
+    """
+
+    executor = None
+    connections = 8
+    use_aiohttp = True
+
+    # in-flight downloads and aiohttp sessions, for each running event loop
+    _inflight = weakref.WeakKeyDictionary()
+    _sessions = weakref.WeakKeyDictionary()
+
+
+    def _aiohttp():
+
+        if not aio.use_aiohttp:
+            return None
+        try:
+            import aiohttp
+        except ImportError:
+            return None
+        return aiohttp
+
+
+    async def run(function, *args, **kwargs):
+
+        """
+        runs a blocking function in the executor, and returns its result
+        """
+
+        return await asyncio.get_running_loop().run_in_executor(aio.executor, functools.partial(function, *args, **kwargs))
+
+
+    async def fetch(url):
+
+        """
+        returns the local path of the cached copy of a URL, downloading it into lehd.cache if it is not there. Calls for
+        the same URL while it is being downloaded wait for that download, rather than starting another one
+
+        cached copies are returned as they are, and are revalidated (if lehd.cache.validate is True) when they are read
+        """
+
+        loop = asyncio.get_running_loop()
+        inflight = aio._inflight.setdefault(loop, {})
+
+        if url not in inflight:
+            task = inflight[url] = loop.create_task(aio._fetch(url))
+            task.add_done_callback(lambda t: inflight.pop(url, None))
+
+        # a cancelled caller does not cancel the download shared with the other callers
+        return await asyncio.shield(inflight[url])
+
+
+    async def _fetch(url):
+
+        file_path = lehd.cache.path(url)
+        if lehd.cache.cached_size(url) is not None:
+            return file_path
+
+        aiohttp = aio._aiohttp()
+        if aiohttp is None or lehd.cache.offline:
+            return await aio.run(lehd.cache.fetch, url)
+
+        # the locks of lehd.cache keep other threads and processes from downloading the same file at once
+        lock_file = await aio._acquire(file_path)
+        try:
+
+            # the file may have been downloaded while this call was waiting for the locks
+            if await aio.run(lehd.cache.cached_size, url) is not None:
+                return file_path
+
+            attempt = 0
+            while True:
+                try:
+                    await aio._download(aiohttp, url, file_path)
+                    await aio.run(lehd.cache.evict, file_path)
+                    return file_path
+                except (_TransientError, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    attempt += 1
+                    if attempt > lehd.cache.retries:
+                        raise Exception('Failed to download ' + url + ' after ' + str(attempt) + ' attempts : ' + str(e)) from e
+                    delay = min(lehd.cache.backoff * 2 ** (attempt - 1), lehd.cache.max_backoff) * (0.5 + random.random() / 2)
+                    lehd.metrics.logger.warning("Retrying %s in %.1f seconds (attempt %d of %d) : %s", url, delay, attempt, lehd.cache.retries, e)
+                    await asyncio.sleep(delay)
+
+        finally:
+            lehd.cache._release(file_path, lock_file)
+
+
+    async def _acquire(file_path):
+
+        """
+        takes the locks of lehd.cache on a cached file in the executor, without blocking the event loop while another
+        thread or process holds them, and returns the lock file for lehd.cache._release
+        """
+
+        future = asyncio.ensure_future(aio.run(lehd.cache._acquire, file_path))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # locks that are only taken after the caller was cancelled are released as soon as they are taken
+            future.add_done_callback(lambda f: f.cancelled() or f.exception() is not None or lehd.cache._release(file_path, f.result()))
+            raise
+
+
+    async def _download(aiohttp, url, file_path):
+
+        """
+        makes one attempt at downloading a URL into the cache with aiohttp, verifying it in the same way as lehd.cache,
+        with the locks of lehd.cache held. The file is written in the executor, so that the event loop is not blocked
+        """
+
+        await aio.run(os.makedirs, os.path.dirname(file_path), exist_ok = True)
+
+        # a separate partial file from the one of lehd.cache, since aiohttp downloads are not resumed, named by process
+        part_path = file_path + "." + str(os.getpid()) + ".aio.part"
+
+        timeout = aiohttp.ClientTimeout(total = None, sock_connect = lehd.cache.timeout, sock_read = lehd.cache.timeout)
+        async with aio._session(aiohttp).get(url, headers = {"User-Agent": lehd.cache._user_agent}, timeout = timeout) as response:
+
+            if response.status >= 500 or response.status == 429:
+                raise _TransientError('HTTP Error ' + str(response.status) + ': ' + str(response.reason))
+            if response.status != 200:
+                raise Exception('HTTP Error ' + str(response.status) + ': ' + str(response.reason) + ' for ' + url)
+
+            total = response.content_length
+            f = await aio.run(open, part_path, "wb")
+            try:
+                async for block in response.content.iter_chunked(1024 * 1024):
+                    await aio.run(f.write, block)
+            finally:
+                await aio.run(f.close)
+
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+
+        size = await aio.run(os.path.getsize, part_path)
+        if total is not None and size != total:
+            await aio.run(lehd.cache._remove, part_path)
+            raise _TransientError('Incomplete download of ' + url + ', expected ' + str(total) + ' bytes but received ' + str(size))
+
+        if lehd.cache.verify and url.endswith(".gz") and not await aio.run(lehd.cache._verify, part_path):
+            await aio.run(lehd.cache._remove, part_path)
+            raise _TransientError('The downloaded copy of ' + url + ' is not a valid gzip file')
+
+        await aio.run(os.replace, part_path, file_path)
+        await aio.run(lehd.cache._write_meta, file_path, {"url": url, "size": size, "etag": etag, "last_modified": last_modified, "last_access": time.time()})
+
+
+    def _session(aiohttp):
+
+        """
+        returns the aiohttp session of the running event loop, opening it on first use
+        """
+
+        loop = asyncio.get_running_loop()
+        session = aio._sessions.get(loop)
+        if session is None or session.closed:
+            session = aio._sessions[loop] = aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = aio.connections))
+        return session
+
+
+    async def close():
+
+        """
+        closes the aiohttp session of the running event loop, if any, e.g. before the loop is closed
+        """
+
+        session = aio._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+    async def _prefetch(q, geographies):
+
+        """
+        fetches the files of a lehd.query that will be read from the network, along with the geography crosswalks of
+        its states if any of @geographies (the output and input geography types) are crosswalk geographies
+        """
+
+        if not lehd.cache.enabled:
+            return
+
+        plan = await aio.run(q.plan, False)
+        urls = list(plan["url"][plan["source"].isin(["cache", "download"])])
+        if any(gtype in lehd.xwalk.levels for gtype in geographies):
+            urls += [lehd.blocks.xwalk_url(state) for state in sorted(set(f.split("_")[0].upper() for f in plan["file"]))]
+
+        await asyncio.gather(*[aio.fetch(url) for url in urls])
+
+
+    async def wac(locations, year = 2016, geography = "B", seg = "S000", type = "JT00", max_workers = 4, chunksize = None, columns = None, output = "pandas", engine = "pandas"):
+
+        """
+        asyncio version of dl_lodes.wac, with the same parameters
+        """
+
+        lehd.dl_lodes._check_params([year], geography, [type], chunksize, engine)
+        lehd.dl_lodes._check_locations("wac", locations)
+        q = lehd.query().wac(year, seg, type).locations(locations).by(geography).options(max_workers, chunksize, output, engine)
+        if columns is not None:
+            q.select(columns)
+        await aio._prefetch(q, [geography] + list(lehd.utils.infer_geog_inputs(locations)))
+        return await aio.run(lehd.dl_lodes.wac, locations, year, geography, seg, type, max_workers, chunksize, columns, output, engine)
+
+
+    async def rac(locations, year = 2016, geography = "B", seg = "S000", type = "JT00", max_workers = 4, chunksize = None, columns = None, output = "pandas", engine = "pandas"):
+
+        """
+        asyncio version of dl_lodes.rac, with the same parameters
+        """
+
+        lehd.dl_lodes._check_params([year], geography, [type], chunksize, engine)
+        lehd.dl_lodes._check_locations("rac", locations)
+        q = lehd.query().rac(year, seg, type).locations(locations).by(geography).options(max_workers, chunksize, output, engine)
+        if columns is not None:
+            q.select(columns)
+        await aio._prefetch(q, [geography] + list(lehd.utils.infer_geog_inputs(locations)))
+        return await aio.run(lehd.dl_lodes.rac, locations, year, geography, seg, type, max_workers, chunksize, columns, output, engine)
+
+
+    async def od(year = 2016, geography = "B", type = "JT00", origins = None, destinations = None, constrained = "no", max_workers = 4, chunksize = None, columns = None, output = "pandas", engine = "pandas"):
+
+        """
+        asyncio version of dl_lodes.od, with the same parameters
+        """
+
+        lehd.dl_lodes._check_params([year], geography, [type], chunksize, engine)
+        lehd.dl_lodes._check_locations("od", origins = origins, destinations = destinations, constrained = constrained)
+        q = lehd.query().od(year, type).by(geography).constrained(constrained).options(max_workers, chunksize, output, engine)
+        if origins is not None:
+            q.origins(origins)
+        if destinations is not None:
+            q.destinations(destinations)
+        if columns is not None:
+            q.select(columns)
+        await aio._prefetch(q, [geography] + list(lehd.utils.infer_geog_inputs(list(origins or []) + list(destinations or []))))
+        return await aio.run(lehd.dl_lodes.od, year, geography, type, origins, destinations, constrained, max_workers, chunksize, columns, output, engine)
+
+
+    class to_geo:
+
+        """
+        asyncio versions of the to_geo joins, which fetch the block crosswalks or centroid tables they need without
+        blocking the event loop, and then run the join in the executor
+        """
+
+        async def _prefetch(df, columns, gtype):
+
+            if not lehd.cache.enabled or gtype not in ["B", "BG", "CT", "C", "S"]:
+                return
+
+            states = sorted(set(s for column in columns for s in df[column].str[:2].unique()))
+            if gtype == "B":
+                # the block coordinates are only downloaded for states whose block store is not built yet
+                urls = [lehd.blocks.xwalk_url(lehd.utils.state_alpha(state)) for state in states
+                    if not os.path.exists(os.path.join(lehd.blocks.directory, lehd.utils.state_alpha(state).lower(), "codes.npy"))]
+            else:
+                urls = [lehd.centroids.url(gtype, state) for state in (states[:1] if gtype == "S" else states)]
+
+            await asyncio.gather(*[aio.fetch(url) for url in urls])
+
+
+        async def od(df):
+
+            """
+            asyncio version of to_geo.od
+            """
+
+            h_column = lehd.to_geo._geoid_column(df, ["h"], 0)
+            w_column = lehd.to_geo._geoid_column(df, ["w"], 1)
+            await aio.to_geo._prefetch(df, [h_column, w_column], lehd.to_geo._gtype(df, h_column))
+            return await aio.run(lehd.to_geo.od, df)
+
+
+        async def wac(df, geo = "pts", tier = "medium"):
+
+            """
+            asyncio version of to_geo.wac (and to_geo.rac)
+            """
+
+            column = lehd.to_geo._geoid_column(df, ["w", "h"], 0)
+            if geo == "pts":
+                await aio.to_geo._prefetch(df, [column], lehd.to_geo._gtype(df, column))
+            return await aio.run(lehd.to_geo.wac, df, geo, tier)
+
+        rac = wac
@@ -0,0 +1,135 @@
+import os
+import threading
+
+import lehd
+import numpy as np
+import pandas as pd
+
+
+class blocks:
+
+    """
+    Memory-mapped store of census block coordinates, used by to_geo to join block level data.
+
+    The store is built once per state from the block latitude and longitude in the LODES geography crosswalk
+    (e.g. ri_xwalk.csv.gz), and saved as a sorted int64 array of block codes and float32 arrays of coordinates.
+    These are memory-mapped when used, so that looking up blocks is a searchsorted over the block codes,
+    with no pandas merge and almost no startup cost.
+
+    directory : folder the block coordinate arrays are written to
+    """
+
+    directory = os.environ.get("LEHD_BLOCKS_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lehd", "blocks"))
+
+    _arrays = {}
+    _lock = threading.Lock()
+
+
+    def xwalk_url(state):
+
+        """
+        returns the URL of the LODES geography crosswalk for a state alpha code, e.g. "RI"
+        """
+
+        return lehd.dl_lodes.url_base + state.lower() + "/" + state.lower() + "_xwalk.csv.gz"
+
+
+    def read_xwalk(state):
+
+        """
+        reads the LODES geography crosswalk of a state alpha code, e.g. "RI", into a dataframe sorted by block code,
+        with the columns of both the block coordinate store and the geography mapping store (lehd.xwalk), so that
+        the file is parsed once when both are built
+        """
+
+        columns = ["tabblk2010", "blklatdd", "blklondd"] + [level[0] for level in lehd.xwalk.levels.values()]
+        df = pd.read_csv(
+            lehd.cache.fetch(blocks.xwalk_url(state)),
+            compression = "gzip",
+            usecols = lambda c: c in columns,
+            dtype = dict([(c, str) for c in columns] + [("tabblk2010", "int64"), ("blklatdd", "float32"), ("blklondd", "float32")]))
+
+        return df.sort_values("tabblk2010", kind = "stable").reset_index(drop = True)
+
+
+    def _save_arrays(folder, arrays):
+
+        """
+        saves a list of (name, array) @arrays as .npy files in a folder, where the first is the "codes" array
+        whose presence marks the store as complete
+        """
+
+        # temporary files are named by process, since several processes may build the same state at once
+        tmp = "." + str(os.getpid()) + ".tmp.npy"
+
+        os.makedirs(folder, exist_ok = True)
+        for name, values in arrays:
+            np.save(os.path.join(folder, name + tmp), values)
+        # the codes file is moved into place last
+        for name, values in arrays[1:] + arrays[:1]:
+            os.replace(os.path.join(folder, name + tmp), os.path.join(folder, name + ".npy"))
+
+        return folder
+
+
+    def build(state, df = None):
+
+        """
+        builds the block coordinate arrays for a state alpha code, e.g. "RI", and returns their folder
+
+        df : the crosswalk of the state from blocks.read_xwalk. Default is None, reading it, and then also building
+        the geography mapping arrays of the state if they are missing
+        """
+
+        if df is None:
+            df = blocks.read_xwalk(state)
+            if not os.path.exists(os.path.join(lehd.xwalk.directory, state.lower(), "codes.npy")):
+                lehd.xwalk.build(state, df)
+
+        arrays = [("codes", df["tabblk2010"]), ("lat", df["blklatdd"]), ("lon", df["blklondd"])]
+        return blocks._save_arrays(os.path.join(blocks.directory, state.lower()), [(name, values.to_numpy()) for name, values in arrays])
+
+
+    def arrays(state):
+
+        """
+        returns the memory-mapped (codes, lat, lon) arrays of a state alpha code, building them first if needed
+        """
+
+        with blocks._lock:
+
+            if state not in blocks._arrays:
+
+                folder = os.path.join(blocks.directory, state.lower())
+                if not os.path.exists(os.path.join(folder, "codes.npy")):
+                    blocks.build(state)
+
+                blocks._arrays[state] = tuple(np.load(os.path.join(folder, name + ".npy"), mmap_mode = "r") for name in ["codes", "lat", "lon"])
+
+            return blocks._arrays[state]
+
+
+    def lookup(geoids):
+
+        """
+        returns arrays of the longitude and latitude of a list of block GEOIDs (strings or integer codes),
+        with NaN for blocks that are not found
+        """
+
+        codes = np.asarray(geoids).astype(np.int64)
+        lon = np.full(len(codes), np.nan, dtype = np.float64)
+        lat = np.full(len(codes), np.nan, dtype = np.float64)
+
+        states = codes // 10 ** 13
+        for state_numeric in np.unique(states):
+
+            block_codes, block_lat, block_lon = blocks.arrays(lehd.utils.state_alpha(state_numeric))
+
+            rows = np.flatnonzero(states == state_numeric)
+            i = np.minimum(np.searchsorted(block_codes, codes[rows]), len(block_codes) - 1)
+            found = block_codes[i] == codes[rows]
+
+            lon[rows[found]] = block_lon[i[found]]
+            lat[rows[found]] = block_lat[i[found]]
+
+        return lon, lat
@@ -0,0 +1,592 @@
+import os
+import sys
+import json
+import time
+import gzip
+import zlib
+import random
+import threading
+import contextlib
+import http.client
+import urllib.request
+import urllib.error
+import urllib.parse
+
+import lehd
+
+
+class _TransientError(Exception):
+
+    # a failed download that is worth retrying, e.g. a dropped connection or a server error
+    pass
+
+
+class cache:
+
+    """
+    Read-through on-disk cache for downloaded LODES files.
+
+    Files are stored under @directory in a tree mirroring their URL (host/path), so that each
+    state/part/seg/type/year file has exactly one cached copy. A small JSON sidecar next to each
+    file records its URL, size, ETag and last access time.
+
+    Downloads reuse one open connection per host in each thread, are retried with exponential backoff
+    when the connection drops or the server fails, and resume from where they stopped with an HTTP
+    Range request. Files are only moved into the cache once their size and gzip stream are verified.
+
+    Settings are class attributes and can be changed at any time, e.g.
+
+        lehd.cache.directory = "/data/lehd_cache"
+        lehd.cache.max_bytes = 50 * 1024 ** 3
+        lehd.cache.offline = True
+
+    directory : folder the cached files are written to. Default is ~/.cache/lehd/downloads, next to (not above) the
+    folders of the other local stores of lehd (e.g. lehd.store, lehd.xwalk), which the cache never removes or counts
+
+    max_bytes : byte budget for the cache, once exceeded the least recently used files are removed
+
+    offline : if True, the network is never touched, and files not in the cache raise an error
+
+    validate : if True, cached files are revalidated against the server with their ETag before use, and used as they
+    are if the server cannot be reached or fails. Default is False, since published LODES files do not change
+
+    enabled : if False, files are read directly from the network without being cached
+
+    retries : number of times a failed download is retried before raising an error
+
+    backoff : seconds to wait before the first retry, doubled for each following retry (up to @max_backoff)
+
+    timeout : seconds to wait for the server before a request is treated as failed
+
+    verify : if True, gzip files are fully decompressed once after downloading, to check their integrity
+    """
+
+    directory = os.environ.get("LEHD_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lehd", "downloads"))
+
+    # the files written next to a cached file while it is downloaded
+    _companions = [".part", ".part.info", ".aio.part", ".lock"]
+    max_bytes = 20 * 1024 ** 3
+    offline = False
+    validate = False
+    enabled = True
+    retries = 5
+    backoff = 1.0
+    max_backoff = 60.0
+    timeout = 60
+    verify = True
+
+    _lock = threading.Lock()
+    _fetching = {}
+    _local = threading.local()
+    _user_agent = "Python-urllib/%d.%d" % sys.version_info[:2]
+
+
+    def settings():
+
+        """
+        returns the current settings of the cache (its public class attributes) as a dict, e.g. to apply them in a worker process
+        """
+
+        return dict((name, value) for name, value in vars(cache).items() if not name.startswith("_") and not callable(value))
+
+
+    def path(url):
+
+        """
+        returns the local path of the cached copy of a URL
+        """
+
+        parsed = urllib.parse.urlparse(url)
+        return os.path.join(cache.directory, parsed.netloc, *parsed.path.strip("/").split("/"))
+
+
+    def fetch(url):
+
+        """
+        returns a local file path for a URL, downloading it into the cache only if it is missing,
+        incomplete, or out of date
+        """
+
+        if not cache.enabled:
+            return urllib.request.urlopen(url, timeout = cache.timeout)
+
+        file_path = cache.path(url)
+
+        # only one thread downloads a file at a time, the others wait and then use its copy
+        with cache._thread_lock(file_path):
+
+            meta = cache._read_meta(file_path)
+
+            # checking if a complete copy is already on disk
+            cached = meta is not None and os.path.exists(file_path) and os.path.getsize(file_path) == meta["size"]
+
+            if cached and (cache.offline or not cache.validate):
+                cache._touch(file_path, meta)
+                return file_path
+
+            if cache.offline:
+                raise Exception('The file ' + url + ' is not in the cache at ' + cache.directory + ', and lehd.cache.offline is True')
+
+            with cache._file_lock(file_path):
+
+                # another process may have downloaded the file while this one was waiting for the lock
+                if not cached:
+                    meta = cache._read_meta(file_path)
+                    cached = meta is not None and os.path.exists(file_path) and os.path.getsize(file_path) == meta["size"]
+                    if cached and not cache.validate:
+                        cache._touch(file_path, meta)
+                        return file_path
+
+                # revalidating with the server in one attempt, keeping the cached copy if the server cannot be reached
+                if cached:
+                    try:
+                        downloaded = cache._attempt(url, file_path, meta)
+                    except (_TransientError, http.client.HTTPException, OSError) as e:
+                        lehd.metrics.logger.warning("Could not revalidate %s, using the cached copy : %s", url, e)
+                        cache._touch(file_path, meta)
+                        return file_path
+                else:
+                    downloaded = cache._download(url, file_path)
+
+                if downloaded:
+                    cache.evict(keep = file_path)
+
+        return file_path
+
+
+    def _thread_lock(file_path):
+
+        # the lock that keeps the threads of this process from fetching the same file at once
+        with cache._lock:
+            return cache._fetching.setdefault(file_path, threading.Lock())
+
+
+    @contextlib.contextmanager
+    def _file_lock(file_path):
+
+        """
+        holds an exclusive lock on the .lock file of a cached file, so that only one process downloads it at a time,
+        on platforms with fcntl (elsewhere only the threads of a process are kept apart)
+        """
+
+        f = cache._lock_file(file_path)
+        try:
+            yield
+        finally:
+            cache._unlock_file(f)
+
+
+    def _lock_file(file_path):
+
+        """
+        waits for and takes the lock on the .lock file of a cached file, returning the open lock file (or None without fcntl)
+        """
+
+        try:
+            import fcntl
+        except ImportError:
+            return None
+
+        os.makedirs(os.path.dirname(file_path), exist_ok = True)
+        f = open(file_path + ".lock", "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+
+    def _unlock_file(f):
+
+        if f is not None:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+
+    def _acquire(file_path):
+
+        """
+        takes both the thread lock and the file lock of a cached file, for code that cannot hold them in a with block
+        (e.g. lehd.aio, across awaits), returning the lock file to pass to cache._release
+        """
+
+        lock = cache._thread_lock(file_path)
+        lock.acquire()
+        try:
+            return cache._lock_file(file_path)
+        except BaseException:
+            lock.release()
+            raise
+
+
+    def _release(file_path, f):
+
+        cache._unlock_file(f)
+        cache._thread_lock(file_path).release()
+
+
+    def _download(url, file_path, meta = None):
+
+        """
+        downloads a URL into the cache, retrying with exponential backoff, and returns True if a new copy was
+        downloaded, or False if the cached copy with @meta was revalidated by the server
+        """
+
+        os.makedirs(os.path.dirname(file_path), exist_ok = True)
+
+        attempt = 0
+        while True:
+            try:
+                return cache._attempt(url, file_path, meta)
+            except (_TransientError, http.client.HTTPException, OSError) as e:
+                attempt += 1
+                if attempt > cache.retries:
+                    raise Exception('Failed to download ' + url + ' after ' + str(attempt) + ' attempts : ' + str(e)) from e
+                delay = min(cache.backoff * 2 ** (attempt - 1), cache.max_backoff) * (0.5 + random.random() / 2)
+                lehd.metrics.logger.warning("Retrying %s in %.1f seconds (attempt %d of %d) : %s", url, delay, attempt, cache.retries, e)
+                time.sleep(delay)
+
+
+    def _attempt(url, file_path, meta):
+
+        """
+        makes one attempt at downloading a URL, appending to any partial download of it in a .part file with a Range
+        request, so that a retry only fetches the missing bytes
+        """
+
+        part_path = file_path + ".part"
+        info = cache._read_json(part_path + ".info")
+
+        # a partial download is only resumed if it can be matched to the server's copy with its ETag or Last-Modified
+        offset = 0
+        if meta is None and info is not None and info.get("url") == url and os.path.exists(part_path):
+            if info.get("etag") is not None or info.get("last_modified") is not None:
+                offset = os.path.getsize(part_path)
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag") is not None:
+                headers["If-None-Match"] = meta["etag"]
+            elif meta.get("last_modified") is not None:
+                headers["If-Modified-Since"] = meta["last_modified"]
+        elif offset > 0:
+            headers["Range"] = "bytes=" + str(offset) + "-"
+            headers["If-Range"] = info["etag"] if info.get("etag") is not None else info["last_modified"]
+
+        response = cache._open(url, headers)
+        try:
+            status = response.status
+
+            if status == 304 and meta is not None:
+                cache._touch(file_path, meta)
+                return False
+
+            if status == 416 and offset > 0:
+                # the partial download does not match the server's copy anymore, so it is started over
+                cache._remove(part_path, part_path + ".info")
+                raise _TransientError('The partial download of ' + url + ' could not be resumed')
+
+            if status >= 500 or status == 429:
+                raise _TransientError('HTTP Error ' + str(status) + ': ' + str(response.reason))
+
+            if status not in [200, 206]:
+                raise Exception('HTTP Error ' + str(status) + ': ' + str(response.reason) + ' for ' + url)
+
+            total = response.headers.get("Content-Length")
+            total = None if total is None else int(total)
+            if status == 206:
+                content_range = response.headers.get("Content-Range", "")
+                start = content_range.split(" ")[-1].split("-")[0]
+                if start != str(offset):
+                    cache._remove(part_path, part_path + ".info")
+                    raise _TransientError('The server returned the wrong range of ' + url)
+                length = content_range.split("/")[-1]
+                total = None if length == "*" else int(length)
+            else:
+                offset = 0
+                info = {"url": url, "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+                cache._write_json(part_path + ".info", info)
+
+            with open(part_path, "ab" if offset > 0 else "wb") as f:
+                while True:
+                    block = response.read(1024 * 1024)
+                    if not block:
+                        break
+                    f.write(block)
+        finally:
+            # a connection is not reused after a response that was not read to its end, e.g. a wrong range
+            if response.length:
+                cache._discard(url)
+            response.close()
+
+        size = os.path.getsize(part_path)
+        if total is not None and size != total:
+            # the bytes received so far are kept, and the next attempt resumes after them
+            raise _TransientError('Incomplete download of ' + url + ', expected ' + str(total) + ' bytes but received ' + str(size))
+
+        if cache.verify and url.endswith(".gz") and not cache._verify(part_path):
+            cache._remove(part_path, part_path + ".info")
+            raise _TransientError('The downloaded copy of ' + url + ' is not a valid gzip file')
+
+        os.replace(part_path, file_path)
+        cache._remove(part_path + ".info")
+
+        meta = {
+            "url": url,
+            "size": size,
+            "etag": info.get("etag"),
+            "last_modified": info.get("last_modified"),
+            "last_access": time.time()
+        }
+        cache._write_meta(file_path, meta)
+        return True
+
+
+    def _verify(file_path):
+
+        """
+        returns True if a file is a complete gzip stream, checking its CRC and length
+        """
+
+        try:
+            with gzip.open(file_path, "rb") as f:
+                while f.read(16 * 1024 * 1024):
+                    pass
+            return True
+        except (OSError, EOFError, zlib.error):
+            return False
+
+
+    def _open(url, headers = {}, method = "GET"):
+
+        """
+        sends a request and returns its response (of any status), reusing this thread's open connection to the host
+        if there is one, and following redirects. Requests through a proxy are sent with urllib instead
+        """
+
+        for redirect in range(10):
+
+            parsed = urllib.parse.urlparse(url)
+            headers = dict(headers, **{"User-Agent": cache._user_agent})
+
+            if urllib.request.getproxies().get(parsed.scheme) and not urllib.request.proxy_bypass(parsed.hostname):
+                try:
+                    return urllib.request.urlopen(urllib.request.Request(url, headers = headers, method = method), timeout = cache.timeout)
+                except urllib.error.HTTPError as e:
+                    return e
+
+            path = parsed.path + ("?" + parsed.query if parsed.query else "")
+
+            # a reused connection may have been closed by the server while idle, in which case it is opened again once
+            connection, reused = cache._connection(parsed)
+            try:
+                connection.request(method, path, headers = headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+                connection, reused = cache._connection(parsed)
+                try:
+                    connection.request(method, path, headers = headers)
+                    response = connection.getresponse()
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    raise
+
+            if response.status in [301, 302, 303, 307, 308] and response.headers.get("Location") is not None:
+                response.read()
+                url = urllib.parse.urljoin(url, response.headers.get("Location"))
+                continue
+
+            return response
+
+        raise Exception('Too many redirects for ' + url)
+
+
+    def _connection(parsed):
+
+        """
+        returns this thread's connection to the host of a parsed URL, and whether it was used before
+        """
+
+        connections = getattr(cache._local, "connections", None)
+        if connections is None:
+            connections = cache._local.connections = {}
+
+        key = (parsed.scheme, parsed.netloc)
+        if key in connections and connections[key].sock is not None:
+            return connections[key], True
+
+        if key in connections:
+            connections[key].close()
+        if parsed.scheme == "https":
+            connections[key] = http.client.HTTPSConnection(parsed.netloc, timeout = cache.timeout)
+        else:
+            connections[key] = http.client.HTTPConnection(parsed.netloc, timeout = cache.timeout)
+        return connections[key], False
+
+
+    def _discard(url):
+
+        """
+        closes this thread's connection to the host of a URL, so that the next request opens a new one
+        """
+
+        parsed = urllib.parse.urlparse(url)
+        connection = getattr(cache._local, "connections", {}).pop((parsed.scheme, parsed.netloc), None)
+        if connection is not None:
+            connection.close()
+
+
+    def _remove(*paths):
+
+        for p in paths:
+            if os.path.exists(p):
+                os.remove(p)
+
+
+    def evict(keep = None):
+
+        """
+        removes the least recently used files until the cache fits within @max_bytes
+        """
+
+        with cache._lock:
+
+            entries = []
+            for root, dirs, files in os.walk(cache.directory):
+                for name in files:
+                    if name.endswith(".json"):
+                        file_path = os.path.join(root, name[:-5])
+                        meta = cache._read_meta(file_path)
+                        if meta is not None:
+                            entries.append((meta.get("last_access", 0), meta.get("size", 0), file_path))
+
+            total = sum(entry[1] for entry in entries)
+
+            for last_access, size, file_path in sorted(entries):
+                if total <= cache.max_bytes:
+                    break
+                if file_path == keep:
+                    continue
+                for p in [file_path, file_path + ".json"]:
+                    if os.path.exists(p):
+                        os.remove(p)
+                total -= size
+
+
+    def _entries():
+
+        """
+        returns the paths of the files held in the cache, those with a JSON sidecar, and of the partial downloads
+        """
+
+        entries, partial = [], []
+        for root, dirs, files in os.walk(cache.directory):
+            names = set(files)
+            for name in files:
+                if name.endswith(".json") and name[:-5] in names:
+                    entries.append(os.path.join(root, name[:-5]))
+                elif any(name.endswith(suffix) for suffix in cache._companions):
+                    partial.append(os.path.join(root, name))
+        return entries, partial
+
+
+    def clear():
+
+        """
+        removes every cached file (those with a JSON sidecar) and partial download from the cache, leaving any other
+        files in its directory in place
+        """
+
+        with cache._lock:
+            entries, partial = cache._entries()
+            for file_path in entries:
+                cache._remove(file_path, file_path + ".json")
+            cache._remove(*partial)
+
+            # folders left empty are removed, but never the cache directory itself
+            for root, dirs, files in os.walk(cache.directory, topdown = False):
+                if root != cache.directory and len(os.listdir(root)) == 0:
+                    os.rmdir(root)
+
+
+    def size():
+
+        """
+        returns the total number of bytes currently held in the cache, by the cached files with a JSON sidecar
+        """
+
+        entries, partial = cache._entries()
+        return sum(os.path.getsize(file_path) for file_path in entries)
+
+
+    def cached_size(url):
+
+        """
+        returns the size in bytes of the cached copy of a URL, or None if the cache does not hold a complete copy
+        """
+
+        file_path = cache.path(url)
+        meta = cache._read_meta(file_path)
+        if meta is not None and os.path.exists(file_path) and os.path.getsize(file_path) == meta["size"]:
+            return meta["size"]
+        return None
+
+
+    def remote_size(url):
+
+        """
+        returns the size in bytes of the file at a URL, from the Content-Length of a HEAD request, or None if it is
+        unknown (e.g. in offline mode, or if the request fails)
+        """
+
+        if cache.offline:
+            return None
+
+        try:
+            response = cache._open(url, method = "HEAD")
+            with response:
+                response.read()
+                size = response.headers.get("Content-Length") if response.status == 200 else None
+        except (http.client.HTTPException, OSError):
+            return None
+        return None if size is None else int(size)
+
+
+    def _read_meta(file_path):
+
+        return cache._read_json(file_path + ".json")
+
+
+    def _write_meta(file_path, meta):
+
+        cache._write_json(file_path + ".json", meta)
+
+
+    def _read_json(path):
+
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def _write_json(path, data):
+
+        # the temporary file is named by process, since other processes may write the same sidecar at once
+        tmp = path + "." + str(os.getpid()) + ".tmp"
+        with cache._lock:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+
+
+    def _touch(file_path, meta):
+
+        meta["last_access"] = time.time()
+        cache._write_meta(file_path, meta)
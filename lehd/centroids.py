@@ -0,0 +1,89 @@
+import threading
+
+import lehd
+import pandas as pd
+
+
+class centroids:
+
+    """
+    Process-wide store of the Census 2010 population weighted centroid tables used by to_geo.
+
+    Each state/level table is downloaded (through lehd.cache, so it is also kept on disk) and parsed at most
+    once per process, and kept in memory indexed by GEOID.
+
+    For more information about this source data, see https://www.census.gov/geographies/reference-files/2010/geo/2010-centers-population.html
+    """
+
+    url_base = "https://www2.census.gov/geo/docs/reference/cenpop2010/"
+
+    # url path, file prefix, and GEOID component columns of the table for each geography type
+    levels = {
+        "BG": ["blkgrp/", "CenPop2010_Mean_BG", ["STATEFP", "COUNTYFP", "TRACTCE", "BLKGRPCE"]],
+        "CT": ["tract/", "CenPop2010_Mean_TR", ["STATEFP", "COUNTYFP", "TRACTCE"]],
+        "C": ["county/", "CenPop2010_Mean_CO", ["STATEFP", "COUNTYFP"]],
+        "S": ["", "CenPop2010_Mean_ST", ["STATEFP"]]
+    }
+
+    _tables = {}
+    _lock = threading.Lock()
+
+
+    def url(gtype, state = None):
+
+        """
+        returns the URL of the centroid table of a geography type for a state (numeric code, e.g. "44"), states use a single national table
+        """
+
+        if gtype not in centroids.levels:
+            raise Exception('Only states ("S"), counties ("C"), census tracts ("CT"), and block groups ("BG") have population weighted centroids')
+
+        path, prefix, id_columns = centroids.levels[gtype]
+        return centroids.url_base + path + prefix + ("" if gtype == "S" else state) + ".txt"
+
+
+    def _load(gtype, state):
+
+        path, prefix, id_columns = centroids.levels[gtype]
+
+        df = pd.read_csv(
+            lehd.cache.fetch(centroids.url(gtype, state)),
+            dtype = dict((c, "str") for c in id_columns),
+            encoding = "ISO-8859-1")
+
+        df["geoid"] = df[id_columns[0]]
+        for c in id_columns[1:]:
+            df["geoid"] = df["geoid"] + df[c]
+        for c in id_columns + ["POPULATION"]:
+            del df[c]
+
+        return df.set_index("geoid")
+
+
+    def get(gtype, states):
+
+        """
+        returns the centroid table of a geography type for a list of states (numeric codes), indexed by GEOID,
+        loading each state's table only the first time it is needed in this process
+        """
+
+        keys = [(gtype, None)] if gtype == "S" else [(gtype, state) for state in sorted(set(states))]
+
+        dfl = []
+        for key in keys:
+            with centroids._lock:
+                if key not in centroids._tables:
+                    centroids._tables[key] = centroids._load(*key)
+                dfl.append(centroids._tables[key])
+
+        return dfl[0] if len(dfl) == 1 else pd.concat(dfl)
+
+
+    def clear():
+
+        """
+        removes all centroid tables from memory
+        """
+
+        with centroids._lock:
+            centroids._tables.clear()
@@ -0,0 +1,51 @@
+import sys
+import logging
+import argparse
+
+import lehd
+
+
+def main(argv = None):
+
+    """
+    command line interface of lehd, e.g. "lehd serve --port 8080"
+    """
+
+    parser = argparse.ArgumentParser(prog = "lehd", description = "a Python library for downloading LEHD data")
+    commands = parser.add_subparsers(dest = "command")
+
+    serve = commands.add_parser("serve", help = "run the local HTTP query service, see lehd.service")
+    serve.add_argument("--host", default = lehd.service.host)
+    serve.add_argument("--port", type = int, default = lehd.service.port)
+    serve.add_argument("--max-mb", type = float, default = lehd.service.max_bytes / 1024 ** 2, help = "memory budget of the result cache, in MB")
+    serve.add_argument("--engine", default = lehd.service.engine, choices = ["pandas", "pyarrow"], help = "CSV parse engine of dl_lodes")
+    serve.add_argument("--cache-dir", default = None, help = "folder of the download cache, see lehd.cache")
+    serve.add_argument("--quiet", action = "store_true", help = "do not log requests")
+
+    args = parser.parse_args(argv)
+
+    if args.command != "serve":
+        parser.print_help()
+        return 1
+
+    lehd.service.max_bytes = int(args.max_mb * 1024 ** 2)
+    lehd.service.engine = args.engine
+    if args.cache_dir is not None:
+        lehd.cache.directory = args.cache_dir
+
+    if not args.quiet:
+        logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(message)s")
+
+    httpd = lehd.service.server(args.host, args.port)
+    print("Serving LEHD queries on http://" + args.host + ":" + str(httpd.server_address[1]) + "/ (/wac, /rac, /od, /metrics)", flush = True)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import os
+import threading
+
+import lehd
+import numpy as np
+import pandas as pd
+
+
+class cube:
+
+    """
+    Precomputed geography rollup cube of LODES files.
+
+    When enabled, the first aggregated request for a LODES file builds its cube: the job counts summed to every
+    supported geography level (block groups, census tracts, counties, and states), computed in a single pass over
+    the block rows and saved as one small Parquet file per level. Later wac, rac, and od requests at any of these
+    levels are answered from the cube, as long as the input locations are at the same level as, or coarser than,
+    the output geography. Block level requests are always read from the raw files. Requires pyarrow.
+
+    directory : folder the cubes are written to
+
+    enabled : if True, dl_lodes answers aggregated requests from the cubes
+
+    chunksize : number of block rows read at a time while building a cube
+    """
+
+    directory = os.environ.get("LEHD_CUBE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lehd", "cube"))
+    enabled = False
+    chunksize = 1000000
+
+    # each level, from the finest, is summed from the level before it
+    levels = ["BG", "CT", "C", "S"]
+
+    _lock = threading.Lock()
+    _building = {}
+
+
+    def path(file_name, geography):
+
+        """
+        returns the path of the cube file of a LODES file name (e.g. ri_od_main_JT00_2016.csv.gz) at a geography level
+        """
+
+        return os.path.join(cube.directory, file_name.split(".")[0], geography + ".parquet")
+
+
+    def usable(locations, geography):
+
+        """
+        returns True if a request for a list of @locations GEOIDs at the output @geography can be answered from a cube
+        """
+
+        if geography not in cube.levels:
+            return False
+        # places and county subdivisions are matched through the crosswalk, which needs the block codes
+        return all(len(geoid) <= lehd.utils.geoid_lengths[geography] and lehd.utils.infer_geog_input(geoid) not in lehd.xwalk.levels for geoid in locations)
+
+
+    def build(file_name, url, dtype = None):
+
+        """
+        builds the cube of a LODES file, if it is not built already
+        """
+
+        lehd.store._pyarrow()
+
+        with cube._lock:
+            lock = cube._building.setdefault(file_name, threading.Lock())
+
+        with lock:
+
+            if all(os.path.exists(cube.path(file_name, level)) for level in cube.levels):
+                return
+
+            sides = ["h", "w"] if "_od_" in file_name else (["w"] if "_wac_" in file_name else ["h"])
+            values = [c for c in dtype if not c.endswith("_geocode") and c != "createdate"]
+
+            # the single pass over the block rows, summing each chunk to block groups
+            df = None
+            with pd.read_csv(lehd.cache.fetch(url), compression = "gzip", dtype = dtype, usecols = lambda c: c in dtype and c != "createdate", chunksize = cube.chunksize) as reader:
+                for chunk in reader:
+                    keys = [lehd.utils.get_geoids(chunk[side + "_geocode"].to_numpy(), "BG") for side in sides]
+                    part = chunk[[c for c in values if c in chunk.columns]].astype("int64").groupby(keys).sum()
+                    df = part if df is None else pd.concat([df, part]).groupby(level = list(range(len(sides)))).sum()
+
+            # rolling each level up to the next, and saving it
+            os.makedirs(os.path.dirname(cube.path(file_name, "BG")), exist_ok = True)
+            previous = "BG"
+            for level in cube.levels:
+                if level != previous:
+                    scale = 10 ** (lehd.utils.geoid_lengths[previous] - lehd.utils.geoid_lengths[level])
+                    keys = [df.index.get_level_values(i).to_numpy() // scale for i in range(len(sides))]
+                    df = df.groupby(keys).sum()
+                    previous = level
+                out = df.reset_index(drop = True)
+                for i, side in enumerate(sides):
+                    out.insert(i, side + "_code", df.index.get_level_values(i).to_numpy())
+                # a temporary file of this process and thread, so that concurrent builds never write the same file
+                tmp = cube.path(file_name, level) + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+                out.to_parquet(tmp, index = False)
+                os.replace(tmp, cube.path(file_name, level))
+
+
+    def read(file_name, url, dtype, geography, columns = None):
+
+        """
+        reads the cube of a LODES file at a geography level, building it first if needed
+
+        the result has the same geocode columns as the raw file, holding the code of the first block of each
+        geography, so that it can be subset and aggregated like raw block rows
+        """
+
+        cube.build(file_name, url, dtype)
+
+        if columns is not None:
+            columns = [c.replace("_geocode", "_code") for c in columns]
+
+        df = pd.read_parquet(cube.path(file_name, geography), columns = columns)
+
+        scale = 10 ** (15 - lehd.utils.geoid_lengths[geography])
+        for column in [c for c in df.columns if c.endswith("_code")]:
+            df[column] = df[column].to_numpy(dtype = np.int64) * scale
+        return df.rename(columns = lambda c: c.replace("_code", "_geocode"))
@@ -1,361 +1,659 @@
-
-
 import lehd
 import pandas as pd
-import geopandas as gpd
-import urllib.request
+import numpy as np
 import gzip
-from shapely import wkt
+import contextlib
+import concurrent.futures
 
 class to_geo:
 
     """
     Takes downloaded LEHD data and converts it to GeoDataFrames which can be used for spatial analysis and visualization
+
+    geopandas and shapely are only imported when to_geo is first used, so that processes which only download data
+    with dl_lodes (e.g. worker processes) do not pay for importing them
     """
 
-    def od(df):
+    def _geopandas():
+
+        # the vectorized geometry functions used by to_geo are only in shapely 2
+        try:
+            import shapely
+            import geopandas
+            shapely.linestrings
+        except (ImportError, AttributeError):
+            raise Exception('Joining to geography requires geopandas and shapely 2, which can be installed with "pip install lehd[geo]"')
+        return geopandas
+
 
+    def _geoid_column(df, sides, default):
 
-        gtype = lehd.utils.infer_geog_input(df[df.columns[0]][0])
+        """
+        returns the name of the first GEOID column of any of the @sides (e.g. ["w", "h"]) in a dataframe from dl_lodes,
+        or the column at position @default if there is none
+        """
+
+        for column in df.columns:
+            if str(column)[:8] in [side + "_geoid_" for side in sides]:
+                return column
+        return df.columns[default]
+
+
+    def _gtype(df, column):
+
+        """
+        returns the geography type of a GEOID column, from its name (e.g. "w_geoid_CT") or otherwise from the length of its first GEOID
+        """
+
+        suffix = str(column).split("_geoid_")[-1]
+        if "_geoid_" in str(column) and (suffix in lehd.utils.geoid_lengths or suffix in lehd.xwalk.levels):
+            return suffix
+        return lehd.utils.infer_geog_input(df[column].iloc[0])
+
+
+    def _coordinates(gtype, geoids, states):
+
+        """
+        returns an array of the (longitude, latitude) of a list of GEOIDs of a geography type, using block coordinates
+        for blocks and population weighted centroids for other geographies, with NaN where a GEOID is not found
+        """
 
         if gtype == "B":
+            return np.column_stack(lehd.blocks.lookup(geoids))
+
+        gdf = lehd.centroids.get(gtype, states)[["LONGITUDE", "LATITUDE"]]
+        return gdf.reindex(geoids).to_numpy(dtype = np.float64)
 
-            raise Exception('Joining to blocks is currently not supported')
+
+    def od(df):
+
+        """
+        df : input data frame from dl_lodes.od, at the block ("B"), block group ("BG"), census tract ("CT"), county ("C"), or state ("S") level
+
+        returns a GeoDataFrame with a straight flow line from the origin to the destination of each row, using block coordinates
+        from the LODES geography crosswalk for blocks, and population weighted centroids for other geographies
+        """
+
+        gpd = to_geo._geopandas()
+        import shapely
+
+        summary = lehd.summary("to_geo.od")
+
+        h_column = to_geo._geoid_column(df, ["h"], 0)
+        w_column = to_geo._geoid_column(df, ["w"], 1)
+
+        gtype = to_geo._gtype(df, h_column)
+
+        if gtype in ["B", "BG", "CT", "C", "S"]:
+
+            df["state_o"] = df[h_column].str[:2]
+            df["state_d"] = df[w_column].str[:2]
+
+            # coordinates for the origin and destination states, each state is only loaded once
+            states_for_dl = sorted(set(df["state_o"].unique()) | set(df["state_d"].unique()))
+
+            # building each unique origin-destination line only once, directly from the coordinate arrays
+            with summary.stage("coordinates", rows_in = len(df)) as record:
+                pair_codes, pairs = pd.MultiIndex.from_arrays([df[h_column], df[w_column]]).factorize()
+                coords = np.stack([
+                    to_geo._coordinates(gtype, pairs.get_level_values(0), states_for_dl),
+                    to_geo._coordinates(gtype, pairs.get_level_values(1), states_for_dl)
+                ], axis = 1)
+                record["rows_out"] = len(pairs)
+
+            # pairs with missing coordinates are given an empty geometry
+            with summary.stage("geometry", rows_in = len(pairs)) as record:
+                valid = ~np.isnan(coords).any(axis = (1, 2))
+                lines = np.full(len(pairs), None, dtype = object)
+                lines[valid] = shapely.linestrings(coords[valid])
+
+                gdf = gpd.GeoDataFrame(df, geometry = lines[pair_codes])
+                record["rows_out"] = len(gdf)
+
+        else:
+
+            raise Exception('Only states ("S"), counties ("C"), census tracts ("CT"), block groups ("BG"), and blocks ("B") are supported for joining OD data to point coodrinates')
             return None
 
-        elif gtype == "BG":
 
-            df["state_o"] = df[df.columns[0]].str[:2]
-            df["state_d"] = df[df.columns[1]].str[:2]
+        return summary.attach(gdf)
 
-            states_for_dl = list(df["state_o"].unique())
 
-            gdfo = []
 
-            for state in states_for_dl:
 
-                dl_url = "https://www2.census.gov/geo/docs/reference/cenpop2010/blkgrp/CenPop2010_Mean_BG" + state + ".txt"
+    def wac(df, geo = "pts", tier = "medium"):
 
-                gdf = pd.read_csv(
-                    urllib.request.urlopen(dl_url),
-                    dtype={
-                        'TRACTCE': 'str',
-                        'BLKGRPCE': 'str',
-                        'COUNTYFP': 'str',
-                        'STATEFP': 'str'
-                    }, encoding="ISO-8859-1")
+        """
+        df : input data frame from dl_lodes class
 
-                gdf["geoid"] = gdf["STATEFP"] + gdf["COUNTYFP"] + gdf["TRACTCE"] + gdf["BLKGRPCE"]
-                del gdf["STATEFP"], gdf["COUNTYFP"], gdf["TRACTCE"], gdf["BLKGRPCE"], gdf["POPULATION"]
+        geo : str indicating to link data to points "pts" or polygons "poly". The default are "pts" since they take up less storage
 
-                gdfo.append(gdf)
+        tier : detail tier of the polygons when @geo is "poly", one of "full", "high", "medium", or "low". Lower tiers are
+        more simplified, and are faster to join and use less memory. Polygons must first be built from a boundary file
+        with lehd.polygons.build
+        """
 
-            gdf = pd.concat(gdfo)
+        gpd = to_geo._geopandas()
 
-            # merge the output, and delete an excess ID column
-            df = pd.merge(df, gdf, how = "left", left_on = "h_geoid_BG", right_on = "geoid")
-            del df["geoid"]
+        summary = lehd.summary("to_geo.wac")
 
-            df["LATITUDE"] = df["LATITUDE"].astype(str)
-            df["LONGITUDE"] = df["LONGITUDE"].astype(str)
+        column = to_geo._geoid_column(df, ["w", "h"], 0)
 
-            df["geometry"] = "LINESTRING (" + df["LONGITUDE"] + " " +  df["LATITUDE"] + ","
+        df["state"] = df[column].str[:2]
 
-            del df["LATITUDE"], df["LONGITUDE"]
+        states_for_dl = list(df["state"].unique())
 
+        gtype = to_geo._gtype(df, column)
 
-            states_for_dl = list(df["state_d"].unique())
+        if geo == "pts":
 
-            gdfo = []
+            if gtype == "B":
 
-            for state in states_for_dl:
+                # block coordinates, looked up from the memory-mapped block store
+                with summary.stage("coordinates", rows_in = len(df)):
+                    lon, lat = lehd.blocks.lookup(df[column])
+                with summary.stage("geometry", rows_in = len(df)):
+                    gdf = gpd.GeoDataFrame(df, geometry = gpd.points_from_xy(x = lon, y = lat))
+                return summary.attach(gdf)
 
-                dl_url = "https://www2.census.gov/geo/docs/reference/cenpop2010/blkgrp/CenPop2010_Mean_BG" + state + ".txt"
+            elif gtype in ["BG", "CT", "C", "S"]:
 
-                gdf = pd.read_csv(
-                    urllib.request.urlopen(dl_url),
-                    dtype={
-                        'TRACTCE': 'str',
-                        'BLKGRPCE': 'str',
-                        'COUNTYFP': 'str',
-                        'STATEFP': 'str'
-                    }, encoding="ISO-8859-1")
+                # centroids for the states in the data, each state is only loaded once
+                with summary.stage("coordinates") as record:
+                    gdf = lehd.centroids.get(gtype, states_for_dl).reset_index()
+                    record["rows_out"] = len(gdf)
 
-                gdf["geoid"] = gdf["STATEFP"] + gdf["COUNTYFP"] + gdf["TRACTCE"] + gdf["BLKGRPCE"]
-                del gdf["STATEFP"], gdf["COUNTYFP"], gdf["TRACTCE"], gdf["BLKGRPCE"], gdf["POPULATION"]
+                with summary.stage("geometry", rows_in = len(gdf)):
+                    gdf = gpd.GeoDataFrame(gdf, geometry=gpd.points_from_xy(x=gdf.LONGITUDE, y=gdf.LATITUDE))
 
-                gdfo.append(gdf)
+                del gdf["LATITUDE"], gdf["LONGITUDE"]
 
-            gdf = pd.concat(gdfo)
+            else:
+
+                raise Exception('Only states ("S"), counties ("C"), census tracts ("CT"), block groups ("BG"), and blocks ("B") are supported for joining to point coodrinates')
+                return None
 
             # merge the output, and delete an excess ID column
-            df = pd.merge(df, gdf, how = "left", left_on = "w_geoid_BG", right_on = "geoid")
-            del df["geoid"]
+            with summary.stage("join", rows_in = len(df)) as record:
+                gdf = pd.merge(gdf, df, how = "right", right_on = column, left_on = "geoid")
+                record["rows_out"] = len(gdf)
+            del gdf["geoid"]
+
+        elif geo == "poly":
 
-            df["LATITUDE"] = df["LATITUDE"].astype(str)
-            df["LONGITUDE"] = df["LONGITUDE"].astype(str)
+            if gtype not in ["BG", "CT", "C", "S"]:
 
-            df["geometry"] = df["geometry"] + df["LONGITUDE"] + " " +  df["LATITUDE"] + ")"
+                raise Exception('Only states ("S"), counties ("C"), census tracts ("CT"), and block groups ("BG") are supported for joining to polygons')
+                return None
 
-            del df["LATITUDE"], df["LONGITUDE"]
+            # polygons at the requested detail tier, each tier is only read once
+            with summary.stage("geometry") as record:
+                gdf = lehd.polygons.get(gtype, tier).reset_index()
+                record["rows_out"] = len(gdf)
 
-            df['geometry'] = df['geometry'].apply(wkt.loads)
-            gdf = gpd.GeoDataFrame(df, geometry='geometry')
+            # merge the output, and delete an excess ID column
+            with summary.stage("join", rows_in = len(df)) as record:
+                gdf = pd.merge(gdf, df, how = "right", right_on = column, left_on = "geoid")
+                record["rows_out"] = len(gdf)
+            del gdf["geoid"]
 
+        else:
 
+            raise Exception('Please make sure the input parameter @geo is one of ["pts","poly"]')
+            return None
 
+        return summary.attach(gdf)
 
-        elif gtype == "CT":
+    rac = wac
 
-            df["state_o"] = df[df.columns[0]].str[:2]
-            df["state_d"] = df[df.columns[1]].str[:2]
 
-            states_for_dl = list(df["state_o"].unique())
+class dl_lodes:
+
+    """
+    Simple class for downloading LEHD data.
 
-            gdfo = []
+    For more information about this source data, see https://lehd.ces.census.gov/data/
+    """
 
-            for state in states_for_dl:
+    url_base = "https://lehd.ces.census.gov/data/lodes/LODES7/"
 
-                dl_url = "https://www2.census.gov/geo/docs/reference/cenpop2010/tract/CenPop2010_Mean_TR" + state + ".txt"
+    # states (and DC) with LODES files
+    states = ["AK","AL","AR","AZ","CA","CO","CT","DC","DE","FL","GA","HI","IA","ID","IL","IN","KS","KY","LA","MA","MD","ME","MI","MN","MO","MS","MT","NC","ND","NE","NH","NJ","NM","NV","NY","OH","OK","OR","PA","RI","SC","SD","TN","TX","UT","VA","VT","WA","WI","WV","WY"]
 
-                gdf = pd.read_csv(
-                    urllib.request.urlopen(dl_url),
-                    dtype={
-                        'TRACTCE': 'str',
-                        'COUNTYFP': 'str',
-                        'STATEFP': 'str'
-                    }, encoding="ISO-8859-1")
+    wac_values = ['C000', 'CA01', 'CA02', 'CA03', 'CE01', 'CE02', 'CE03', 'CNS01', 'CNS02', 'CNS03', 'CNS04', 'CNS05', 'CNS06', 'CNS07', 'CNS08', 'CNS09', 'CNS10', 'CNS11', 'CNS12', 'CNS13', 'CNS14', 'CNS15', 'CNS16', 'CNS17', 'CNS18', 'CNS19', 'CNS20', 'CR01', 'CR02', 'CR03', 'CR04', 'CR05', 'CR07', 'CT01', 'CT02', 'CD01', 'CD02', 'CD03', 'CD04', 'CS01', 'CS02']
 
-                gdf["geoid"] = gdf["STATEFP"] + gdf["COUNTYFP"] + gdf["TRACTCE"]
-                del gdf["STATEFP"], gdf["COUNTYFP"], gdf["TRACTCE"],  gdf["POPULATION"]
+    od_values = ["S000","SA01","SA02","SA03","SE01","SE02","SE03","SI01","SI02","SI03"]
 
-                gdfo.append(gdf)
+    firm_values = ['CFA01', 'CFA02', 'CFA03', 'CFA04', 'CFA05', 'CFS01', 'CFS02', 'CFS03', 'CFS04', 'CFS05']
 
-            gdf = pd.concat(gdfo)
+    # declared column types for each LODES file type, with job counts read as narrow unsigned integers
+    schema = {
+        "wac": dict([("w_geocode", "int64")] + [(c, "uint32") for c in wac_values + firm_values] + [("createdate", "uint32")]),
+        "rac": dict([("h_geocode", "int64")] + [(c, "uint32") for c in wac_values] + [("createdate", "uint32")]),
+        "od": dict([("w_geocode", "int64"), ("h_geocode", "int64")] + [(c, "uint16") for c in od_values] + [("createdate", "uint32")])
+    }
 
-            # merge the output, and delete an excess ID column
-            df = pd.merge(df, gdf, how = "left", left_on = df.columns[0], right_on = "geoid")
-            del df["geoid"]
+    def __init__(self):
 
-            df["LATITUDE"] = df["LATITUDE"].astype(str)
-            df["LONGITUDE"] = df["LONGITUDE"].astype(str)
+        None
 
-            df["geometry"] = "LINESTRING (" + df["LONGITUDE"] + " " +  df["LATITUDE"] + ","
 
-            del df["LATITUDE"], df["LONGITUDE"]
+    def _read_files(files, max_workers = 4, process = None, chunksize = None, dtype = None, usecols = None, filter = None, cube_level = None, summary = None, engine = "pandas"):
 
+        """
+        downloads and reads a list of (file_name, url) LODES files, using up to @max_workers threads,
+        and returns the resulting dataframes in the same order as the input list
 
-            states_for_dl = list(df["state_d"].unique())
+        if @process is given, it is applied to each file, or to each chunk of @chunksize rows of a file,
+        as it is read, so that only its (smaller) output is kept in memory
 
-            gdfo = []
+        @dtype and @usecols declare column types and skip unneeded columns while parsing with the "pandas" or "pyarrow" @engine
 
-            for state in states_for_dl:
+        if lehd.store is enabled, files are read from the columnar store instead, with @filter used to skip
+        row groups that do not match the input locations
 
-                dl_url = "https://www2.census.gov/geo/docs/reference/cenpop2010/tract/CenPop2010_Mean_TR" + state + ".txt"
+        if @cube_level is given, each file is read from its rollup cube at that geography level instead (see lehd.cube)
 
-                gdf = pd.read_csv(
-                    urllib.request.urlopen(dl_url),
-                    dtype={
-                        'TRACTCE': 'str',
-                        'COUNTYFP': 'str',
-                        'STATEFP': 'str'
-                    }, encoding="ISO-8859-1")
+        the time, rows, and bytes of the download and parse stages of each file are recorded in @summary (see lehd.metrics)
+        """
 
-                gdf["geoid"] = gdf["STATEFP"] + gdf["COUNTYFP"] + gdf["TRACTCE"]
-                del gdf["STATEFP"], gdf["COUNTYFP"], gdf["TRACTCE"], gdf["POPULATION"]
+        if summary is None:
+            summary = lehd.summary("read")
+
+        def read(file):
+            file_name, url = file
+            lehd.metrics.logger.info("Trying to download %s from %s", file_name, url)
+            summary.count("files", 1)
+            try:
+                if cube_level is not None:
+                    with summary.stage("read", file_name) as record:
+                        df = lehd.cube.read(file_name, url, dtype, cube_level, usecols)
+                        record["rows_out"] = len(df)
+                    return df if process is None else process(df)
+                if lehd.store.enabled:
+                    chunks = summary.iterate("read", lehd.store.read(file_name, url, dtype, usecols, filter, chunksize), file_name)
+                    return pd.concat([chunk if process is None else process(chunk) for chunk in chunks])
+                # the file is decompressed here rather than by pandas, to count the decompressed bytes
+                with gzip.open(dl_lodes._fetch(file_name, url, summary)) as f:
+                    if chunksize is None:
+                        with summary.stage("parse", file_name) as record:
+                            df = dl_lodes._parse(f, dtype, usecols, engine)
+                            record["rows_out"] = len(df)
+                        summary.count("bytes_decompressed", f.tell())
+                        return df if process is None else process(df)
+                    # the chunk reader is closed before the file, also when processing a chunk fails
+                    with contextlib.closing(dl_lodes._parse_chunks(f, dtype, usecols, chunksize, engine)) as chunks:
+                        df = pd.concat([chunk if process is None else process(chunk) for chunk in summary.iterate("parse", chunks, file_name)])
+                    summary.count("bytes_decompressed", f.tell())
+                    return df
+            except Exception as e:
+                raise Exception('Failed to download or read ' + file_name + ' from ' + url + ' : ' + str(e)) from e
+
+        if max_workers is None or max_workers < 1:
+            raise Exception('Please make sure the input parameter @max_workers is a positive integer')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = min(max_workers, max(len(files), 1))) as executor:
+            futures = [executor.submit(read, file) for file in files]
+            return [future.result() for future in futures]
+
+
+    def _parse(f, dtype, usecols, engine):
 
-                gdfo.append(gdf)
+        """
+        parses an open (decompressed) LODES file into a dataframe with the "pandas" or "pyarrow" @engine,
+        with the same column types (@dtype) and columns (@usecols) under both
+        """
 
-            gdf = pd.concat(gdfo)
+        if engine == "pandas":
+            return pd.read_csv(f, dtype = dtype, usecols = usecols)
 
-            # merge the output, and delete an excess ID column
-            df = pd.merge(df, gdf, how = "left", left_on = df.columns[1], right_on = "geoid")
-            del df["geoid"]
+        csv = dl_lodes._pyarrow_csv()
+        table = csv.read_csv(f, read_options = csv.ReadOptions(use_threads = True), convert_options = dl_lodes._convert_options(csv, dtype, usecols))
+        # each column becomes its own pandas block, so numeric columns are not copied, and the table is freed as it is converted
+        return table.to_pandas(split_blocks = True, self_destruct = True)
 
-            df["LATITUDE"] = df["LATITUDE"].astype(str)
-            df["LONGITUDE"] = df["LONGITUDE"].astype(str)
 
-            df["geometry"] = df["geometry"] + df["LONGITUDE"] + " " +  df["LATITUDE"] + ")"
+    def _parse_chunks(f, dtype, usecols, chunksize, engine):
 
-            del df["LATITUDE"], df["LONGITUDE"]
+        """
+        yields the dataframes of each @chunksize rows of an open (decompressed) LODES file, see dl_lodes._parse
+        """
 
-            df['geometry'] = df['geometry'].apply(wkt.loads)
-            gdf = gpd.GeoDataFrame(df, geometry='geometry')
+        if engine == "pandas":
+            with pd.read_csv(f, dtype = dtype, usecols = usecols, chunksize = chunksize) as reader:
+                yield from reader
+            return
 
+        import pyarrow
 
+        csv = dl_lodes._pyarrow_csv()
+        reader = csv.open_csv(f, read_options = csv.ReadOptions(use_threads = True), convert_options = dl_lodes._convert_options(csv, dtype, usecols))
 
+        # the blocks of the reader are regrouped into chunks of exactly @chunksize rows, indexed by row number as with pandas
+        batches, rows, start = [], 0, 0
+        for batch in reader:
+            batches.append(batch)
+            rows += batch.num_rows
+            while rows >= chunksize:
+                table = pyarrow.Table.from_batches(batches, schema = reader.schema)
+                df = table.slice(0, chunksize).to_pandas()
+                df.index = pd.RangeIndex(start, start + chunksize)
+                yield df
+                start += chunksize
+                table = table.slice(chunksize)
+                batches, rows = table.to_batches(), table.num_rows
+        if rows > 0:
+            df = pyarrow.Table.from_batches(batches, schema = reader.schema).to_pandas()
+            df.index = pd.RangeIndex(start, start + rows)
+            yield df
 
-        return gdf
 
+    def _pyarrow_csv():
 
+        try:
+            import pyarrow.csv
+        except ImportError:
+            raise Exception('The pyarrow engine requires pyarrow, which can be installed with "pip install lehd[arrow]"')
+        return pyarrow.csv
 
 
-    def wac(df, geo = "pts"):
+    def _convert_options(csv, dtype, usecols):
 
         """
-        df : input data frame from dl_lodes class
+        returns the pyarrow ConvertOptions of a LODES schema (@dtype) and the columns to read (@usecols), keeping the column order of the file as pandas does
+        """
+
+        import pyarrow
+
+        # all columns are read if @usecols is None, since some columns (e.g. the firm columns of WAC files) are only in some years
+        columns = [] if usecols is None else [c for c in dtype.keys() if c in usecols]
+        return csv.ConvertOptions(
+            column_types = dict((c, pyarrow.from_numpy_dtype(np.dtype(t))) for c, t in dtype.items()),
+            include_columns = columns)
+
+
+    def _fetch(file_name, url, summary):
 
-        geo : str indicating to link data to points "pts" or polygons "poly". The default are "pts" since they take up less storage
+        """
+        fetches a file through lehd.cache, timing it as the download stage of @summary, and counting its bytes if it was not already cached
         """
 
-        df["state"] = df[df.columns[0]].str[:2]
+        with summary.stage("download", file_name):
+            cached = lehd.cache.cached_size(url) if lehd.cache.enabled else None
+            source = lehd.cache.fetch(url)
+            if lehd.cache.enabled and cached is None:
+                summary.count("bytes_downloaded", lehd.cache.cached_size(url))
+        return source
 
-        states_for_dl = list(df["state"].unique())
 
-        gtype = lehd.utils.infer_geog_input(df[df.columns[0]][0])
+    def _file(state, kind, seg, type, year):
 
-        if geo == "pts":
+        """
+        returns the (file_name, url) of a LODES file, where @seg is the workforce segment for WAC and RAC, or the part ("main" or "aux") for OD
+        """
 
-            if gtype == "B":
+        file_name = state.lower() + "_" + kind + "_" + seg + "_" + type + "_" + str(year) + ".csv.gz"
+        url = dl_lodes.url_base + state.lower() + "/" + kind + "/" + file_name
+        return file_name, url
 
-                raise Exception('Joining to blocks is currently not supported')
-                return None
 
-            elif gtype == "BG":
+    def _characteristics_files(kind, states, years, segs, types):
 
-                gdfo = []
+        """
+        plans the WAC or RAC files to download for lists of states, years, segs, and types, returning the list of
+        (file_name, url), the (year, seg, type) label of each file, and the list of unique labels
+        """
 
-                for state in states_for_dl:
+        files = []
+        file_labels = []
+        labels = []
+        for year in years:
+            for seg in segs:
+                for type in types:
+                    labels.append((year, seg, type))
+                    for state in states:
+                        files.append(dl_lodes._file(state, kind, seg, type, year))
+                        file_labels.append((year, seg, type))
+        return files, file_labels, labels
 
-                    dl_url = "https://www2.census.gov/geo/docs/reference/cenpop2010/blkgrp/CenPop2010_Mean_BG" + state + ".txt"
 
-                    #print(dl_url)
+    def _od_parts(state, origin_states, destination_states, constrained):
 
-                    gdf = pd.read_csv(
-                        urllib.request.urlopen(dl_url),
-                        dtype={
-                            'TRACTCE': 'str',
-                            'BLKGRPCE': 'str',
-                            'COUNTYFP': 'str',
-                            'STATEFP': 'str'
-                        }, encoding="ISO-8859-1")
+        """
+        returns the parts ("aux" and/or "main") of a state's OD files that can contain rows matching the input origin and
+        destination states. Every row of a state's files has its workplace in that state, "main" rows have their home in the
+        same state, and "aux" rows have their home in another state
+        """
 
-                    gdf["geoid"] = gdf["STATEFP"] + gdf["COUNTYFP"] + gdf["TRACTCE"] + gdf["BLKGRPCE"]
-                    del gdf["STATEFP"], gdf["COUNTYFP"], gdf["TRACTCE"], gdf["BLKGRPCE"], gdf["POPULATION"]
+        parts = []
+        for part in ["aux", "main"]:
 
-                    gdf = gpd.GeoDataFrame(gdf, geometry=gpd.points_from_xy(x=gdf.LONGITUDE, y=gdf.LATITUDE))
+            # whether rows in this part can match the origins (by home state) or destinations (by workplace state)
+            if part == "main":
+                origin_match = state in origin_states
+            else:
+                origin_match = len(set(origin_states) - set([state])) > 0
+            destination_match = state in destination_states
+
+            if len(destination_states) == 0:
+                keep = origin_match
+            elif len(origin_states) == 0:
+                keep = destination_match
+            elif constrained == "yes":
+                keep = origin_match and destination_match
+            else:
+                keep = origin_match or destination_match
 
-                    del gdf["LATITUDE"], gdf["LONGITUDE"]
+            if keep:
+                parts.append(part)
+        return parts
 
-                    gdfo.append(gdf)
 
-                gdf = pd.concat(gdfo)
+    def _od_files(origin_states, destination_states, constrained, years, types):
 
-            elif gtype == "CT":
+        """
+        plans the OD files to download for the input origin and destination states, years, and types, skipping file parts
+        that cannot contain matching rows, and returning the list of (file_name, url), the (year, type) label of each file,
+        and the list of unique labels
+        """
 
-                gdfo = []
+        states_for_dl = sorted(set(list(origin_states) + list(destination_states)))
 
+        files = []
+        file_labels = []
+        labels = []
+        for year in years:
+            for type in types:
+                labels.append((year, type))
                 for state in states_for_dl:
+                    for part in dl_lodes._od_parts(state, origin_states, destination_states, constrained):
+                        files.append(dl_lodes._file(state, "od", part, type, year))
+                        file_labels.append((year, type))
+        return files, file_labels, labels
 
-                    dl_url = "https://www2.census.gov/geo/docs/reference/cenpop2010/tract/CenPop2010_Mean_TR" + state + ".txt"
 
-                    print(dl_url)
+    def _check_params(years, geography, types, chunksize, engine = "pandas"):
 
-                    gdf = pd.read_csv(
-                        urllib.request.urlopen(dl_url),
-                        dtype={
-                            'TRACTCE': 'str',
-                            'COUNTYFP': 'str',
-                            'STATEFP': 'str'
-                        }, encoding="ISO-8859-1")
+        """
+        checks the input parameters shared by wac, rac, and od, and the panel versions of these, returning the years as integers
+        """
 
-                    gdf["geoid"] = gdf["STATEFP"] + gdf["COUNTYFP"] + gdf["TRACTCE"]
-                    del gdf["STATEFP"], gdf["COUNTYFP"], gdf["TRACTCE"], gdf["POPULATION"]
+        years = [int(year) for year in years]
+        for year in years:
+            if year < 2002:
+                raise Exception('LEHD OD data is unavailable prior to 2002')
+            if year > 2017:
+                raise Exception('LEHD OD data is unavailable after to 2017')
 
-                    gdf = gpd.GeoDataFrame(gdf, geometry=gpd.points_from_xy(x=gdf.LONGITUDE, y=gdf.LATITUDE))
+        if geography not in ["B","BG","CT","C","S"] + list(lehd.xwalk.levels.keys()):
 
-                    del gdf["LATITUDE"], gdf["LONGITUDE"]
+            raise Exception('Please make sure the input parameter @geography is one of ' + str(["B","BG","CT","C","S"] + list(lehd.xwalk.levels.keys())))
 
-                    gdfo.append(gdf)
+        for type in types:
+            if type not in ["JT00","JT01","JT02","JT03","JT04","JT05"]:
 
-                gdf = pd.concat(gdfo)
+                raise Exception('Please make sure the input parameter @type is one of ["JT00","JT01","JT02","JT03","JT04","JT05"]')
 
-            elif gtype == "C":
+        if chunksize is not None and int(chunksize) < 1:
 
-                gdfo = []
+            raise Exception('Please make sure the input parameter @chunksize is None or a positive integer')
 
-                for state in states_for_dl:
+        if engine not in ["pandas", "pyarrow"]:
 
-                    dl_url = "https://www2.census.gov/geo/docs/reference/cenpop2010/county/CenPop2010_Mean_CO" + state + ".txt"
+            raise Exception('Please make sure the input parameter @engine is one of ["pandas","pyarrow"]')
 
-                    print(dl_url)
+        return years
 
-                    gdf = pd.read_csv(
-                        urllib.request.urlopen(dl_url),
-                        dtype={
-                            'COUNTYFP': 'str',
-                            'STATEFP': 'str'
-                        }, encoding="ISO-8859-1")
 
-                    gdf["geoid"] = gdf["STATEFP"] + gdf["COUNTYFP"]
-                    del gdf["STATEFP"], gdf["COUNTYFP"], gdf["POPULATION"],
+    def _check_locations(kind, locations = None, origins = None, destinations = None, constrained = "no"):
 
-                    gdf = gpd.GeoDataFrame(gdf, geometry=gpd.points_from_xy(x=gdf.LONGITUDE, y=gdf.LATITUDE))
+        """
+        checks the input locations of wac and rac, or the origins, destinations, and constraint of od
+        """
 
-                    del gdf["LATITUDE"], gdf["LONGITUDE"]
+        if kind != "od":
 
-                    gdfo.append(gdf)
+            if locations is None:
 
-                gdf = pd.concat(gdfo)
+                raise Exception('Please input a list of locations to download data for')
 
-            elif gtype == "S":
+            return
 
+        if constrained not in ["yes","no"]:
 
-                dl_url = "https://www2.census.gov/geo/docs/reference/cenpop2010/CenPop2010_Mean_ST.txt"
+            raise Exception('Please make sure the input parameter @constrained is one of ["yes","no"]')
 
-                print(dl_url)
+        if origins is None and destinations is None:
 
-                gdf = pd.read_csv(
-                    urllib.request.urlopen(dl_url),
-                    dtype={
-                        'STATEFP': 'str'
-                    }, encoding="ISO-8859-1")
+            raise Exception("Please input a list of origins and/or a list of destinations")
 
-                gdf["geoid"] = gdf["STATEFP"]
-                del gdf["STATEFP"], gdf["POPULATION"],
 
-                gdf = gpd.GeoDataFrame(gdf, geometry=gpd.points_from_xy(x=gdf.LONGITUDE, y=gdf.LATITUDE))
+    def _combine(dfl, file_labels, labels, label_names, finalize, summary):
 
-                del gdf["LATITUDE"], gdf["LONGITUDE"]
+        """
+        combines the dataframes read from each file into one output per label (e.g. per year/seg/type), using
+        @finalize, and returns a single long-form dataframe (or pyarrow table) with the label columns if there is more than one label
+        """
 
-            else:
+        lehd.metrics.logger.info("Finalizing the output ...")
+
+        dfo = []
+        for label in labels:
+            with summary.stage("combine") as record:
+                df = pd.concat([d for d, l in zip(dfl, file_labels) if l == label])
+                record["rows_out"] = len(df)
+            with summary.stage("finalize", rows_in = len(df)) as record:
+                df = finalize(df)
+                record["rows_out"] = None if isinstance(df, lehd.od_matrix) else len(df)
+            if label_names is not None:
+                for i, name in enumerate(label_names):
+                    if isinstance(df, pd.DataFrame):
+                        df.insert(i, name, label[i])
+                    else:
+                        df = df.add_column(i, name, dl_lodes._pyarrow().array(np.full(len(df), label[i])))
+            dfo.append(df)
+
+        if label_names is None:
+            return dfo[0]
+        if not isinstance(dfo[0], pd.DataFrame):
+            return dl_lodes._pyarrow().concat_tables(dfo)
+        return pd.concat(dfo, ignore_index = True)
+
+
+    def _projection(kind, geography, columns):
 
-                raise Exception('Only states ("S"), counties ("C"), census tracts ("CT"), block groups ("BG"), and blocks ("B") are supported for joining to point coodrinates')
-                return None
+        """
+        returns the job count columns to output for a file type, and the list of columns to read from its files
+        (or None to read every column)
+        """
 
-            # merge the output, and delete an excess ID column
-            gdf = pd.merge(gdf, df, how = "right", right_on = df.columns[0], left_on = "geoid")
-            del gdf["geoid"]
+        allowed = dl_lodes.od_values if kind == "od" else dl_lodes.wac_values + (dl_lodes.firm_values if kind == "wac" else [])
 
-        elif geo == "poly":
+        if columns is not None:
+            columns = list(columns)
+            for column in columns:
+                if column not in allowed:
+                    raise Exception('Please make sure the input parameter @columns only contains values from ' + str(allowed))
 
-            raise Exception('Joining to polygons is currently not supported')
-            return None
+        # block level output with no columns specified keeps every column of the raw files
+        if geography == "B" and columns is None:
+            return allowed, None
 
-        else:
+        values = columns if columns is not None else (dl_lodes.od_values if kind == "od" else dl_lodes.wac_values)
+        geocodes = ["w_geocode", "h_geocode"] if kind == "od" else [("w" if kind == "wac" else "h") + "_geocode"]
+        return values, geocodes + values
 
-            raise Exception('Please make sure the input parameter @geo is one of ["pts","poly"]')
-            return None
 
-        return gdf
+    def _widen(df):
 
-    rac = wac
+        """
+        returns block level output with its job count columns, read as narrow unsigned integers, cast back to 64-bit
+        integers, so that arithmetic on them (e.g. differences between years) does not wrap around
+        """
 
+        return df.astype(dict((c, "int64") for c in df.columns if not c.endswith("_geocode") and df[c].dtype.kind == "u"))
 
-class dl_lodes:
 
-    """
-    Simple class for downloading LEHD data.
+    def _block_geoids(df, side, locations):
 
-    For more information about this source data, see https://lehd.ces.census.gov/data/
-    """
+        """
+        replaces the integer @side ("w" or "h") block codes of block level output with zero-padded GEOID strings,
+        along with the GEOIDs of the geography levels of the input @locations
+        """
 
-    def __init__(self):
+        codes = df[side + "_geocode"].to_numpy(dtype = np.int64)
+        del df[side + "_geocode"]
+        df[side + "_geoid_B"] = lehd.utils.format_geoids(codes, "B")
+        if locations is not None:
+            for geoid in list(locations["gtype"].unique()):
+                if geoid != "B":
+                    df[side + "_geoid_" + geoid] = lehd.utils.format_geoids(lehd.utils.get_geoids(codes, geoid), geoid)
+        return df
 
-        None
+
+    def _pyarrow():
+
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception('The arrow output requires pyarrow, which can be installed with "pip install lehd[arrow]"')
+        return pyarrow
+
+
+    def _arrow_table(geoids, df, values):
+
+        """
+        returns a pyarrow table of dictionary-encoded GEOID columns, from a list of (name, integer codes, geography type)
+        @geoids, followed by the @values columns of a dataframe, which are not copied
+        """
+
+        pyarrow = dl_lodes._pyarrow()
+
+        columns = [(name, lehd.utils.geoid_dictionary(codes, gtype)) for name, codes, gtype in geoids]
+        columns += [(c, pyarrow.array(df[c].to_numpy())) for c in values]
+        return pyarrow.table(dict(columns))
+
+
+    def _block_table(df, sides):
+
+        """
+        returns block level output as a pyarrow table, with the same columns as dl_lodes._block_geoids, for a list of
+        (side, input locations) @sides, e.g. [("h", origins), ("w", destinations)] for OD data
+        """
+
+        geocodes = [side + "_geocode" for side, l in sides]
+        table = dl_lodes._arrow_table([], df, [c for c in df.columns if c not in geocodes])
+        for side, locations in sides:
+            codes = df[side + "_geocode"].to_numpy(dtype = np.int64)
+            table = table.append_column(side + "_geoid_B", lehd.utils.geoid_dictionary(codes, "B"))
+            if locations is not None:
+                for geoid in list(locations["gtype"].unique()):
+                    if geoid != "B":
+                        table = table.append_column(side + "_geoid_" + geoid, lehd.utils.geoid_dictionary(lehd.utils.get_geoids(codes, geoid), geoid))
+        return table
 
 
-    def wac(locations, year = 2016, geography = "B", seg = "S000", type = "JT00"):
+    def wac(locations, year = 2016, geography = "B", seg = "S000", type = "JT00", max_workers = 4, chunksize = None, columns = None, output = "pandas", engine = "pandas"):
 
         """
         Downloads workplace characteristic (WAC) data into a pandas dataframe
@@ -374,211 +672,253 @@ class dl_lodes:
         "CS" | county subdivision
         "C"  | counties
         "S"  | states
+        "CBSA" | core based statistical areas
+        "ZCTA" | ZIP code tabulation areas
+        Places, county subdivisions, CBSAs, and ZCTAs are aggregated with the LODES geography crosswalk (see lehd.xwalk)
         The default are blocks, which are how the raw data is provided, which thus does not require aggregation
 
         seg : Segment of the workforce, can have the values of “S000”, “SA01”, “SA02”, “SA03”, “SE01”, “SE02”, “SE03”, “SI01”, “SI02”, or “SI03”. Default is all workers. Please see https://lehd.ces.census.gov/data/lodes/LODES7/LODESTechDoc7.4.pdf for detail on the subset workforce segments
 
         type : From the LEHD documentation, this can have a value of "JT00" for All Jobs, "JT01" for Primary Jobs, "JT02" for All Private Jobs, "JT03" for Private Primary Jobs, "JT04" for All Federal Jobs, or "JT05" for Federal Primary Jobs.
 
+        max_workers : maximum number of state files to download and read at the same time. Default is 4
+
+        chunksize : if set, each state file is read in chunks of this many rows, which are subset (and aggregated, if applicable) as they are read, so that memory use is bounded by the chunk size rather than the size of the state file. Default is None, reading each file at once
+
+        columns : list of job count columns to download and return, e.g. ["C000", "CE01"]. Columns not listed are skipped while reading. Default is None, returning all job count columns
+
+        output : the format of the output
+        "pandas" | a pandas dataframe
+        "arrow"  | a pyarrow table, with dictionary-encoded GEOID columns, and the metrics of the call in its schema metadata (requires pyarrow)
+
+        engine : the CSV parser used to read each file, "pandas" (the default), or "pyarrow" to parse with the multi-threaded pyarrow CSV reader (requires pyarrow). Both read the same columns with the same types
+
         """
 
-        # initial parameter checking
+        return dl_lodes._characteristics("wac", locations, [year], geography, [seg], [type], max_workers, chunksize, columns, False, output, engine)
 
-        year = int(year)
-        if year < 2002:
-            raise Exception('LEHD OD data is unavailable prior to 2002')
-        if year > 2017:
-            raise Exception('LEHD OD data is unavailable after to 2017')
 
-        if geography not in ["B","BG","CT","C","S"]:
 
-            raise Exception('Please make sure the input parameter @geography is one of ["B","BG","CT","C","S"]')
 
-        if type not in ["JT00","JT01","JT02","JT03","JT04","JT05"]:
 
-            raise Exception('Please make sure the input parameter @type is one of ["JT00","JT01","JT02","JT03","JT04","JT05"]')
+    def rac(locations, year = 2016, geography = "B", seg = "S000", type = "JT00", max_workers = 4, chunksize = None, columns = None, output = "pandas", engine = "pandas"):
 
-        if seg not in ["S000", "SA01", "SA02", "SA03", "SE01", "SE02", "SE03", "SI01", "SI02"]:
+        """
+        Downloads residential characteristic (RAC) data into a pandas dataframe
 
-            raise Exception('Please make sure the input parameter @seg is one of ["S000", "SA01", "SA02", "SA03", "SE01", "SE02", "SE03", "SI01", "SI02"]')
+        Parameters
+        ----------
+        locations | List of home locations to download data for, where locations are strings of GEOIDs. Must be specified
 
+        year : int or str representing the year to download data for
 
-        # getting list of states to download data for
+        geography : The geographic scale in which to aggregate data to. The options are as follows:
+        "B"  | blocks
+        "BG" | block groups
+        "CT" | census tracts
+        "P"  | places
+        "CS" | county subdivision
+        "C"  | counties
+        "S"  | states
+        "CBSA" | core based statistical areas
+        "ZCTA" | ZIP code tabulation areas
+        Places, county subdivisions, CBSAs, and ZCTAs are aggregated with the LODES geography crosswalk (see lehd.xwalk)
+        The default are blocks, which are how the raw data is provided, which thus does not require aggregation
 
-        states_for_dl = []
-        if locations is not None:
-            locations = pd.DataFrame(locations)
-            locations.columns = ["o"]
-            locations["gtype"] = locations["o"].apply(lehd.utils.infer_geog_input)
-            states_for_dl = lehd.utils.get_state_alpha(locations, "o")
-        else:
-            raise Exception('Please input a list of locations to download data for')
-        states_for_dl = list(set(list(states_for_dl)))
+        seg : Segment of the workforce, can have the values of “S000”, “SA01”, “SA02”, “SA03”, “SE01”, “SE02”, “SE03”, “SI01”, “SI02”, or “SI03”. Default is all workers. Please see https://lehd.ces.census.gov/data/lodes/LODES7/LODESTechDoc7.4.pdf for detail on the subset workforce segments
 
-        # setting up the URLs needed for download, then download and put into a single pandas dataframe
+        type : From the LEHD documentation, this can have a value of "JT00" for All Jobs, "JT01" for Primary Jobs, "JT02" for All Private Jobs, "JT03" for Private Primary Jobs, "JT04" for All Federal Jobs, or "JT05" for Federal Primary Jobs.
 
-        url_base = "https://lehd.ces.census.gov/data/lodes/LODES7/"
-        dfl = []
-        for state in states_for_dl:
-            file_name = state.lower() + "_wac_" + seg + "_" + type + "_" + str(year) + ".csv.gz"
-            url = url_base + state.lower() + "/wac/" + file_name
-            print("Trying to download ", file_name, " from ", url, " ......")
-            df = pd.read_csv(urllib.request.urlopen(url), compression = "gzip")
-            dfl.append(df)
-        df = pd.concat(dfl)
+        max_workers : maximum number of state files to download and read at the same time. Default is 4
 
-        # cleaning and adding leading 0s to block ids
-        df["w_geoid_B"] = df["w_geocode"].astype(str)
-        df["w_geoid_B"] = df["w_geoid_B"].str.zfill(15)
-        del df["w_geocode"]
+        chunksize : if set, each state file is read in chunks of this many rows, which are subset (and aggregated, if applicable) as they are read, so that memory use is bounded by the chunk size rather than the size of the state file. Default is None, reading each file at once
 
-        # add column for aggregation, if applicable
-        if geography != "B":
-            df["w_geoid_" + geography] = df["w_geoid_B"].apply(lehd.utils.get_geoid, args = (geography,))
+        columns : list of job count columns to download and return, e.g. ["C000", "CE01"]. Columns not listed are skipped while reading. Default is None, returning all job count columns
 
+        output : the format of the output
+        "pandas" | a pandas dataframe
+        "arrow"  | a pyarrow table, with dictionary-encoded GEOID columns, and the metrics of the call in its schema metadata (requires pyarrow)
 
-        # substting the data based on the input locations
+        engine : the CSV parser used to read each file, "pandas" (the default), or "pyarrow" to parse with the multi-threaded pyarrow CSV reader (requires pyarrow). Both read the same columns with the same types
 
-        print("Subsetting the data based on the input locations list ...")
-        dfm = []
-        for geoid in list(locations["gtype"].unique()):
-            if geoid != "B" and geoid != geography:
-                df["w_geoid_" + geoid] = df["w_geoid_B"].apply(lehd.utils.get_geoid, args = (geoid,))
-            list_unique = list(locations["o"][locations["gtype"] == geoid].unique())
-            dfs = df[df["w_geoid_" + geoid].isin(list_unique)]["w_geoid_B"].unique()
-            dfm = dfm + list(dfs)
-        df = df.query("w_geoid_B in @dfm")
+        """
 
+        return dl_lodes._characteristics("rac", locations, [year], geography, [seg], [type], max_workers, chunksize, columns, False, output, engine)
 
-        # aggregating the output if applicable, and returning the resulting dataframe
 
-        print("Finalizing the output ...")
 
-        if geography == "B":
-            return df
-        else:
-            output_values = ['C000', 'CA01', 'CA02', 'CA03', 'CE01', 'CE02', 'CE03', 'CNS01', 'CNS02', 'CNS03', 'CNS04', 'CNS05', 'CNS06', 'CNS07', 'CNS08', 'CNS09', 'CNS10', 'CNS11', 'CNS12', 'CNS13', 'CNS14', 'CNS15', 'CNS16', 'CNS17', 'CNS18', 'CNS19', 'CNS20', 'CR01', 'CR02', 'CR03', 'CR04', 'CR05', 'CR07', 'CT01', 'CT02', 'CD01', 'CD02', 'CD03', 'CD04', 'CS01', 'CS02']
-            df = df.groupby(["w_geoid_" + geography])[output_values].sum().reset_index()
-            return df
-        print("Finished !!!")
 
 
+    def wac_panel(locations, years, geography = "B", segs = ["S000"], types = ["JT00"], max_workers = 4, chunksize = None, columns = None, output = "pandas", engine = "pandas"):
+
+        """
+        Downloads workplace characteristic (WAC) data for several years, segments, and job types into a single
+        long-form pandas dataframe, with "year", "seg", and "type" columns identifying each row
+
+        All the files are planned up front and downloaded concurrently, and the input locations are only processed once
+
+        Parameters
+        ----------
+        locations | List of workplace locations to download data for, where locations are strings of GEOIDs. Must be specified
+
+        years : list of int or str representing the years to download data for, e.g. range(2002, 2018)
+
+        geography : The geographic scale in which to aggregate data to, e.g. "B", "BG", "CT", "C", "S", or "P". See dl_lodes.wac
+
+        segs : list of segments of the workforce, e.g. ["S000", "SE01", "SE02", "SE03"]. Default is all workers, ["S000"]
 
+        types : list of job types, e.g. ["JT00", "JT01"]. Default is all jobs, ["JT00"]
 
+        max_workers : maximum number of files to download and read at the same time. Default is 4
 
-    def rac(locations, year = 2016, geography = "B", seg = "S000", type = "JT00"):
+        chunksize : if set, each file is read in chunks of this many rows. Default is None, reading each file at once
+
+        columns : list of job count columns to download and return. Default is None, returning all job count columns
+
+        output : "pandas" for a dataframe, or "arrow" for a pyarrow table. See dl_lodes.wac
+
+        engine : "pandas" or "pyarrow", the CSV parser used to read each file. See dl_lodes.wac
 
         """
-        Downloads residential characteristic (RAC) data into a pandas dataframe
+
+        return dl_lodes._characteristics("wac", locations, years, geography, segs, types, max_workers, chunksize, columns, True, output, engine)
+
+
+
+
+
+    def rac_panel(locations, years, geography = "B", segs = ["S000"], types = ["JT00"], max_workers = 4, chunksize = None, columns = None, output = "pandas", engine = "pandas"):
+
+        """
+        Downloads residential characteristic (RAC) data for several years, segments, and job types into a single
+        long-form pandas dataframe, with "year", "seg", and "type" columns identifying each row
+
+        All the files are planned up front and downloaded concurrently, and the input locations are only processed once
 
         Parameters
         ----------
         locations | List of home locations to download data for, where locations are strings of GEOIDs. Must be specified
 
-        year : int or str representing the year to download data for
+        years : list of int or str representing the years to download data for, e.g. range(2002, 2018)
 
-        geography : The geographic scale in which to aggregate data to. The options are as follows:
-        "B"  | blocks
-        "BG" | block groups
-        "CT" | census tracts
-        "P"  | places
-        "CS" | county subdivision
-        "C"  | counties
-        "S"  | states
-        The default are blocks, which are how the raw data is provided, which thus does not require aggregation
+        geography : The geographic scale in which to aggregate data to, e.g. "B", "BG", "CT", "C", "S", or "P". See dl_lodes.rac
 
-        seg : Segment of the workforce, can have the values of “S000”, “SA01”, “SA02”, “SA03”, “SE01”, “SE02”, “SE03”, “SI01”, “SI02”, or “SI03”. Default is all workers. Please see https://lehd.ces.census.gov/data/lodes/LODES7/LODESTechDoc7.4.pdf for detail on the subset workforce segments
+        segs : list of segments of the workforce, e.g. ["S000", "SE01", "SE02", "SE03"]. Default is all workers, ["S000"]
 
-        type : From the LEHD documentation, this can have a value of "JT00" for All Jobs, "JT01" for Primary Jobs, "JT02" for All Private Jobs, "JT03" for Private Primary Jobs, "JT04" for All Federal Jobs, or "JT05" for Federal Primary Jobs.
+        types : list of job types, e.g. ["JT00", "JT01"]. Default is all jobs, ["JT00"]
+
+        max_workers : maximum number of files to download and read at the same time. Default is 4
+
+        chunksize : if set, each file is read in chunks of this many rows. Default is None, reading each file at once
+
+        columns : list of job count columns to download and return. Default is None, returning all job count columns
+
+        output : "pandas" for a dataframe, or "arrow" for a pyarrow table. See dl_lodes.wac
+
+        engine : "pandas" or "pyarrow", the CSV parser used to read each file. See dl_lodes.wac
+
+        """
+
+        return dl_lodes._characteristics("rac", locations, years, geography, segs, types, max_workers, chunksize, columns, True, output, engine)
 
+
+
+
+
+    def _characteristics(kind, locations, years, geography, segs, types, max_workers, chunksize, columns, panel, output = "pandas", engine = "pandas"):
+
+        """
+        downloads and summarizes WAC ("wac") or RAC ("rac") data for lists of years, segs, and types,
+        see dl_lodes.wac and dl_lodes.wac_panel
         """
 
         # initial parameter checking
 
-        year = int(year)
-        if year < 2002:
-            raise Exception('LEHD OD data is unavailable prior to 2002')
-        if year > 2017:
-            raise Exception('LEHD OD data is unavailable after to 2017')
+        years = dl_lodes._check_params(years, geography, types, chunksize, engine)
 
-        if geography not in ["B","BG","CT","C","S"]:
+        dl_lodes._check_locations(kind, locations)
 
-            raise Exception('Please make sure the input parameter @geography is one of ["B","BG","CT","C","S"]')
+        for seg in segs:
+            if seg not in ["S000", "SA01", "SA02", "SA03", "SE01", "SE02", "SE03", "SI01", "SI02"]:
 
-        if type not in ["JT00","JT01","JT02","JT03","JT04","JT05"]:
+                raise Exception('Please make sure the input parameter @seg is one of ["S000", "SA01", "SA02", "SA03", "SE01", "SE02", "SE03", "SI01", "SI02"]')
 
-            raise Exception('Please make sure the input parameter @type is one of ["JT00","JT01","JT02","JT03","JT04","JT05"]')
+        if output not in ["pandas", "arrow"]:
 
-        if seg not in ["S000", "SA01", "SA02", "SA03", "SE01", "SE02", "SE03", "SI01", "SI02"]:
+            raise Exception('Please make sure the input parameter @output is one of ["pandas","arrow"]')
 
-            raise Exception('Please make sure the input parameter @seg is one of ["S000", "SA01", "SA02", "SA03", "SE01", "SE02", "SE03", "SI01", "SI02"]')
+        # workplace blocks for WAC, and home blocks for RAC
+        side = "w" if kind == "wac" else "h"
+
+        output_values, usecols = dl_lodes._projection(kind, geography, columns)
 
 
         # getting list of states to download data for
 
-        states_for_dl = []
-        if locations is not None:
-            locations = pd.DataFrame(locations)
-            locations.columns = ["o"]
-            locations["gtype"] = locations["o"].apply(lehd.utils.infer_geog_input)
-            states_for_dl = lehd.utils.get_state_alpha(locations, "o")
-        else:
-            raise Exception('Please input a list of locations to download data for')
-        states_for_dl = list(set(list(states_for_dl)))
+        locations = pd.DataFrame(locations)
+        locations.columns = ["o"]
+        locations["gtype"] = lehd.utils.infer_geog_inputs(locations["o"])
+        states_for_dl = sorted(set(lehd.utils.get_state_alpha(locations, "o")))
 
+        # matching of block codes to the input locations, and the ranges of block codes that cover them
+        in_locations, ranges = lehd.utils.locator(locations["o"])
+
+        summary = lehd.summary(kind)
 
-        # setting up the URLs needed for download, then download and put into a single pandas dataframe
 
-        url_base = "https://lehd.ces.census.gov/data/lodes/LODES7/"
-        dfl = []
-        for state in states_for_dl:
-            file_name = state.lower() + "_rac_" + seg + "_" + type + "_" + str(year) + ".csv.gz"
-            url = url_base + state.lower() + "/rac/" + file_name
-            print("Trying to download ", file_name, " from ", url, " ......")
-            df = pd.read_csv(urllib.request.urlopen(url), compression = "gzip")
-            dfl.append(df)
-        df = pd.concat(dfl)
+        # cleaning, subsetting, and partially aggregating each file (or chunk of a file) as it is read
 
-        # cleaning and adding leading 0s to block ids
-        df["h_geoid_B"] = df["h_geocode"].astype(str)
-        df["h_geoid_B"] = df["h_geoid_B"].str.zfill(15)
-        del df["h_geocode"]
+        def process(df):
 
-        # add column for aggregation, if applicable
-        if geography != "B":
-            df["h_geoid_" + geography] = df["h_geoid_B"].apply(lehd.utils.get_geoid, args = (geography,))
+            # substting the data based on the input locations, using integer block codes
+            with summary.stage("filter", rows_in = len(df)) as record:
+                codes = df[side + "_geocode"].to_numpy(dtype = np.int64)
+                mask = in_locations(codes)
+                df = df[mask]
+                record["rows_out"] = len(df)
 
+            # aggregating by the integer codes of the output geography, if applicable
+            if geography != "B":
+                with summary.stage("geography", rows_in = len(df)):
+                    keys = lehd.utils.get_geoids(codes[mask], geography)
+                with summary.stage("aggregate", rows_in = len(df)) as record:
+                    df = lehd.utils.sum_by([keys], df, output_values)
+                    record["rows_out"] = len(df)
 
-        # substting the data based on the input locations
+            return df
+
+
+        # setting up the URLs needed for download, then download and put into a single pandas dataframe
 
-        print("Subsetting the data based on the input locations list ...")
-        dfm = []
-        for geoid in list(locations["gtype"].unique()):
-            if geoid != "B" and geoid != geography:
-                df["h_geoid_" + geoid] = df["h_geoid_B"].apply(lehd.utils.get_geoid, args = (geoid,))
-            list_unique = list(locations["o"][locations["gtype"] == geoid].unique())
-            dfs = df[df["h_geoid_" + geoid].isin(list_unique)]["h_geoid_B"].unique()
-            dfm = dfm + list(dfs)
-        df = df.query("h_geoid_B in @dfm")
+        files, file_labels, labels = dl_lodes._characteristics_files(kind, states_for_dl, years, segs, types)
+        lehd.metrics.logger.info("Subsetting the data based on the input locations list ...")
+        filter = lehd.store.range_filter(side + "_geocode", *ranges) if lehd.store.enabled else None
+        cube_level = geography if lehd.cube.enabled and lehd.cube.usable(locations["o"], geography) else None
+        dfl = dl_lodes._read_files(files, max_workers, process, chunksize, dl_lodes.schema[kind], usecols, filter, cube_level, summary, engine)
 
 
         # aggregating the output if applicable, and returning the resulting dataframe
 
-        print("Finalizing the output ...")
+        def finalize(df):
+            if geography == "B":
+                df = dl_lodes._widen(df)
+                if output == "arrow":
+                    return dl_lodes._block_table(df, [(side, locations)])
+                return dl_lodes._block_geoids(df, side, locations)
+            else:
+                df = df.groupby(level = 0).sum().astype("int64")
+                if output == "arrow":
+                    return dl_lodes._arrow_table([(side + "_geoid_" + geography, df.index, geography)], df, output_values)
+                df.insert(0, side + "_geoid_" + geography, lehd.utils.format_geoids(df.index, geography))
+                return df.reset_index(drop = True)
 
-        if geography == "B":
-            return df
-        else:
-            output_values = ['C000', 'CA01', 'CA02', 'CA03', 'CE01', 'CE02', 'CE03', 'CNS01', 'CNS02', 'CNS03', 'CNS04', 'CNS05', 'CNS06', 'CNS07', 'CNS08', 'CNS09', 'CNS10', 'CNS11', 'CNS12', 'CNS13', 'CNS14', 'CNS15', 'CNS16', 'CNS17', 'CNS18', 'CNS19', 'CNS20', 'CR01', 'CR02', 'CR03', 'CR04', 'CR05', 'CR07', 'CT01', 'CT02', 'CD01', 'CD02', 'CD03', 'CD04', 'CS01', 'CS02']
-            df = df.groupby(["h_geoid_" + geography])[output_values].sum().reset_index()
-            return df
-        print("Finished !!!")
+        return summary.attach(dl_lodes._combine(dfl, file_labels, labels, ["year", "seg", "type"] if panel else None, finalize, summary))
 
 
 
 
 
-    def od(year = 2016, geography = "B", type = "JT00", origins = None, destinations = None, constrained = "no"):
+    def od(year = 2016, geography = "B", type = "JT00", origins = None, destinations = None, constrained = "no", max_workers = 4, chunksize = None, columns = None, output = "pandas", engine = "pandas"):
 
         """
         Downloads origin-destination (OD) commuting flow data into a pandas dataframe
@@ -595,6 +935,9 @@ class dl_lodes:
         "CS" | county subdivision
         "C"  | counties
         "S"  | states
+        "CBSA" | core based statistical areas
+        "ZCTA" | ZIP code tabulation areas
+        places, county subdivisions, CBSAs, and ZCTAs are aggregated with the LODES geography crosswalk (see lehd.xwalk)
         the default are blocks, which are how the raw data is provided, which thus does not require aggregation
 
         type : from the LEHD docementation, this can have a value of "JT00" for All Jobs, "JT01" for Primary Jobs, "JT02" for All Private Jobs, "JT03" for Private Primary Jobs, "JT04" for All Federal Jobs, or "JT05" for Federal Primary Jobs.
@@ -609,32 +952,89 @@ class dl_lodes:
         "yes"  | download only the data from the input origins, to the input destinations,
         "no"   | download all data without OD constraints
 
+        max_workers : maximum number of state files to download and read at the same time. Default is 4
+
+        chunksize : if set, each state file is read in chunks of this many rows, which are subset (and aggregated, if applicable) as they are read, so that memory use is bounded by the chunk size rather than the size of the state file. Default is None, reading each file at once
+
+        columns : list of job count columns to download and return, e.g. ["C000", "CE01"]. Columns not listed are skipped while reading. Default is None, returning all job count columns
+
+        output : the format of the output
+        "pandas" | a long pandas dataframe with one row per origin-destination pair
+        "sparse" | a lehd.od_matrix of scipy.sparse matrices, one per job count column, over a shared index of origin and destination GEOIDs, with helpers for row/column totals, net flows, intrazonal shares, and matrix balancing
+        "arrow"  | a pyarrow table, with dictionary-encoded GEOID columns, and the metrics of the call in its schema metadata (requires pyarrow)
+
+        engine : "pandas" or "pyarrow", the CSV parser used to read each file. See dl_lodes.wac
+
         """
 
+        return dl_lodes._od([year], geography, [type], origins, destinations, constrained, max_workers, chunksize, columns, False, output, engine)
 
-        # verifying the input parameters
 
-        year = int(year)
-        if year < 2002:
-            raise Exception('LEHD OD data is unavailable prior to 2002')
-        if year > 2017:
-            raise Exception('LEHD OD data is unavailable after to 2017')
 
-        if constrained not in ["yes","no"]:
 
-            raise Exception('Please make sure the input parameter @constrained is one of ["yes","no"]')
 
-        if geography not in ["B","BG","CT","C","S"]:
+    def od_panel(years, geography = "B", types = ["JT00"], origins = None, destinations = None, constrained = "no", max_workers = 4, chunksize = None, columns = None, output = "pandas", engine = "pandas"):
 
-            raise Exception('Please make sure the input parameter @geography is one of ["B","BG","CT","C","S"]')
+        """
+        Downloads origin-destination (OD) commuting flow data for several years and job types into a single
+        long-form pandas dataframe, with "year" and "type" columns identifying each row
 
-        if type not in ["JT00","JT01","JT02","JT03","JT04","JT05"]:
+        All the files are planned up front and downloaded concurrently, and the input origins and destinations are only processed once
 
-            raise Exception('Please make sure the input parameter @type is one of ["JT00","JT01","JT02","JT03","JT04","JT05"]')
+        Parameters
+        ----------
+        years : list of int or str representing the years to download data for, e.g. range(2002, 2018)
 
-        if origins is None and destinations is None:
+        geography : the geographic scale in which to aggregate data to, e.g. "B", "BG", "CT", "C", "S", or "P". See dl_lodes.od
 
-            raise Exception("Please input a list of origins and/or a list of destinations")
+        types : list of job types, e.g. ["JT00", "JT01"]. Default is all jobs, ["JT00"]
+
+        origins | list of origins to download data for, where origins are strings of GEOIDs. Must be specified if destinations is not specified
+
+        destinations | list of destinations to download data for, where destinations are strings of GEOIDs. Must be specified if origins is not specified
+
+        constrained : whether or not to only download data within a state, "yes" or "no". See dl_lodes.od
+
+        max_workers : maximum number of files to download and read at the same time. Default is 4
+
+        chunksize : if set, each file is read in chunks of this many rows. Default is None, reading each file at once
+
+        columns : list of job count columns to download and return. Default is None, returning all job count columns
+
+        output : "pandas" for a dataframe, or "arrow" for a pyarrow table. See dl_lodes.wac
+
+        engine : "pandas" or "pyarrow", the CSV parser used to read each file. See dl_lodes.wac
+
+        """
+
+        if output not in ["pandas", "arrow"]:
+
+            raise Exception('Please make sure the input parameter @output is one of ["pandas","arrow"]')
+
+        return dl_lodes._od(years, geography, types, origins, destinations, constrained, max_workers, chunksize, columns, True, output, engine)
+
+
+
+
+
+    def _od(years, geography, types, origins, destinations, constrained, max_workers, chunksize, columns, panel, output, engine = "pandas"):
+
+        """
+        downloads and summarizes OD data for lists of years and types, see dl_lodes.od and dl_lodes.od_panel
+        """
+
+        # verifying the input parameters
+
+        years = dl_lodes._check_params(years, geography, types, chunksize, engine)
+
+        dl_lodes._check_locations("od", origins = origins, destinations = destinations, constrained = constrained)
+
+        if output not in ["pandas", "sparse", "arrow"]:
+
+            raise Exception('Please make sure the input parameter @output is one of ["pandas","sparse","arrow"]')
+
+        # sparse matrices only hold the job counts, so they are read the same way as aggregated data
+        output_values, usecols = dl_lodes._projection("od", "C" if output == "sparse" else geography, columns)
 
 
         # creating dataframes for the origins and destinations, and grabbing the list of state alpha codes needed for downloading
@@ -644,7 +1044,7 @@ class dl_lodes:
 
             origins = pd.DataFrame(origins)
             origins.columns = ["o"]
-            origins["gtype"] = origins["o"].apply(lehd.utils.infer_geog_input)
+            origins["gtype"] = lehd.utils.infer_geog_inputs(origins["o"])
             origin_states = lehd.utils.get_state_alpha(origins, "o")
 
         destination_states = []
@@ -652,92 +1052,244 @@ class dl_lodes:
 
             destinations = pd.DataFrame(destinations)
             destinations.columns = ["d"]
-            destinations["gtype"] = destinations["d"].apply(lehd.utils.infer_geog_input)
+            destinations["gtype"] = lehd.utils.infer_geog_inputs(destinations["d"])
             destination_states = lehd.utils.get_state_alpha(destinations, "d")
 
         states_for_dl = list(origin_states) + list(destination_states)
-        states_for_dl = list(set(states_for_dl))
+        states_for_dl = sorted(set(states_for_dl))
+
+        # matching of block codes to the input origins and destinations, and the ranges of block codes that cover them
+        if origins is not None:
+            in_origins, origin_ranges = lehd.utils.locator(origins["o"])
+        if destinations is not None:
+            in_destinations, destination_ranges = lehd.utils.locator(destinations["d"])
+
+        summary = lehd.summary("od")
+
+
+        # cleaning, subsetting, and partially aggregating each file (or chunk of a file) as it is read
+
+        def process(df):
+
+            # subsetting, based on the origin and/or destination inputs
+            with summary.stage("filter", rows_in = len(df)) as record:
+                h_codes = df["h_geocode"].to_numpy(dtype = np.int64)
+                w_codes = df["w_geocode"].to_numpy(dtype = np.int64)
+                if destinations is None:
+                    mask = in_origins(h_codes)
+                elif origins is None:
+                    mask = in_destinations(w_codes)
+                else:
+                    mask_o = in_origins(h_codes)
+                    mask_d = in_destinations(w_codes)
+                    if constrained == "no":
+                        mask = mask_d | mask_o
+                    if constrained == "yes":
+                        mask = mask_d & mask_o
+                df = df[mask]
+                record["rows_out"] = len(df)
+
+            if output == "sparse" or geography != "B":
+                with summary.stage("geography", rows_in = len(df)):
+                    h_keys = lehd.utils.get_geoids(h_codes[mask], geography)
+                    w_keys = lehd.utils.get_geoids(w_codes[mask], geography)
+
+            # keeping only the integer codes of the output geography and job counts, for building sparse matrices
+            if output == "sparse":
+                valid = (h_keys >= 0) & (w_keys >= 0)
+                df = df[output_values][valid].reset_index(drop = True)
+                df.insert(0, "h_code", h_keys[valid])
+                df.insert(1, "w_code", w_keys[valid])
+
+            # aggregating by the integer codes of the output geography, if applicable
+            elif geography != "B":
+                with summary.stage("aggregate", rows_in = len(df)) as record:
+                    df = lehd.utils.sum_by([h_keys, w_keys], df, output_values)
+                    record["rows_out"] = len(df)
 
+            return df
 
 
-        # setting up the URLs needed for download, then download and put into a single pandas dataframe
+        # setting up the URLs needed for download, skipping file parts that cannot contain matching rows, then download and put into a single pandas dataframe
 
-        url_base = "https://lehd.ces.census.gov/data/lodes/LODES7/"
-        dfl = []
-        for state in states_for_dl:
-            for part in ["aux", "main"]:
-                file_name = state.lower() + "_od_" +  part + "_" + type + "_" + str(year) + ".csv.gz"
-                url = url_base + state.lower() + "/od/" + file_name
-                print("Trying to download ", file_name, " from ", url, " ......")
-                df = pd.read_csv(urllib.request.urlopen(url), compression = "gzip")
-                dfl.append(df)
+        files, file_labels, labels = dl_lodes._od_files(origin_states, destination_states, constrained, years, types)
+        lehd.metrics.logger.info("Subsetting the data based on the input origin and destination lists ...")
+        filter = None
+        if lehd.store.enabled:
+            if destinations is None:
+                filter = lehd.store.range_filter("h_geocode", *origin_ranges)
+            elif origins is None:
+                filter = lehd.store.range_filter("w_geocode", *destination_ranges)
+            elif constrained == "no":
+                filter = lehd.store.range_filter("w_geocode", *destination_ranges) | lehd.store.range_filter("h_geocode", *origin_ranges)
+            else:
+                filter = lehd.store.range_filter("w_geocode", *destination_ranges) & lehd.store.range_filter("h_geocode", *origin_ranges)
+        cube_level = None
+        if lehd.cube.enabled and output != "sparse":
+            locations = (list(origins["o"]) if origins is not None else []) + (list(destinations["d"]) if destinations is not None else [])
+            if lehd.cube.usable(locations, geography):
+                cube_level = geography
+        dfl = dl_lodes._read_files(files, max_workers, process, chunksize, dl_lodes.schema["od"], usecols, filter, cube_level, summary, engine)
 
-        print("Concatinating data for the states in ", states_for_dl)
-        df = pd.concat(dfl)
+        lehd.metrics.logger.info("Concatinating data for the states in %s", states_for_dl)
 
 
+        # aggregating by geography, and returning a dataframe
 
-        # updating the GEOID to be strings and have leading 0s where appropriate
+        def finalize(df):
+            if output == "sparse":
+                values = dict((c, df[c].to_numpy()) for c in output_values)
+                return lehd.od_matrix.from_codes(df["h_code"].to_numpy(), df["w_code"].to_numpy(), values, geography)
+            elif geography == "B":
+                df = dl_lodes._widen(df)
+                if output == "arrow":
+                    return dl_lodes._block_table(df, [("h", origins), ("w", destinations)])
+                df = dl_lodes._block_geoids(df, "h", origins)
+                df = dl_lodes._block_geoids(df, "w", destinations)
+                return df
+            else:
+                df = df.groupby(level = [0, 1]).sum().astype("int64")
+                if output == "arrow":
+                    return dl_lodes._arrow_table([("h_geoid_" + geography, df.index.get_level_values(0), geography), ("w_geoid_" + geography, df.index.get_level_values(1), geography)], df, output_values)
+                df.insert(0, "h_geoid_" + geography, lehd.utils.format_geoids(df.index.get_level_values(0), geography))
+                df.insert(1, "w_geoid_" + geography, lehd.utils.format_geoids(df.index.get_level_values(1), geography))
+                return df.reset_index(drop = True)
 
-        df["h_geoid_B"] = df["h_geocode"].astype(str)
-        df["h_geoid_B"] = df["h_geoid_B"].str.zfill(15)
-        del df["h_geocode"]
-        df["w_geoid_B"] = df["w_geocode"].astype(str)
-        df["w_geoid_B"] = df["w_geoid_B"].str.zfill(15)
-        del df["w_geocode"]
+        return summary.attach(dl_lodes._combine(dfl, file_labels, labels, ["year", "type"] if panel else None, finalize, summary))
 
 
 
-        # creating the geoid for the desired output geography
 
-        if geography != "B":
-            df["h_geoid_" + geography] = df["h_geoid_B"].apply(lehd.utils.get_geoid, args = (geography,))
-            df["w_geoid_" + geography] = df["w_geoid_B"].apply(lehd.utils.get_geoid, args = (geography,))
 
+    def od_national(year = 2016, geography = "C", type = "JT00", states = None, processes = None, chunksize = 1000000, columns = None, output = "pandas", engine = "pandas"):
 
-        # subsetting data based on inputs
+        """
+        Downloads and aggregates origin-destination (OD) commuting flow data for the whole country (or a list of states)
 
-        # generating subset if origin data are input
-        if origins is not None:
-            print("Subsetting the data based on the input origin input list ...")
-            dfm_o = []
-            for geoid in list(origins["gtype"].unique()):
-                if geoid != "B" and geoid != geography:
-                    df["h_geoid_" + geoid] = df["h_geoid_B"].apply(lehd.utils.get_geoid, args = (geoid,))
-                list_unique = list(origins["o"][origins["gtype"] == geoid].unique())
-                dfs = df[df["h_geoid_" + geoid].isin(list_unique)]["h_geoid_B"].unique()
-                dfm_o = dfm_o + list(dfs)
-
-        # generating subset if destination geoid are input
-        if destinations is not None:
-            print("Subsetting the data based on the input destination input list ...")
-            dfm_d = []
-            for geoid in list(destinations["gtype"].unique()):
-                if geoid != "B" and geoid != geography:
-                    df["w_geoid_" + geoid] = df["w_geoid_B"].apply(lehd.utils.get_geoid, args = (geoid,))
-                list_unique = list(destinations["d"][destinations["gtype"] == geoid].unique())
-                dfs = df[df["w_geoid_" + geoid].isin(list_unique)]["w_geoid_B"].unique()
-                dfm_d = dfm_d + list(dfs)
-
-        # subsetting, based on the inputs
-        if destinations is None:
-            df = df.query("h_geoid_B in @dfm_o")
-        elif origins is None:
-            df = df.query("w_geoid_B in @dfm_d")
-        else:
-            if constrained == "no":
-                df = df.query("w_geoid_B in @dfm_d or h_geoid_B in @dfm_o")
-            if constrained == "yes":
-                df = df.query("w_geoid_B in @dfm_d and h_geoid_B in @dfm_o")
+        Each state file is processed independently in a separate worker process, read in chunks, and reduced to the output geography,
+        and the partial aggregates are then merged, so that peak memory is bounded by one chunk per worker plus the result
+
+        Parameters
+        ----------
+        year : int or str reperesenting the year to download data for
 
+        geography : the geographic scale in which to aggregate data to, any of the levels of dl_lodes.od except blocks. Default is counties
 
+        type : the job type, e.g. "JT00" for All Jobs. See dl_lodes.od
 
-        # aggregating by geography, and returning a dataframe
+        states : list of state alpha codes (e.g. ["RI", "CT"]) to aggregate flows for, by workplace state. Default is None, all states
+
+        processes : maximum number of worker processes. Default is None, the number of processors on the machine
+
+        chunksize : number of rows read at a time by each worker. Default is 1000000
+
+        columns : list of job count columns to return. Default is None, returning all job count columns
+
+        output : "pandas" for a long dataframe, "sparse" for a lehd.od_matrix, or "arrow" for a pyarrow table. See dl_lodes.od
+
+        engine : "pandas" or "pyarrow", the CSV parser used by the workers. See dl_lodes.wac
+
+        """
+
+        # verifying the input parameters
+
+        year = dl_lodes._check_params([year], geography, [type], chunksize, engine)[0]
 
-        print("Finalizing the output ...")
         if geography == "B":
-            return df
-        else:
-            df = df.groupby(["h_geoid_" + geography,"w_geoid_" + geography])[["S000","SA01","SA02","SA03","SE01","SE02","SE03","SI01","SI02","SI03"]].sum().reset_index()
-            return df
-        print("Finished !!!")
+
+            raise Exception('Please make sure the input parameter @geography is not "B", national block level flows are not aggregated')
+
+        if output not in ["pandas", "sparse", "arrow"]:
+
+            raise Exception('Please make sure the input parameter @output is one of ["pandas","sparse","arrow"]')
+
+        output_values, usecols = dl_lodes._projection("od", geography, columns)
+
+        states = dl_lodes.states if states is None else sorted(set(state.upper() for state in states))
+
+
+        # both the main (within state) and aux (from out of state) files, which together hold each flow once, by workplace state
+
+        files = []
+        for state in states:
+            for part in ["aux", "main"]:
+                files.append(dl_lodes._file(state, "od", part, type, year))
+
+        # the crosswalk arrays are built here before starting the workers, rather than by several workers at once
+        if geography in lehd.xwalk.levels:
+            for state in states:
+                lehd.xwalk.arrays(state, geography)
+
+        # all cache settings, and the locations of the files and crosswalk arrays, are passed to the workers, since
+        # they may not inherit them from this process (e.g. with spawn)
+        settings = [(lehd.cache, name, value) for name, value in lehd.cache.settings().items()]
+        settings += [(dl_lodes, "url_base", dl_lodes.url_base), (lehd.xwalk, "directory", lehd.xwalk.directory)]
+
+
+        # merging the partial aggregates as each worker finishes
+
+        summary = lehd.summary("od_national")
+
+        df = None
+        with concurrent.futures.ProcessPoolExecutor(max_workers = processes) as executor:
+            futures = [executor.submit(dl_lodes._national_worker, file_name, url, geography, output_values, usecols, int(chunksize), settings, engine) for file_name, url in files]
+            for future in concurrent.futures.as_completed(futures):
+                part, worker_summary = future.result()
+                summary.merge(worker_summary)
+                if part is not None:
+                    with summary.stage("combine", rows_in = len(part)) as record:
+                        df = part if df is None else pd.concat([df, part]).groupby(level = [0, 1]).sum()
+                        record["rows_out"] = len(df)
+
+        if df is None:
+            df = pd.DataFrame(0, columns = output_values, index = pd.MultiIndex.from_arrays([np.array([], dtype = np.int64)] * 2))
+
+
+        lehd.metrics.logger.info("Finalizing the output ...")
+
+        with summary.stage("finalize", rows_in = len(df)):
+            df = df.astype("int64")
+            if output == "sparse":
+                values = dict((c, df[c].to_numpy()) for c in output_values)
+                df = lehd.od_matrix.from_codes(df.index.get_level_values(0).to_numpy(), df.index.get_level_values(1).to_numpy(), values, geography)
+            elif output == "arrow":
+                df = dl_lodes._arrow_table([("h_geoid_" + geography, df.index.get_level_values(0), geography), ("w_geoid_" + geography, df.index.get_level_values(1), geography)], df, output_values)
+            else:
+                df.insert(0, "h_geoid_" + geography, lehd.utils.format_geoids(df.index.get_level_values(0), geography))
+                df.insert(1, "w_geoid_" + geography, lehd.utils.format_geoids(df.index.get_level_values(1), geography))
+                df = df.reset_index(drop = True)
+
+        return summary.attach(df)
+
+
+    def _national_worker(file_name, url, geography, output_values, usecols, chunksize, settings, engine = "pandas"):
+
+        """
+        reads one OD file in chunks in a worker process, and returns its flows aggregated to integer geography codes,
+        along with the lehd.summary of the worker
+        """
+
+        for target, name, value in settings:
+            setattr(target, name, value)
+
+        lehd.metrics.logger.info("Trying to download %s from %s", file_name, url)
+
+        summary = lehd.summary("od_national")
+        summary.count("files", 1)
+
+        df = None
+        try:
+            with gzip.open(dl_lodes._fetch(file_name, url, summary)) as f, contextlib.closing(dl_lodes._parse_chunks(f, dl_lodes.schema["od"], usecols, chunksize, engine)) as chunks:
+                for chunk in summary.iterate("parse", chunks, file_name):
+                    with summary.stage("geography", rows_in = len(chunk)):
+                        keys = [lehd.utils.get_geoids(chunk["h_geocode"].to_numpy(), geography), lehd.utils.get_geoids(chunk["w_geocode"].to_numpy(), geography)]
+                    with summary.stage("aggregate", rows_in = len(chunk)) as record:
+                        part = lehd.utils.sum_by(keys, chunk, output_values)
+                        df = part if df is None else pd.concat([df, part]).groupby(level = [0, 1]).sum()
+                        record["rows_out"] = len(part)
+                summary.count("bytes_decompressed", f.tell())
+        except Exception as e:
+            raise Exception('Failed to download or read ' + file_name + ' from ' + url + ' : ' + str(e)) from e
+
+        summary.measure()
+        return df, summary
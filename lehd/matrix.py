@@ -0,0 +1,169 @@
+import lehd
+import numpy as np
+import pandas as pd
+
+
+class od_matrix:
+
+    """
+    Sparse origin-destination matrices, returned by dl_lodes.od(output = "sparse").
+
+    Rows are origins (home locations) and columns are destinations (workplaces), over a shared, sorted index of
+    zones (@geoids), so that the matrices are square and intrazonal flows are on the diagonal.
+
+    matrices : dict of scipy.sparse CSR matrices, one per job count column, e.g. matrices["S000"]
+
+    geoids : array of the GEOID strings of the zones, in row / column order
+
+    geography : geography type of the zones, e.g. "CT"
+
+    metrics : the metrics of the call that built the matrices, as a dict, see lehd.summary.to_dict
+
+    Requires scipy.
+    """
+
+    def __init__(self, matrices, geoids, geography):
+
+        self.matrices = matrices
+        self.geoids = geoids
+        self.geography = geography
+        self.metrics = None
+
+
+    def from_codes(h_codes, w_codes, values, geography):
+
+        """
+        builds an od_matrix directly from arrays of integer origin and destination codes, and a dict of arrays
+        of job counts per column, summing duplicate origin-destination pairs
+        """
+
+        try:
+            import scipy.sparse
+        except ImportError:
+            raise Exception('The sparse output requires scipy, which can be installed with "pip install lehd[sparse]"')
+
+        codes = np.unique(np.concatenate([h_codes, w_codes]))
+        rows = np.searchsorted(codes, h_codes)
+        cols = np.searchsorted(codes, w_codes)
+
+        matrices = {}
+        for column, data in values.items():
+            matrices[column] = scipy.sparse.coo_matrix(
+                (np.asarray(data, dtype = np.int64), (rows, cols)),
+                shape = (len(codes), len(codes))).tocsr()
+
+        return od_matrix(matrices, lehd.utils.format_geoids(codes, geography), geography)
+
+
+    @property
+    def origins(self):
+        return self.geoids
+
+
+    @property
+    def destinations(self):
+        return self.geoids
+
+
+    def __getitem__(self, column):
+        return self.matrices[column]
+
+
+    def __repr__(self):
+        return "od_matrix(geography = " + repr(self.geography) + ", zones = " + str(len(self.geoids)) + ", columns = " + str(list(self.matrices.keys())) + ")"
+
+
+    def row_totals(self, column = "S000"):
+
+        """
+        returns the total flows leaving each origin, e.g. total workers living in each zone
+        """
+
+        return pd.Series(np.asarray(self.matrices[column].sum(axis = 1)).ravel(), index = self.geoids)
+
+
+    def column_totals(self, column = "S000"):
+
+        """
+        returns the total flows arriving at each destination, e.g. total jobs in each zone
+        """
+
+        return pd.Series(np.asarray(self.matrices[column].sum(axis = 0)).ravel(), index = self.geoids)
+
+
+    def intrazonal(self, column = "S000"):
+
+        """
+        returns the flows that start and end in the same zone
+        """
+
+        return pd.Series(self.matrices[column].diagonal(), index = self.geoids)
+
+
+    def intrazonal_share(self, column = "S000"):
+
+        """
+        returns the share of the flows leaving each origin that stay within the same zone
+        """
+
+        return self.intrazonal(column) / self.row_totals(column)
+
+
+    def net_flows(self, column = "S000"):
+
+        """
+        returns the flows arriving at each zone minus the flows leaving it, e.g. net commuting inflow
+        """
+
+        return self.column_totals(column) - self.row_totals(column)
+
+
+    def to_frame(self, column = None):
+
+        """
+        returns the non-zero flows as a long pandas dataframe, like the default output of dl_lodes.od
+        """
+
+        columns = list(self.matrices.keys()) if column is None else [column]
+
+        coo = self.matrices[columns[0]].tocoo()
+        df = pd.DataFrame({
+            "h_geoid_" + self.geography: self.geoids[coo.row],
+            "w_geoid_" + self.geography: self.geoids[coo.col]
+        })
+        for c in columns:
+            df[c] = np.asarray(self.matrices[c][coo.row, coo.col]).ravel()
+        return df
+
+
+    def balance(self, row_targets, column_targets, column = "S000", iterations = 100, tolerance = 1e-6):
+
+        """
+        scales a matrix to match target row (origin) and column (destination) totals, by iterative proportional fitting,
+        and returns the balanced matrix as a scipy.sparse CSR matrix of floats
+
+        row_targets, column_targets : arrays (or Series indexed by GEOID) of target totals for each zone
+        """
+
+        if isinstance(row_targets, pd.Series):
+            row_targets = row_targets.reindex(self.geoids).fillna(0).to_numpy()
+        if isinstance(column_targets, pd.Series):
+            column_targets = column_targets.reindex(self.geoids).fillna(0).to_numpy()
+
+        matrix = self.matrices[column].astype(np.float64)
+        row_targets = np.asarray(row_targets, dtype = np.float64)
+        column_targets = np.asarray(column_targets, dtype = np.float64)
+
+        for i in range(iterations):
+
+            rows = np.asarray(matrix.sum(axis = 1)).ravel()
+            matrix = matrix.multiply(np.divide(row_targets, rows, out = np.zeros_like(rows), where = rows > 0)[:, None]).tocsr()
+
+            cols = np.asarray(matrix.sum(axis = 0)).ravel()
+            matrix = matrix.multiply(np.divide(column_targets, cols, out = np.zeros_like(cols), where = cols > 0)[None, :]).tocsr()
+
+            rows = np.asarray(matrix.sum(axis = 1)).ravel()
+            if np.abs(rows - row_targets).max(initial = 0) <= tolerance * max(row_targets.max(initial = 0), 1):
+                break
+
+        return matrix
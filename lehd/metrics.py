@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+
+
+class metrics:
+
+    """
+    Instrumentation of dl_lodes and to_geo.
+
+    Each call records the time spent in each stage (download, parse, filter, geography, aggregate, combine, finalize,
+    and for to_geo, coordinates and geometry), the rows going in and out of each stage, the bytes downloaded and
+    decompressed, and the peak memory of the process during the call, into a lehd.summary whose totals are attached to its result
+    as a plain dict (see summary.to_dict), e.g. df.attrs["metrics"] for dataframes.
+
+    Progress messages and stage timings are written to the "lehd" logger (at the INFO and DEBUG levels), which
+    prints nothing unless logging is configured, e.g. with logging.basicConfig(level = logging.INFO).
+
+    callback : if set, a function called with a dict for every completed stage, and for the total of every call
+    (with "stage" set to "total"), e.g. to forward them to a metrics system. Default is None
+    """
+
+    callback = None
+    logger = logging.getLogger("lehd")
+
+    _lock = threading.Lock()
+
+
+    def emit(record):
+
+        """
+        passes a stage record to the logger and to the metrics callback, if any
+        """
+
+        metrics.logger.debug("%s", record)
+        if metrics.callback is not None:
+            metrics.callback(record)
+
+
+    def peak_memory():
+
+        """
+        returns the peak resident memory of this process in bytes, over its whole lifetime, or None where it is not
+        available (e.g. Windows)
+        """
+
+        try:
+            import resource
+        except ImportError:
+            return None
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+    def current_memory():
+
+        """
+        returns the current resident memory of this process in bytes, or None where it is not available (only Linux has it)
+        """
+
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+
+metrics.logger.addHandler(logging.NullHandler())
+
+
+class summary:
+
+    """
+    Timings and counts of a single dl_lodes or to_geo call, see lehd.metrics.
+
+    name : name of the call, e.g. "wac"
+
+    stages : dict of the totals of each stage, with its number of "calls", "seconds", "rows_in", and "rows_out"
+
+    counters : dict of other totals, "files", "bytes_downloaded", and "bytes_decompressed"
+
+    seconds : total time of the call
+
+    peak_memory : peak resident memory of the process in bytes during the call. This is the process's high-water
+    mark if it was raised during the call, and otherwise the largest resident memory measured at the end of each
+    stage, so it is a lower bound where memory is only measured by stage, and includes the memory of other calls
+    running at the same time in other threads. For od_national, it is the largest of this process and the workers
+
+    process_peak_memory : peak resident memory of the process in bytes over its whole lifetime, at the end of the call
+    """
+
+    def __init__(self, name):
+
+        self.name = name
+        self.stages = {}
+        self.counters = {"files": 0, "bytes_downloaded": 0, "bytes_decompressed": 0}
+        self.seconds = None
+        self.peak_memory = None
+        self.process_peak_memory = None
+        self._start = time.perf_counter()
+        self._start_peak = metrics.peak_memory()
+        self._memory = metrics.current_memory()
+
+
+    def add(self, stage, seconds, file = None, rows_in = None, rows_out = None):
+
+        """
+        adds the time and rows of one run of a stage
+        """
+
+        with metrics._lock:
+            totals = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "rows_in": 0, "rows_out": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["rows_in"] += rows_in or 0
+            totals["rows_out"] += rows_out or 0
+            self._sample()
+
+        metrics.emit({"query": self.name, "stage": stage, "file": file, "seconds": seconds, "rows_in": rows_in, "rows_out": rows_out})
+
+
+    def _sample(self):
+
+        # the resident memory at the end of a stage, while its data is still held
+        memory = metrics.current_memory()
+        if memory is not None:
+            self._memory = max(self._memory or 0, memory)
+
+
+    def measure(self):
+
+        """
+        records the peak memory of the process during the call so far, see summary.peak_memory
+        """
+
+        with metrics._lock:
+            self._sample()
+            self.process_peak_memory = metrics.peak_memory()
+            if self.process_peak_memory is not None and self._start_peak is not None and self.process_peak_memory > self._start_peak:
+                peak = self.process_peak_memory
+            else:
+                peak = self._memory
+            if peak is not None:
+                self.peak_memory = max(self.peak_memory or 0, peak)
+
+
+    def count(self, counter, value):
+
+        """
+        adds a value to one of the counters, e.g. "bytes_downloaded"
+        """
+
+        with metrics._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + (value or 0)
+
+
+    @contextlib.contextmanager
+    def stage(self, stage, file = None, rows_in = None):
+
+        """
+        times the code run inside a with block as a stage, the rows out can be set on the yielded record, e.g.
+
+            with s.stage("filter", rows_in = len(df)) as record:
+                df = df[mask]
+                record["rows_out"] = len(df)
+        """
+
+        record = {"rows_out": None}
+        start = time.perf_counter()
+        yield record
+        self.add(stage, time.perf_counter() - start, file, rows_in, record["rows_out"])
+
+
+    def iterate(self, stage, chunks, file = None):
+
+        """
+        yields the dataframes of an iterator (e.g. the chunks of a CSV reader), timing the production of each as a stage
+        """
+
+        chunks = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            self.add(stage, time.perf_counter() - start, file, None, len(chunk))
+            yield chunk
+
+
+    def merge(self, other):
+
+        """
+        adds the stages and counters of another summary, e.g. from a worker process
+        """
+
+        with metrics._lock:
+            for stage, totals in other.stages.items():
+                mine = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "rows_in": 0, "rows_out": 0})
+                for key, value in totals.items():
+                    mine[key] += value
+            for counter, value in other.counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+            if other.peak_memory is not None:
+                self.peak_memory = max(self.peak_memory or 0, other.peak_memory)
+
+
+    def finish(self):
+
+        """
+        records the total time and peak memory of the call, and passes them to the logger and metrics callback
+        """
+
+        self.seconds = time.perf_counter() - self._start
+        self.measure()
+
+        metrics.logger.info("%s finished in %.3f seconds", self.name, self.seconds)
+        metrics.emit(dict({"query": self.name, "stage": "total", "seconds": self.seconds, "peak_memory": self.peak_memory, "process_peak_memory": self.process_peak_memory}, **self.counters))
+        return self
+
+
+    def attach(self, result):
+
+        """
+        finishes the summary, and attaches it to a result as a plain dict (see summary.to_dict), as result.attrs["metrics"]
+        for dataframes, as JSON under the "lehd.metrics" key of the schema metadata for pyarrow tables, or as
+        result.metrics otherwise (e.g. for a lehd.od_matrix), and returns the result
+
+        only plain values are attached, since pandas copies attrs into every derived dataframe, and writes them as JSON
+        when a dataframe is saved to Parquet
+        """
+
+        self.finish()
+        totals = self.to_dict()
+        if hasattr(result, "attrs"):
+            result.attrs["metrics"] = totals
+        elif hasattr(result, "replace_schema_metadata"):
+            result = result.replace_schema_metadata(dict(result.schema.metadata or {}, **{"lehd.metrics": json.dumps(totals)}))
+        else:
+            result.metrics = totals
+        return result
+
+
+    def to_dict(self):
+
+        """
+        returns the summary as a plain dict
+        """
+
+        return {"name": self.name, "seconds": self.seconds, "peak_memory": self.peak_memory, "process_peak_memory": self.process_peak_memory, "counters": dict(self.counters), "stages": dict((k, dict(v)) for k, v in self.stages.items())}
+
+
+    def __repr__(self):
+
+        lines = ["summary(" + repr(self.name) + ", seconds = " + ("None" if self.seconds is None else "%.3f" % self.seconds) + ", peak_memory = " + str(self.peak_memory) + ", " + ", ".join(k + " = " + str(v) for k, v in self.counters.items()) + ")"]
+        for stage, totals in self.stages.items():
+            lines.append("  %-12s %6d calls %10.3f s %12d rows in %12d rows out" % (stage, totals["calls"], totals["seconds"], totals["rows_in"], totals["rows_out"]))
+        return "\n".join(lines)
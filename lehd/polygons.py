@@ -0,0 +1,103 @@
+import os
+import threading
+
+import lehd
+import pandas as pd
+
+
+class polygons:
+
+    """
+    Store of boundary polygons used by to_geo to join data to polygons.
+
+    A local boundary file (e.g. a TIGER/Line shapefile of census tracts) is read once with polygons.build, and
+    saved as GeoParquet files, sorted by GEOID, at several pre-simplified detail tiers. Joins then read only the
+    tier they need, which is kept in memory for the rest of the process. Requires geopandas and pyarrow.
+
+    directory : folder the polygon tiers are written to
+
+    tiers : simplification tolerance (in the units of the boundary file, degrees for TIGER/Line files) of each tier,
+    None keeps the full detail
+    """
+
+    directory = os.environ.get("LEHD_POLYGONS_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lehd", "polygons"))
+
+    tiers = {"full": None, "high": 0.0001, "medium": 0.001, "low": 0.01}
+
+    _tables = {}
+    _lock = threading.Lock()
+
+
+    def path(gtype, tier):
+
+        """
+        returns the path of the GeoParquet file of a geography type and tier
+        """
+
+        if tier not in polygons.tiers:
+            raise Exception('Please make sure the polygon tier is one of ' + str(list(polygons.tiers.keys())))
+
+        return os.path.join(polygons.directory, gtype, tier + ".parquet")
+
+
+    def build(gtype, paths, geoid_column = "GEOID"):
+
+        """
+        reads one or more local boundary files (any format readable by geopandas) of a geography type, e.g. "CT",
+        and saves every detail tier of their polygons
+
+        gtype : geography type of the boundaries, one of "BG", "CT", "C", or "S"
+
+        paths : path, or list of paths, to boundary files, e.g. one TIGER/Line shapefile per state
+
+        geoid_column : name of the GEOID column in the boundary files, e.g. "GEOID10" for 2010 TIGER/Line files
+        """
+
+        gpd = lehd.to_geo._geopandas()
+
+        if gtype not in ["BG", "CT", "C", "S"]:
+            raise Exception('Only states ("S"), counties ("C"), census tracts ("CT"), and block groups ("BG") are supported for polygons')
+
+        if isinstance(paths, str):
+            paths = [paths]
+
+        gdf = pd.concat([gpd.read_file(path)[[geoid_column, "geometry"]] for path in paths])
+        gdf = gdf.rename(columns = {geoid_column: "geoid"}).sort_values("geoid").reset_index(drop = True)
+        gdf = gpd.GeoDataFrame(gdf, geometry = "geometry")
+
+        os.makedirs(os.path.join(polygons.directory, gtype), exist_ok = True)
+
+        for tier, tolerance in polygons.tiers.items():
+            tier_gdf = gdf.copy()
+            if tolerance is not None:
+                tier_gdf["geometry"] = tier_gdf.geometry.simplify(tolerance, preserve_topology = True)
+            # a temporary file of this process and thread, so that concurrent builds never write the same file
+            tmp = polygons.path(gtype, tier) + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+            tier_gdf.to_parquet(tmp, index = False)
+            os.replace(tmp, polygons.path(gtype, tier))
+
+        with polygons._lock:
+            for key in [key for key in polygons._tables if key[0] == gtype]:
+                del polygons._tables[key]
+
+
+    def get(gtype, tier = "medium"):
+
+        """
+        returns the polygons of a geography type at a detail tier as a GeoDataFrame indexed by GEOID,
+        reading them from disk only the first time they are needed in this process
+        """
+
+        gpd = lehd.to_geo._geopandas()
+
+        with polygons._lock:
+
+            if (gtype, tier) not in polygons._tables:
+
+                path = polygons.path(gtype, tier)
+                if not os.path.exists(path):
+                    raise Exception('No polygons are stored for the geography type "' + gtype + '", please first build them from a boundary file with lehd.polygons.build')
+
+                polygons._tables[(gtype, tier)] = gpd.read_parquet(path).set_index("geoid")
+
+            return polygons._tables[(gtype, tier)]
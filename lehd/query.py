@@ -0,0 +1,269 @@
+import os
+
+import lehd
+import pandas as pd
+
+
+class query:
+
+    """
+    Lazy query of LODES data, built up by chaining methods and only downloaded when collected, e.g.
+
+        q = lehd.query().od(year = 2016).origins(["44001"]).destinations(["44007"]).by("C")
+        print(q.explain())
+        df = q.collect()
+
+    Before anything is downloaded, the query can be planned into the minimal list of files (skipping states and
+    OD file parts that cannot contain matching rows) and the columns to read from them, along with the estimated
+    number of bytes to download. Collecting the query runs the same download as dl_lodes.wac, dl_lodes.rac, or
+    dl_lodes.od (or their panel versions, if several years, segs, or types are queried).
+    """
+
+    def __init__(self):
+
+        self.kind = None
+        self.years = [2016]
+        self.segs = ["S000"]
+        self.types = ["JT00"]
+        self.geography = "B"
+        self.location_list = None
+        self.origin_list = None
+        self.destination_list = None
+        self.constrained_flag = "no"
+        self.columns = None
+        self.max_workers = 4
+        self.chunksize = None
+        self.output = "pandas"
+        self.engine = "pandas"
+
+
+    def _list(value):
+        return [value] if isinstance(value, (str, int)) else list(value)
+
+
+    def wac(self, year = 2016, seg = "S000", type = "JT00"):
+
+        """
+        queries workplace area characteristics (WAC) data, @year, @seg, and @type can each be a single value or a list
+        """
+
+        self.kind = "wac"
+        self.years, self.segs, self.types = query._list(year), query._list(seg), query._list(type)
+        return self
+
+
+    def rac(self, year = 2016, seg = "S000", type = "JT00"):
+
+        """
+        queries residence area characteristics (RAC) data, @year, @seg, and @type can each be a single value or a list
+        """
+
+        self.kind = "rac"
+        self.years, self.segs, self.types = query._list(year), query._list(seg), query._list(type)
+        return self
+
+
+    def od(self, year = 2016, type = "JT00"):
+
+        """
+        queries origin-destination (OD) data, @year and @type can each be a single value or a list
+        """
+
+        self.kind = "od"
+        self.years, self.segs, self.types = query._list(year), ["S000"], query._list(type)
+        return self
+
+
+    def locations(self, geoids):
+
+        """
+        sets the list of GEOIDs to subset WAC or RAC data to
+        """
+
+        self.location_list = query._list(geoids)
+        return self
+
+
+    def origins(self, geoids):
+
+        """
+        sets the list of GEOIDs to subset OD data to by origin (home location)
+        """
+
+        self.origin_list = query._list(geoids)
+        return self
+
+
+    def destinations(self, geoids):
+
+        """
+        sets the list of GEOIDs to subset OD data to by destination (workplace location)
+        """
+
+        self.destination_list = query._list(geoids)
+        return self
+
+
+    def constrained(self, constrained = "yes"):
+
+        """
+        sets whether OD flows must match both the origins and the destinations ("yes"), or either of them ("no")
+        """
+
+        self.constrained_flag = constrained
+        return self
+
+
+    def by(self, geography):
+
+        """
+        sets the geography level to aggregate to, e.g. "CT"
+        """
+
+        self.geography = geography
+        return self
+
+
+    def select(self, columns):
+
+        """
+        sets the list of job count columns to download and return, e.g. ["S000", "SE03"]
+        """
+
+        self.columns = query._list(columns)
+        return self
+
+
+    def options(self, max_workers = None, chunksize = None, output = None, engine = None):
+
+        """
+        sets the @max_workers, @chunksize, @output, and @engine options of the download, see dl_lodes.od
+        """
+
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if chunksize is not None:
+            self.chunksize = chunksize
+        if output is not None:
+            self.output = output
+        if engine is not None:
+            self.engine = engine
+        return self
+
+
+    def _states(geoids):
+
+        if geoids is None:
+            return []
+        df = pd.DataFrame({"o": geoids})
+        df["gtype"] = lehd.utils.infer_geog_inputs(df["o"])
+        return sorted(set(lehd.utils.get_state_alpha(df, "o")))
+
+
+    def _source(self, file_name, url):
+
+        # where a planned file would be read from, in the same order of precedence as dl_lodes._read_files
+        if self.kind == "od":
+            locations = (self.origin_list or []) + (self.destination_list or [])
+            cube = self.output != "sparse"
+        else:
+            locations = self.location_list
+            cube = True
+        if cube and lehd.cube.enabled and lehd.cube.usable(locations, self.geography):
+            if all(os.path.exists(lehd.cube.path(file_name, level)) for level in lehd.cube.levels):
+                return "cube"
+        if lehd.store.enabled and os.path.exists(lehd.store.path(file_name)):
+            return "store"
+        if lehd.cache.enabled and lehd.cache.cached_size(url) is not None:
+            return "cache"
+        return "download"
+
+
+    def plan(self, sizes = True):
+
+        """
+        returns the plan of the query as a pandas dataframe, with one row per file to read, its URL, where it will be
+        read from ("cube", "store", "cache", or "download"), and its size in bytes (None if unknown). The columns read
+        from each file are in the "columns" attribute of the output (None means every column)
+
+        sizes : if True, the size of files that are not cached is requested from the server, with a HEAD request
+        """
+
+        if self.kind is None:
+            raise Exception('Please choose the data to query with .wac(), .rac(), or .od()')
+
+        lehd.dl_lodes._check_params(self.years, self.geography, self.types, self.chunksize, self.engine)
+
+        if self.kind == "od":
+            if self.origin_list is None and self.destination_list is None:
+                raise Exception('Please input a list of origins and/or destinations to download data for')
+            output_values, usecols = lehd.dl_lodes._projection("od", "C" if self.output == "sparse" else self.geography, self.columns)
+            files, file_labels, labels = lehd.dl_lodes._od_files(
+                query._states(self.origin_list), query._states(self.destination_list), self.constrained_flag, self.years, self.types)
+        else:
+            if self.location_list is None:
+                raise Exception('Please input a list of locations to download data for')
+            output_values, usecols = lehd.dl_lodes._projection(self.kind, self.geography, self.columns)
+            files, file_labels, labels = lehd.dl_lodes._characteristics_files(
+                self.kind, query._states(self.location_list), self.years, self.segs, self.types)
+
+        rows = []
+        for file_name, url in files:
+            source = self._source(file_name, url)
+            size = lehd.cache.cached_size(url)
+            if size is None and sizes:
+                size = lehd.cache.remote_size(url)
+            rows.append({"file": file_name, "url": url, "source": source, "bytes": size})
+
+        df = pd.DataFrame(rows, columns = ["file", "url", "source", "bytes"])
+        df.attrs["columns"] = usecols
+        return df
+
+
+    def explain(self, sizes = True):
+
+        """
+        returns a readable description of the plan of the query, see query.plan
+        """
+
+        df = self.plan(sizes)
+
+        lines = []
+        lines.append("query: " + self.kind + " " + self.geography + " for years " + str(self.years) + (", types " + str(self.types)) + ("" if self.kind == "od" else ", segs " + str(self.segs)))
+        if self.kind == "od":
+            lines.append("origins: " + str(self.origin_list) + ", destinations: " + str(self.destination_list) + ", constrained: " + self.constrained_flag)
+        else:
+            lines.append("locations: " + str(self.location_list))
+        lines.append("columns read: " + ("all" if df.attrs["columns"] is None else str(df.attrs["columns"])))
+        lines.append("files: " + str(len(df)))
+        for row in df.itertuples():
+            lines.append("  " + row.file + "  [" + row.source + "]  " + ("? bytes" if row.bytes is None or pd.isna(row.bytes) else str(int(row.bytes)) + " bytes"))
+        known = df["bytes"].dropna()
+        lines.append("estimated bytes: " + str(int(known.sum())) + ("" if len(known) == len(df) else " (" + str(len(df) - len(known)) + " files of unknown size)"))
+        return "\n".join(lines)
+
+
+    def collect(self):
+
+        """
+        downloads the data of the query, and returns it in the same form as dl_lodes.wac, dl_lodes.rac, or dl_lodes.od
+        (or their panel versions, if several years, segs, or types are queried)
+        """
+
+        if self.kind is None:
+            raise Exception('Please choose the data to query with .wac(), .rac(), or .od()')
+
+        panel = len(self.years) > 1 or len(self.segs) > 1 or len(self.types) > 1
+
+        if self.kind == "od":
+            if panel:
+                if self.output == "sparse":
+                    raise Exception('Please query a single year and type for the "sparse" @output')
+                return lehd.dl_lodes.od_panel(self.years, self.geography, self.types, self.origin_list, self.destination_list, self.constrained_flag, self.max_workers, self.chunksize, self.columns, self.output, self.engine)
+            return lehd.dl_lodes.od(self.years[0], self.geography, self.types[0], self.origin_list, self.destination_list, self.constrained_flag, self.max_workers, self.chunksize, self.columns, self.output, self.engine)
+
+        if panel:
+            function = lehd.dl_lodes.wac_panel if self.kind == "wac" else lehd.dl_lodes.rac_panel
+            return function(self.location_list, self.years, self.geography, self.segs, self.types, self.max_workers, self.chunksize, self.columns, self.output, self.engine)
+        function = lehd.dl_lodes.wac if self.kind == "wac" else lehd.dl_lodes.rac
+        return function(self.location_list, self.years[0], self.geography, self.segs[0], self.types[0], self.max_workers, self.chunksize, self.columns, self.output, self.engine)
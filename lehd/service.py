@@ -0,0 +1,351 @@
+import io
+import json
+import time
+import threading
+import collections
+import http.server
+import urllib.parse
+import concurrent.futures
+
+import lehd
+import numpy as np
+
+
+class QueryError(Exception):
+
+    # an invalid query, which the service answers with a 400 status rather than a 500
+    pass
+
+
+class service:
+
+    """
+    Local HTTP query service in front of dl_lodes, started with "lehd serve" (see lehd serve --help) or lehd.service.server
+
+    Queries are GET requests to /wac, /rac, or /od, with the parameters of dl_lodes.wac, dl_lodes.rac, or dl_lodes.od,
+    where lists are comma separated, and the format of the response as "format", one of "parquet", "csv", or "json", e.g.
+
+        /wac?locations=44001,44003&year=2016&geography=CT&columns=C000,CE01&format=csv
+        /od?origins=44&geography=C&format=parquet
+
+    Parameters are normalized (defaults filled in, lists deduplicated and sorted) so that equivalent queries share one
+    result. Results are kept in an LRU cache bounded by @max_bytes, and identical queries that arrive while one is
+    being computed wait for its result instead of computing it again. The latency and cache hit rate of each endpoint
+    are returned as JSON by /metrics
+
+    host : address the service listens on. Default is "127.0.0.1"
+
+    port : port the service listens on. Default is 8080
+
+    max_bytes : memory budget of the result cache, once exceeded the least recently used results are removed. Default is 512 MB
+
+    engine : the CSV parse engine of dl_lodes used for every query, "pandas" or "pyarrow". Default is "pandas"
+
+    samples : number of recent latencies kept per endpoint for the latency percentiles of /metrics. Default is 1000
+    """
+
+    host = "127.0.0.1"
+    port = 8080
+    max_bytes = 512 * 1024 ** 2
+    engine = "pandas"
+    samples = 1000
+
+    # the query parameters of each endpoint, with their defaults, lists are None
+    endpoints = {
+        "wac": {"locations": None, "year": 2016, "geography": "B", "seg": "S000", "type": "JT00", "columns": None},
+        "rac": {"locations": None, "year": 2016, "geography": "B", "seg": "S000", "type": "JT00", "columns": None},
+        "od": {"year": 2016, "geography": "B", "type": "JT00", "origins": None, "destinations": None, "constrained": "no", "columns": None}
+    }
+
+    formats = {
+        "parquet": "application/vnd.apache.parquet",
+        "csv": "text/csv",
+        "json": "application/json"
+    }
+
+    _lock = threading.Lock()
+    _results = collections.OrderedDict()
+    _bytes = 0
+    _inflight = {}
+    _metrics = {}
+
+
+    def normalize(endpoint, params):
+
+        """
+        returns the normalized key of the query parameters (a dict of lists of strings, as from urllib.parse.parse_qs)
+        of an endpoint, and the keyword arguments of the dl_lodes function to run it with
+        """
+
+        if endpoint not in service.endpoints:
+            raise QueryError('Please make sure the endpoint is one of ' + str(["/" + e for e in service.endpoints]))
+
+        defaults = service.endpoints[endpoint]
+        for name in params:
+            if name not in defaults and name != "format":
+                raise QueryError('Please make sure the query parameters of /' + endpoint + ' are from ' + str(list(defaults.keys()) + ["format"]))
+
+        kwargs = {}
+        for name, default in defaults.items():
+            values = [v.strip() for value in params.get(name, []) for v in value.split(",") if v.strip() != ""]
+            if default is not None:
+                kwargs[name] = values[-1] if len(values) > 0 else default
+            elif len(values) > 0:
+                kwargs[name] = sorted(set(values)) if name != "columns" else list(dict.fromkeys(values))
+            else:
+                kwargs[name] = None
+
+        kwargs["geography"] = kwargs["geography"].upper()
+        kwargs["type"] = kwargs["type"].upper()
+        if "seg" in kwargs:
+            kwargs["seg"] = kwargs["seg"].upper()
+        if "constrained" in kwargs:
+            kwargs["constrained"] = kwargs["constrained"].lower()
+
+        service._validate(endpoint, kwargs)
+
+        # job count columns are put in the order of the files, so that any order of the same columns is the same query
+        if kwargs["columns"] is not None:
+            order = dict((c, i) for i, c in enumerate(lehd.dl_lodes.od_values + lehd.dl_lodes.wac_values + lehd.dl_lodes.firm_values))
+            kwargs["columns"] = sorted(kwargs["columns"], key = lambda c: order.get(c, len(order)))
+
+        key = (endpoint,) + tuple((name, tuple(value) if isinstance(value, list) else value) for name, value in sorted(kwargs.items()))
+        return key, kwargs
+
+
+    def _validate(endpoint, kwargs):
+
+        """
+        checks the normalized parameters of a query before it is run, raising a QueryError for any invalid value, and
+        converts the year to an integer
+        """
+
+        try:
+            kwargs["year"] = int(kwargs["year"])
+        except ValueError:
+            raise QueryError('Please make sure the query parameter year is an integer')
+
+        # the checks of dl_lodes are reused, with their errors raised as QueryErrors
+        try:
+            lehd.dl_lodes._check_params([kwargs["year"]], kwargs["geography"], [kwargs["type"]], None)
+            lehd.dl_lodes._projection(endpoint, kwargs["geography"], kwargs["columns"])
+        except Exception as e:
+            raise QueryError(str(e)) from e
+
+        if "seg" in kwargs and kwargs["seg"] not in ["S000", "SA01", "SA02", "SA03", "SE01", "SE02", "SE03", "SI01", "SI02"]:
+            raise QueryError('Please make sure the query parameter seg is one of ["S000", "SA01", "SA02", "SA03", "SE01", "SE02", "SE03", "SI01", "SI02"]')
+        if "constrained" in kwargs and kwargs["constrained"] not in ["yes", "no"]:
+            raise QueryError('Please make sure the query parameter constrained is one of ["yes","no"]')
+
+        names = ["locations"] if endpoint != "od" else ["origins", "destinations"]
+        if all(kwargs[name] is None for name in names):
+            raise QueryError('Please make sure the query has ' + " or ".join(names))
+        for name in names:
+            if kwargs[name] is not None and (lehd.utils.infer_geog_inputs(kwargs[name]) == "error").any():
+                raise QueryError('Please make sure the query parameter ' + name + ' only contains valid GEOIDs')
+
+
+    def query(endpoint, params):
+
+        """
+        returns the result of a query to an endpoint, and whether it was a cache "hit", a "miss" that was computed,
+        or "coalesced" with an identical query that was already being computed
+        """
+
+        key, kwargs = service.normalize(endpoint, params)
+
+        with service._lock:
+            if key in service._results:
+                service._results.move_to_end(key)
+                return service._results[key][0], "hit"
+            future = service._inflight.get(key)
+            if future is not None:
+                coalesced = True
+            else:
+                coalesced = False
+                future = service._inflight[key] = concurrent.futures.Future()
+
+        if coalesced:
+            return future.result(), "coalesced"
+
+        try:
+            df = getattr(lehd.dl_lodes, endpoint)(engine = service.engine, **kwargs)
+        except Exception as e:
+            with service._lock:
+                del service._inflight[key]
+            future.set_exception(e)
+            raise
+
+        # the result is cached before the query stops being in flight, so that no identical query can miss both
+        with service._lock:
+            service._store(key, df)
+            del service._inflight[key]
+        future.set_result(df)
+
+        return df, "miss"
+
+
+    def _store(key, df):
+
+        # called with the lock held, results larger than the whole budget are not cached
+        size = int(df.memory_usage(index = True, deep = True).sum())
+        if size > service.max_bytes:
+            return
+
+        service._results[key] = (df, size)
+        service._bytes += size
+        while service._bytes > service.max_bytes:
+            old_key, (old_df, old_size) = service._results.popitem(last = False)
+            service._bytes -= old_size
+
+
+    def serialize(df, format):
+
+        """
+        returns the bytes of a dataframe in a response format, "parquet", "csv", or "json", and their content type
+        """
+
+        if format not in service.formats:
+            raise QueryError('Please make sure the input parameter @format is one of ' + str(list(service.formats.keys())))
+
+        if format == "parquet":
+            buffer = io.BytesIO()
+            df.to_parquet(buffer, index = False)
+            body = buffer.getvalue()
+        elif format == "csv":
+            body = df.to_csv(index = False).encode("utf-8")
+        else:
+            body = df.to_json(orient = "records").encode("utf-8")
+
+        return body, service.formats[format]
+
+
+    def record(endpoint, seconds, cache = None, error = False):
+
+        """
+        records the latency of a request to an endpoint, and whether it was a cache "hit", "miss", or "coalesced", or an error
+        """
+
+        with service._lock:
+            metrics = service._metrics.setdefault(endpoint, {
+                "requests": 0, "errors": 0, "hit": 0, "miss": 0, "coalesced": 0, "seconds": 0.0, "max_seconds": 0.0,
+                "latencies": collections.deque(maxlen = service.samples)})
+            metrics["requests"] += 1
+            metrics["errors"] += error
+            if cache is not None:
+                metrics[cache] += 1
+            metrics["seconds"] += seconds
+            metrics["max_seconds"] = max(metrics["max_seconds"], seconds)
+            metrics["latencies"].append(seconds)
+
+
+    def metrics():
+
+        """
+        returns the metrics of the service as a dict, with the requests, errors, cache hits, misses, and coalesced
+        queries, hit rate, and latencies (mean, p50, p95, p99, and max, in seconds) of each endpoint, and the size of the result cache
+        """
+
+        with service._lock:
+            endpoints = {}
+            for endpoint, m in service._metrics.items():
+                latencies = np.array(m["latencies"])
+                queries = m["hit"] + m["miss"] + m["coalesced"]
+                endpoints[endpoint] = {
+                    "requests": m["requests"],
+                    "errors": m["errors"],
+                    "hits": m["hit"],
+                    "misses": m["miss"],
+                    "coalesced": m["coalesced"],
+                    "hit_rate": (m["hit"] + m["coalesced"]) / queries if queries > 0 else None,
+                    "latency": {
+                        "mean": m["seconds"] / m["requests"],
+                        "p50": float(np.percentile(latencies, 50)),
+                        "p95": float(np.percentile(latencies, 95)),
+                        "p99": float(np.percentile(latencies, 99)),
+                        "max": m["max_seconds"]
+                    }
+                }
+            return {
+                "endpoints": endpoints,
+                "cache": {"entries": len(service._results), "bytes": service._bytes, "max_bytes": service.max_bytes},
+                "inflight": len(service._inflight)
+            }
+
+
+    def clear():
+
+        """
+        removes every result from the result cache, and resets the metrics
+        """
+
+        with service._lock:
+            service._results.clear()
+            service._bytes = 0
+            service._metrics.clear()
+
+
+    def server(host = None, port = None):
+
+        """
+        returns the HTTP server of the service on @host and @port (default service.host and service.port), which is
+        started with server.serve_forever(), and stopped with server.shutdown()
+        """
+
+        httpd = http.server.ThreadingHTTPServer((host or service.host, service.port if port is None else port), _Handler)
+        httpd.daemon_threads = True
+        return httpd
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    # requests are logged to the "lehd" logger rather than stderr
+    def log_message(self, format, *args):
+        lehd.metrics.logger.info("%s " + format, self.address_string(), *args)
+
+
+    def _send(self, status, body, content_type, headers = {}):
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _send_json(self, status, value):
+
+        self._send(status, json.dumps(value).encode("utf-8"), "application/json")
+
+
+    def do_GET(self):
+
+        parsed = urllib.parse.urlparse(self.path)
+        endpoint = parsed.path.strip("/")
+
+        if endpoint == "metrics":
+            return self._send_json(200, service.metrics())
+        if endpoint == "health":
+            return self._send_json(200, {"status": "ok"})
+        if endpoint not in service.endpoints:
+            return self._send_json(404, {"error": 'Please make sure the endpoint is one of ' + str(["/" + e for e in service.endpoints] + ["/metrics", "/health"])})
+
+        start = time.perf_counter()
+        params = urllib.parse.parse_qs(parsed.query)
+        cache = None
+        try:
+            format = params.get("format", ["json"])[-1].lower()
+            if format not in service.formats:
+                raise QueryError('Please make sure the input parameter @format is one of ' + str(list(service.formats.keys())))
+            df, cache = service.query(endpoint, params)
+            body, content_type = service.serialize(df, format)
+        except Exception as e:
+            service.record(endpoint, time.perf_counter() - start, cache, error = True)
+            # invalid queries are the client's errors, and any other error (e.g. a failed download) is the service's
+            return self._send_json(400 if isinstance(e, QueryError) else 500, {"error": str(e)})
+
+        seconds = time.perf_counter() - start
+        service.record(endpoint, seconds, cache)
+        self._send(200, body, content_type, {"X-Lehd-Cache": cache, "X-Lehd-Seconds": "%.6f" % seconds})
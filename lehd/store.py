@@ -0,0 +1,135 @@
+import os
+import threading
+
+import lehd
+import pandas as pd
+
+
+class store:
+
+    """
+    Columnar (Parquet) local mirror of LODES files.
+
+    When enabled, each LODES file is converted once from gzip CSV into a Parquet file, partitioned by
+    file type/state/year/seg (or part)/type, sorted by geocode, and written with row group statistics.
+    Later dl_lodes calls then read only the needed columns, and only the row groups whose geocodes
+    overlap the requested locations. Requires pyarrow.
+
+    Settings are class attributes, e.g.
+
+        lehd.store.enabled = True
+        lehd.store.directory = "/data/lehd_parquet"
+
+    directory : folder the Parquet files are written to
+
+    enabled : if True, dl_lodes reads LODES files through the columnar store
+
+    row_group_size : number of rows per Parquet row group, smaller row groups allow finer filtering
+    """
+
+    directory = os.environ.get("LEHD_STORE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lehd", "parquet"))
+    enabled = False
+    row_group_size = 64 * 1024
+
+    _lock = threading.Lock()
+    _converting = {}
+
+
+    def _pyarrow():
+
+        try:
+            import pyarrow
+            import pyarrow.parquet
+            import pyarrow.dataset
+        except ImportError:
+            raise Exception('The columnar store requires pyarrow, which can be installed with "pip install lehd[arrow]"')
+        return pyarrow
+
+
+    def path(file_name):
+
+        """
+        returns the path of the Parquet file for a LODES file name, e.g. ri_od_main_JT00_2016.csv.gz
+        """
+
+        state, kind, seg, type, year = file_name.split(".")[0].split("_")
+        part = "part=" if kind == "od" else "seg="
+        return os.path.join(store.directory, "kind=" + kind, "state=" + state, "year=" + year, part + seg, "type=" + type, "data.parquet")
+
+
+    def convert(file_name, url, dtype = None):
+
+        """
+        converts a LODES file into the columnar store, if it is not there already, and returns its path
+        """
+
+        pa = store._pyarrow()
+
+        file_path = store.path(file_name)
+
+        # only one thread converts a given file, others wait for it to finish
+        with store._lock:
+            lock = store._converting.setdefault(file_path, threading.Lock())
+
+        with lock:
+
+            if os.path.exists(file_path):
+                return file_path
+
+            df = pd.read_csv(lehd.cache.fetch(url), compression = "gzip", dtype = dtype)
+
+            # sorting by geocode so that row group statistics can be used to skip data
+            sort_columns = [c for c in ["w_geocode", "h_geocode"] if c in df.columns]
+            df = df.sort_values(sort_columns, kind = "stable").reset_index(drop = True)
+
+            os.makedirs(os.path.dirname(file_path), exist_ok = True)
+            table = pa.Table.from_pandas(df, preserve_index = False)
+            # a temporary file of this process and thread, so that concurrent builds never write the same file
+            tmp = file_path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+            pa.parquet.write_table(table, tmp, row_group_size = store.row_group_size, write_statistics = True)
+            os.replace(tmp, file_path)
+
+        return file_path
+
+
+    def range_filter(column, starts, ends):
+
+        """
+        returns a filter expression for the rows where @column is within any of the sorted block code ranges from utils.geoid_ranges
+        """
+
+        pa = store._pyarrow()
+
+        expression = None
+        for start, end in zip(starts, ends):
+            condition = (pa.dataset.field(column) >= int(start)) & (pa.dataset.field(column) < int(end))
+            expression = condition if expression is None else expression | condition
+        return expression
+
+
+    def read(file_name, url, dtype = None, columns = None, filter = None, chunksize = None):
+
+        """
+        reads a LODES file from the columnar store (converting it first if needed), yielding pandas
+        dataframes of up to @chunksize rows, or a single dataframe if @chunksize is None
+
+        columns : list of columns to read, or None for all columns
+
+        filter : filter expression, e.g. from store.range_filter, used to skip row groups and rows
+        """
+
+        pa = store._pyarrow()
+
+        dataset = pa.dataset.dataset(store.convert(file_name, url, dtype), format = "parquet")
+
+        if chunksize is None:
+            yield dataset.to_table(columns = columns, filter = filter).to_pandas()
+            return
+
+        empty = True
+        for batch in dataset.to_batches(columns = columns, filter = filter, batch_size = chunksize):
+            if batch.num_rows > 0:
+                empty = False
+                yield batch.to_pandas()
+        if empty:
+            yield dataset.schema.empty_table().select(columns if columns is not None else dataset.schema.names).to_pandas()
@@ -1,7 +1,15 @@
+import lehd
 import pandas as pd
+import numpy as np
 
 class utils:
 
+    # number of digits in the GEOID of each geography type
+    geoid_lengths = {"S": 2, "C": 5, "P": 7, "CS": 10, "CT": 11, "BG": 12, "B": 15}
+
+    # state alpha and numeric codes
+    state_codes = [["AL","01"],["AK","02"],["AS","60"],["","03"],["AZ","04"],["AR","05"],["BI","81"],["CA","06"],["","07"],["CO","08"],["CT","09"],["DE","10"],["DC","11"],["FL","12"],["FM","64"],["GA","13"],["","14"],["GU","66"],["HI","15"],["HI","84"],["ID","16"],["IL","17"],["IN","18"],["IA","19"],["JI","86"],["JA","67"],["KS","20"],["KY","21"],["KR","89"],["LA","22"],["ME","23"],["MH","68"],["MD","24"],["MA","25"],["MI","26"],["MI","71"],["MN","27"],["MS","28"],["MO","29"],["MT","30"],["NI","76"],["NE","31"],["NV","32"],["NH","33"],["NJ","34"],["NM","35"],["NY","36"],["NC","37"],["ND","38"],["MP","69"],["OH","39"],["OK","40"],["OR","41"],["PW","70"],["PA","95"],["PA","42"],["","43"],["PR","72"],["RI","44"],["SC","45"],["SD","46"],["TN","47"],["TX","48"],["UM","74"],["UT","49"],["VT","50"],["VA","51"],["","52"],["VI","78"],["WI","79"],["WA","53"],["WV","54"],["WI","55"],["WY","56"]]
+
     def get_state_alpha(df, id):
 
         """
@@ -10,9 +18,7 @@ class utils:
 
         df["state_numeric"] = df[id].astype(str).str[0:2]
 
-        state_codes = [["AL","01"],["AK","02"],["AS","60"],["","03"],["AZ","04"],["AR","05"],["BI","81"],["CA","06"],["","07"],["CO","08"],["CT","09"],["DE","10"],["DC","11"],["FL","12"],["FM","64"],["GA","13"],["","14"],["GU","66"],["HI","15"],["HI","84"],["ID","16"],["IL","17"],["IN","18"],["IA","19"],["JI","86"],["JA","67"],["KS","20"],["KY","21"],["KR","89"],["LA","22"],["ME","23"],["MH","68"],["MD","24"],["MA","25"],["MI","26"],["MI","71"],["MN","27"],["MS","28"],["MO","29"],["MT","30"],["NI","76"],["NE","31"],["NV","32"],["NH","33"],["NJ","34"],["NM","35"],["NY","36"],["NC","37"],["ND","38"],["MP","69"],["OH","39"],["OK","40"],["OR","41"],["PW","70"],["PA","95"],["PA","42"],["","43"],["PR","72"],["RI","44"],["SC","45"],["SD","46"],["TN","47"],["TX","48"],["UM","74"],["UT","49"],["VT","50"],["VA","51"],["","52"],["VI","78"],["WI","79"],["WA","53"],["WV","54"],["WI","55"],["WY","56"]]
-
-        state_codes = pd.DataFrame(state_codes, columns = ["state_alpha","state_numeric"])
+        state_codes = pd.DataFrame(utils.state_codes, columns = ["state_alpha","state_numeric"])
 
         return pd.merge(df, state_codes, on = "state_numeric")["state_alpha"].unique()
 
@@ -44,20 +50,221 @@ class utils:
     def get_geoid(block_id, gtype):
 
         """
-        gets the GEOID for different higher level geographies from a block GEOID
+        gets the GEOID for different higher level geographies from a block GEOID, places, county subdivisions, and
+        other crosswalk geographies are looked up in the geography crosswalk (see lehd.xwalk)
         """
 
-        if gtype == "S":
+        if gtype in lehd.xwalk.levels:
+            return(utils.format_geoids(lehd.xwalk.map([int(block_id)], gtype), gtype)[0])
+        elif gtype == "S":
             return(block_id[0:2])
         elif gtype == "C":
             return(block_id[0:5])
-        elif gtype == "CS":
-            return(block_id[0:10])
-        elif gtype == "P":
-            return(block_id[0:7])
         elif gtype == "CT":
             return(block_id[0:11])
         elif gtype == "BG":
             return(block_id[0:12])
         else:
             None
+
+
+    def infer_geog_inputs(geoids):
+
+        """
+        array-level version of infer_geog_input, infers the geography type of each GEOID in a list or array of GEOID strings
+        """
+
+        lengths = np.char.str_len(np.asarray(geoids, dtype = str))
+        gtypes = np.full(len(lengths), "error", dtype = object)
+        for gtype, length in utils.geoid_lengths.items():
+            gtypes[lengths == length] = gtype
+        return gtypes
+
+
+    def get_geoids(block_codes, gtype):
+
+        """
+        array-level version of get_geoid, gets the integer GEOID codes of a higher level geography from an array of integer block codes,
+        with -1 for blocks outside any geography of a crosswalk geography type
+        """
+
+        if gtype in lehd.xwalk.levels:
+            return lehd.xwalk.map(block_codes, gtype)
+
+        if gtype not in utils.geoid_lengths:
+            raise Exception('Please make sure the geography type is one of ' + str(list(utils.geoid_lengths.keys()) + list(lehd.xwalk.levels.keys())))
+
+        return np.asarray(block_codes, dtype = np.int64) // 10 ** (15 - utils.geoid_lengths[gtype])
+
+
+    def format_geoids(codes, gtype):
+
+        """
+        converts an array of integer GEOID codes to zero-padded GEOID strings of a geography type, with None for negative
+        codes (blocks outside any geography of a crosswalk geography type)
+        """
+
+        codes = np.asarray(codes, dtype = np.int64)
+        if len(codes) == 0:
+            return np.array([], dtype = object)
+        length = lehd.xwalk.levels[gtype][1] if gtype in lehd.xwalk.levels else utils.geoid_lengths[gtype]
+        geoids = np.char.zfill(codes.astype(str), length).astype(object)
+        geoids[codes < 0] = None
+        return geoids
+
+
+    def geoid_dictionary(codes, gtype):
+
+        """
+        converts an array of integer GEOID codes to a dictionary-encoded pyarrow array of GEOID strings of a geography
+        type, formatting each distinct code only once, with nulls for negative codes (see format_geoids)
+        """
+
+        import pyarrow
+
+        codes = np.asarray(codes, dtype = np.int64)
+        valid = codes >= 0
+
+        # negative codes are only masked, and kept out of the dictionary, which cannot hold nulls
+        indices = np.zeros(len(codes), dtype = np.int32)
+        positions, unique = pd.factorize(codes[valid])
+        indices[valid] = positions
+        return pyarrow.DictionaryArray.from_arrays(
+            pyarrow.array(indices, mask = ~valid),
+            pyarrow.array(utils.format_geoids(unique, gtype), type = pyarrow.string()))
+
+
+    def geoid_ranges(geoids):
+
+        """
+        converts a list of GEOID strings of any mix of geography levels (S, C, CT, BG, B, ...) into sorted,
+        non-overlapping ranges of integer block codes, returned as arrays of range starts and (exclusive) range ends
+
+        places and county subdivisions are not made of the blocks whose GEOIDs start with theirs, so they are given
+        the range of their whole state (or county), which covers them, see utils.locator for an exact match
+        """
+
+        geoids = np.asarray(geoids, dtype = str)
+        gtypes = utils.infer_geog_inputs(geoids)
+        if (gtypes == "error").any():
+            raise Exception('Could not infer the geography type of the GEOIDs ' + str(list(geoids[gtypes == "error"])))
+
+        geoids = geoids.astype(object)
+        geoids[gtypes == "P"] = [geoid[:2] for geoid in geoids[gtypes == "P"]]
+        geoids[gtypes == "CS"] = [geoid[:5] for geoid in geoids[gtypes == "CS"]]
+        geoids = geoids.astype(str)
+
+        # each GEOID covers every block code that starts with it
+        scale = 10 ** (15 - np.char.str_len(geoids).astype(np.int64))
+        codes = geoids.astype(np.int64)
+        starts = codes * scale
+        ends = (codes + 1) * scale
+
+        order = np.argsort(starts, kind = "stable")
+        starts = starts[order]
+        ends = np.maximum.accumulate(ends[order])
+
+        # merging ranges that overlap or touch, e.g. a county inside an input state
+        new_range = np.ones(len(starts), dtype = bool)
+        new_range[1:] = starts[1:] > ends[:-1]
+        group = np.cumsum(new_range) - 1
+        merged_ends = np.zeros(new_range.sum(), dtype = np.int64)
+        np.maximum.at(merged_ends, group, ends)
+
+        return starts[new_range], merged_ends
+
+
+    def in_ranges(codes, starts, ends):
+
+        """
+        returns a boolean mask of the integer block @codes that fall within any of the sorted ranges from geoid_ranges
+        """
+
+        codes = np.asarray(codes, dtype = np.int64)
+        i = np.searchsorted(starts, codes, side = "right") - 1
+        return (i >= 0) & (codes < ends[np.maximum(i, 0)])
+
+
+    def locator(geoids):
+
+        """
+        returns a function that gives the boolean mask of an array of integer block codes within any of a list of GEOID
+        strings, along with the (starts, ends) block code ranges from geoid_ranges that cover them. Places and county
+        subdivisions are matched through the geography crosswalk, and other geographies by their block code ranges
+        """
+
+        geoids = np.asarray(geoids, dtype = str)
+        gtypes = utils.infer_geog_inputs(geoids)
+        ranges = utils.geoid_ranges(geoids)
+
+        crosswalked = np.isin(gtypes, list(lehd.xwalk.levels.keys()))
+        if not crosswalked.any():
+            return (lambda codes: utils.in_ranges(codes, *ranges)), ranges
+
+        prefix_ranges = utils.geoid_ranges(geoids[~crosswalked]) if (~crosswalked).any() else None
+        lookups = [(gtype, np.unique(geoids[gtypes == gtype].astype(np.int64))) for gtype in sorted(set(gtypes[crosswalked]))]
+
+        def mask(codes):
+            codes = np.asarray(codes, dtype = np.int64)
+            m = np.zeros(len(codes), dtype = bool) if prefix_ranges is None else utils.in_ranges(codes, *prefix_ranges)
+            # only the blocks in the covering ranges are looked up in the crosswalk
+            candidates = np.flatnonzero(~m & utils.in_ranges(codes, *ranges))
+            for gtype, values in lookups:
+                m[candidates] |= np.isin(lehd.xwalk.map(codes[candidates], gtype), values)
+            return m
+
+        return mask, ranges
+
+
+    def sum_by(keys, df, columns):
+
+        """
+        sums the @columns of a dataframe by one or two arrays of integer @keys (e.g. the origin and destination codes),
+        skipping rows with a negative key, and returns a dataframe indexed by the keys, like df.groupby(keys)[columns].sum()
+
+        the rows are reduced with np.bincount over the factorized keys, so every geography level is summed the same way
+        """
+
+        valid = np.ones(len(df), dtype = bool)
+        for key in keys:
+            valid &= key >= 0
+
+        group = None
+        uniques = []
+        for key in keys:
+            codes, unique = pd.factorize(key[valid])
+            group = codes if group is None else group * len(unique) + codes
+            uniques.append(unique)
+
+        if group is None or len(group) == 0:
+            index = pd.MultiIndex.from_arrays([np.array([], dtype = np.int64)] * len(keys)) if len(keys) > 1 else pd.Index([], dtype = np.int64)
+            return pd.DataFrame(0, index = index, columns = columns, dtype = np.int64)
+
+        group, first = pd.factorize(group)
+        # decoding the key values of each group from the combined group code
+        key_values = []
+        remainder = first
+        for unique in reversed(uniques[1:]):
+            key_values.insert(0, unique[remainder % len(unique)])
+            remainder = remainder // len(unique)
+        key_values.insert(0, uniques[0][remainder])
+
+        out = {}
+        for column in columns:
+            out[column] = np.bincount(group, weights = df[column].to_numpy()[valid], minlength = len(first)).astype(np.int64)
+
+        index = pd.MultiIndex.from_arrays(key_values) if len(keys) > 1 else pd.Index(key_values[0])
+        return pd.DataFrame(out, index = index)
+
+
+    def state_alpha(state_numeric):
+
+        """
+        returns the state alpha code (e.g. "RI") for a state numeric code (e.g. "44" or 44)
+        """
+
+        state_numeric = str(state_numeric).zfill(2)
+        for alpha, numeric in utils.state_codes:
+            if numeric == state_numeric and alpha != "":
+                return alpha
+        raise Exception('Could not find a state with the numeric code ' + state_numeric)
@@ -0,0 +1,118 @@
+import os
+import threading
+
+import lehd
+import numpy as np
+import pandas as pd
+
+
+class xwalk:
+
+    """
+    Memory-mapped store of the block to geography mappings of the LODES geography crosswalk, used to aggregate
+    data to geographies whose GEOIDs are not prefixes of block GEOIDs, such as places and ZIP code tabulation areas.
+
+    The store is built once per state from the crosswalk (e.g. ri_xwalk.csv.gz), and saved as a sorted int64 array
+    of block codes, with one int64 array of geography codes per level aligned to it, using -1 for blocks outside any
+    geography of that level. These are memory-mapped when used, so that mapping blocks to a geography is a
+    searchsorted over the block codes.
+
+    directory : folder the mapping arrays are written to
+
+    levels : for each geography type, its crosswalk column, the number of digits in its GEOID, and the number of
+    trailing digits that are all 9s for blocks outside any geography of that type (e.g. "4499999" for places)
+    """
+
+    directory = os.environ.get("LEHD_XWALK_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lehd", "xwalk"))
+
+    levels = {
+        "P": ["stplc", 7, 5],
+        "CS": ["ctycsub", 10, 5],
+        "CBSA": ["cbsa", 5, 5],
+        "ZCTA": ["zcta", 5, 5]
+    }
+
+    _arrays = {}
+    _lock = threading.Lock()
+
+
+    def build(state, df = None):
+
+        """
+        builds the mapping arrays of every level for a state alpha code, e.g. "RI", and returns their folder
+
+        df : the crosswalk of the state from lehd.blocks.read_xwalk. Default is None, reading it, and then also building
+        the block coordinate arrays of the state if they are missing
+        """
+
+        if df is None:
+            df = lehd.blocks.read_xwalk(state)
+            if not os.path.exists(os.path.join(lehd.blocks.directory, state.lower(), "codes.npy")):
+                lehd.blocks.build(state, df)
+
+        arrays = [("codes", df["tabblk2010"].to_numpy())]
+        for gtype, (column, length, missing) in xwalk.levels.items():
+            if column not in df.columns:
+                continue
+            values = pd.to_numeric(df[column], errors = "coerce").fillna(-1).astype(np.int64).to_numpy()
+            arrays.append((gtype, np.where(values % 10 ** missing == 10 ** missing - 1, -1, values)))
+
+        return lehd.blocks._save_arrays(os.path.join(xwalk.directory, state.lower()), arrays)
+
+
+    def arrays(state, gtype):
+
+        """
+        returns the memory-mapped (codes, values) arrays of a state alpha code and a geography type, building them first if needed
+        """
+
+        with xwalk._lock:
+
+            if (state, gtype) not in xwalk._arrays:
+
+                folder = os.path.join(xwalk.directory, state.lower())
+                if not os.path.exists(os.path.join(folder, "codes.npy")) or not os.path.exists(os.path.join(folder, gtype + ".npy")):
+                    xwalk.build(state)
+                if not os.path.exists(os.path.join(folder, gtype + ".npy")):
+                    raise Exception('The geography crosswalk of ' + state + ' has no "' + xwalk.levels[gtype][0] + '" column for the geography type "' + gtype + '"')
+
+                xwalk._arrays[(state, gtype)] = tuple(np.load(os.path.join(folder, name + ".npy"), mmap_mode = "r") for name in ["codes", gtype])
+
+            return xwalk._arrays[(state, gtype)]
+
+
+    def map(block_codes, gtype):
+
+        """
+        returns an array of the integer geography codes of a geography type (e.g. "P") for an array of integer block codes,
+        with -1 for blocks that are outside any geography of that type, or not found
+        """
+
+        if gtype not in xwalk.levels:
+            raise Exception('Please make sure the crosswalk geography type is one of ' + str(list(xwalk.levels.keys())))
+
+        codes = np.asarray(block_codes, dtype = np.int64)
+        values = np.full(len(codes), -1, dtype = np.int64)
+
+        states = codes // 10 ** 13
+        for state_numeric in np.unique(states):
+
+            xwalk_codes, xwalk_values = xwalk.arrays(lehd.utils.state_alpha(state_numeric), gtype)
+
+            rows = np.flatnonzero(states == state_numeric)
+            i = np.minimum(np.searchsorted(xwalk_codes, codes[rows]), len(xwalk_codes) - 1)
+            found = xwalk_codes[i] == codes[rows]
+
+            values[rows[found]] = xwalk_values[i[found]]
+
+        return values
+
+
+    def clear():
+
+        """
+        closes all memory-mapped mapping arrays, e.g. before rebuilding them
+        """
+
+        with xwalk._lock:
+            xwalk._arrays.clear()
@@ -18,9 +18,20 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     install_requires=[
-        'pandas>=1.0',
-        'urllib3>1.25'
-    ]
+        'numpy>=1.17',
+        'pandas>=1.2'
+    ],
+    extras_require={
+        'arrow': ['pyarrow>=7'],
+        'sparse': ['scipy>=1.4'],
+        'aio': ['aiohttp>=3.7'],
+        'geo': ['geopandas>=0.12', 'shapely>=2', 'pyproj', 'pyarrow>=7']
+    },
+    entry_points={
+        'console_scripts': [
+            'lehd=lehd.cli:main'
+        ]
+    }
 )
@@ -0,0 +1,82 @@
+"""
+tests of lehd.aio, downloading into lehd.cache from a local HTTP server alongside the blocking downloader
+"""
+
+import os
+import gzip
+import random
+import asyncio
+import threading
+import functools
+import http.server
+
+import pytest
+
+import lehd
+
+
+class CountingHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        return super().do_GET()
+
+
+@pytest.fixture
+def url(tmp_path, monkeypatch):
+
+    body = gzip.compress(random.Random(0).randbytes(2000000))
+    os.makedirs(tmp_path / "www" / "ri" / "wac")
+    with open(tmp_path / "www" / "ri" / "wac" / "ri_wac_S000_JT00_2016.csv.gz", "wb") as f:
+        f.write(body)
+
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(CountingHandler, directory = str(tmp_path / "www")))
+    httpd.daemon_threads = True
+    httpd.requests = []
+    threading.Thread(target = httpd.serve_forever, args = (0.05,), daemon = True).start()
+
+    for name, value in {"directory": str(tmp_path / "downloads"), "enabled": True, "offline": False, "validate": False, "retries": 0}.items():
+        monkeypatch.setattr(lehd.cache, name, value)
+
+    yield "http://127.0.0.1:" + str(httpd.server_address[1]) + "/ri/wac/ri_wac_S000_JT00_2016.csv.gz", body, httpd.requests
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize("use_aiohttp", [True, False])
+def test_fetch_alongside_cache_fetch(url, use_aiohttp, monkeypatch):
+
+    if use_aiohttp:
+        pytest.importorskip("aiohttp")
+    monkeypatch.setattr(lehd.aio, "use_aiohttp", use_aiohttp)
+    url, body, requests = url
+
+    async def main():
+        # a blocking fetch in another thread and two asyncio fetches of the same file share one download
+        thread = threading.Thread(target = lehd.cache.fetch, args = (url,))
+        thread.start()
+        paths = await asyncio.gather(lehd.aio.fetch(url), lehd.aio.fetch(url))
+        thread.join()
+        await lehd.aio.close()
+        return paths
+
+    paths = asyncio.run(main())
+
+    assert paths[0] == paths[1] == lehd.cache.path(url)
+    with open(paths[0], "rb") as f:
+        assert f.read() == body
+    assert len(requests) == 1
+    assert not [name for name in os.listdir(os.path.dirname(paths[0])) if name.endswith(".part")]
+
+
+def test_invalid_inputs_raise_before_downloading():
+
+    with pytest.raises(Exception, match = "Please input a list of locations"):
+        asyncio.run(lehd.aio.wac(None))
+    with pytest.raises(Exception, match = "Please input a list of origins"):
+        asyncio.run(lehd.aio.od(2016, "C"))
+    with pytest.raises(Exception, match = "@geography"):
+        asyncio.run(lehd.aio.rac(["44"], 2016, "XX"))
@@ -0,0 +1,296 @@
+"""
+tests of the download cache against a local HTTP server that stands in for the Census servers, and can be made to
+drop connections, corrupt files, or answer Range requests wrongly
+"""
+
+import os
+import gzip
+import random
+import threading
+import http.server
+
+import pytest
+
+import lehd
+
+
+path = "ri/wac/ri_wac_S000_JT00_2016.csv.gz"
+
+
+class FaultyHandler(http.server.BaseHTTPRequestHandler):
+
+    """
+    serves one gzip file, with ETag revalidation and If-Range resumes, applying the next fault of the server (if any)
+    to each request: "drop" sends half of the body and closes the connection, "corrupt" sends a body of the right
+    length that is not a valid gzip stream, "416" refuses the requested range, "500" fails, and "wrong_range"
+    answers a Range request with the file from its start
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+
+        state = self.server.state
+        state["requests"].append(dict(self.headers))
+        fault = state["faults"].pop(0) if state["faults"] else None
+        body, etag = state["body"], state["etag"]
+
+        if self.path.lstrip("/") != path:
+            return self._send(404, {}, b"")
+        if fault == "416":
+            return self._send(416, {"Content-Range": "bytes */" + str(len(body))}, b"")
+        if fault == "500":
+            return self._send(500, {}, b"")
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, {"ETag": etag}, b"")
+
+        # a Range request is only answered with a part of the file if it is still the same file
+        start = 0
+        if self.headers.get("Range") is not None and self.headers.get("If-Range") == etag:
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+        if fault == "wrong_range":
+            start = 0
+        if fault == "corrupt":
+            body = body[:10] + bytes(len(body) - 10)
+
+        headers = {"ETag": etag}
+        if start > 0 or fault == "wrong_range":
+            headers["Content-Range"] = "bytes " + str(start) + "-" + str(len(body) - 1) + "/" + str(len(body))
+        self._send(206 if "Content-Range" in headers else 200, headers, body[start:], drop = fault == "drop")
+
+
+    def _send(self, status, headers, body, drop = False):
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2] if drop else body)
+        if drop:
+            self.close_connection = True
+
+
+@pytest.fixture
+def server():
+
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FaultyHandler)
+    httpd.daemon_threads = True
+    httpd.state = {"body": gzip.compress(random.Random(0).randbytes(200000)), "etag": '"v1"', "faults": [], "requests": []}
+    threading.Thread(target = httpd.serve_forever, args = (0.05,), daemon = True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+
+    settings = {"directory": str(tmp_path / "downloads"), "enabled": True, "offline": False, "validate": True,
+        "verify": True, "retries": 3, "backoff": 0.0, "max_backoff": 0.0, "timeout": 10}
+    for name, value in settings.items():
+        monkeypatch.setattr(lehd.cache, name, value)
+    yield lehd.cache
+
+    # the connections kept open to the server are closed along with it
+    for connection in getattr(lehd.cache._local, "connections", {}).values():
+        connection.close()
+
+
+def url(server):
+
+    return "http://127.0.0.1:" + str(server.server_address[1]) + "/" + path
+
+
+def read(file_path):
+
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def test_download(server, cache):
+
+    file_path = cache.fetch(url(server))
+
+    assert read(file_path) == server.state["body"]
+    meta = cache._read_meta(file_path)
+    assert meta["url"] == url(server)
+    assert meta["size"] == len(server.state["body"])
+    assert meta["etag"] == '"v1"'
+    assert not os.path.exists(file_path + ".part")
+
+
+def test_dropped_connection_resumes(server, cache):
+
+    server.state["faults"] = ["drop"]
+    file_path = cache.fetch(url(server))
+
+    assert read(file_path) == server.state["body"]
+    first, second = server.state["requests"]
+    assert "Range" not in first
+    assert second["Range"] == "bytes=" + str(len(server.state["body"]) // 2) + "-"
+    assert second["If-Range"] == '"v1"'
+
+
+def test_partial_download_is_kept_for_the_next_fetch(server, cache):
+
+    cache.retries = 0
+    server.state["faults"] = ["drop"]
+    with pytest.raises(Exception, match = "Failed to download"):
+        cache.fetch(url(server))
+
+    file_path = cache.path(url(server))
+    assert os.path.getsize(file_path + ".part") == len(server.state["body"]) // 2
+    assert cache.cached_size(url(server)) is None
+
+    cache.fetch(url(server))
+    assert read(file_path) == server.state["body"]
+    assert server.state["requests"][-1]["Range"] == "bytes=" + str(len(server.state["body"]) // 2) + "-"
+    assert not os.path.exists(file_path + ".part")
+
+
+def test_changed_file_is_not_resumed(server, cache):
+
+    cache.retries = 0
+    server.state["faults"] = ["drop"]
+    with pytest.raises(Exception):
+        cache.fetch(url(server))
+
+    # If-Range no longer matches, so the server sends the whole new file
+    server.state["body"] = gzip.compress(random.Random(1).randbytes(150000))
+    server.state["etag"] = '"v2"'
+    file_path = cache.fetch(url(server))
+
+    assert read(file_path) == server.state["body"]
+    assert server.state["requests"][-1]["If-Range"] == '"v1"'
+    assert cache._read_meta(file_path)["etag"] == '"v2"'
+
+
+def test_revalidation(server, cache):
+
+    file_path = cache.fetch(url(server))
+    meta = cache._read_meta(file_path)
+
+    assert cache.fetch(url(server)) == file_path
+    assert server.state["requests"][-1]["If-None-Match"] == '"v1"'
+    assert read(file_path) == server.state["body"]
+    assert cache._read_meta(file_path)["last_access"] >= meta["last_access"]
+
+    # a changed file is downloaded again
+    server.state["body"] = gzip.compress(random.Random(1).randbytes(150000))
+    server.state["etag"] = '"v2"'
+    cache.fetch(url(server))
+    assert read(file_path) == server.state["body"]
+    assert cache._read_meta(file_path)["etag"] == '"v2"'
+
+
+def test_cached_file_is_not_revalidated(server, cache):
+
+    cache.fetch(url(server))
+    cache.validate = False
+    cache.fetch(url(server))
+    cache.validate, cache.offline = True, True
+    cache.fetch(url(server))
+
+    assert len(server.state["requests"]) == 1
+
+
+def test_offline_missing_file(server, cache):
+
+    cache.offline = True
+    with pytest.raises(Exception, match = "not in the cache"):
+        cache.fetch(url(server))
+    assert len(server.state["requests"]) == 0
+
+
+def test_corrupt_gzip_is_downloaded_again(server, cache):
+
+    server.state["faults"] = ["corrupt"]
+    file_path = cache.fetch(url(server))
+
+    assert read(file_path) == server.state["body"]
+    assert "Range" not in server.state["requests"][-1]
+
+
+def test_corrupt_gzip_is_not_cached(server, cache):
+
+    cache.retries = 0
+    server.state["faults"] = ["corrupt"]
+    with pytest.raises(Exception, match = "not a valid gzip file"):
+        cache.fetch(url(server))
+
+    file_path = cache.path(url(server))
+    assert cache.cached_size(url(server)) is None
+    assert not os.path.exists(file_path)
+    assert not os.path.exists(file_path + ".part")
+
+
+def test_unsatisfiable_range_restarts(server, cache):
+
+    server.state["faults"] = ["drop", "416"]
+    file_path = cache.fetch(url(server))
+
+    assert read(file_path) == server.state["body"]
+    statuses = [("Range" in request) for request in server.state["requests"]]
+    assert statuses == [False, True, False]
+
+
+def test_wrong_range_restarts(server, cache):
+
+    server.state["faults"] = ["drop", "wrong_range"]
+    file_path = cache.fetch(url(server))
+
+    assert read(file_path) == server.state["body"]
+    statuses = [("Range" in request) for request in server.state["requests"]]
+    assert statuses == [False, True, False]
+
+
+def test_missing_file(server, cache):
+
+    with pytest.raises(Exception, match = "HTTP Error 404"):
+        cache.fetch(url(server).replace("2016", "2015"))
+
+
+def test_clear_and_size_only_touch_cached_files(server, cache):
+
+    file_path = cache.fetch(url(server))
+    other = os.path.join(cache.directory, "notes", "keep.txt")
+    os.makedirs(os.path.dirname(other))
+    with open(other, "w") as f:
+        f.write("not a download")
+
+    assert cache.size() == len(server.state["body"])
+
+    cache.clear()
+    assert not os.path.exists(file_path)
+    assert not os.path.exists(file_path + ".json")
+    assert os.path.exists(other)
+    assert cache.size() == 0
+
+
+def test_cached_file_is_used_when_the_server_is_down(server, cache):
+
+    file_path = cache.fetch(url(server))
+    server.shutdown()
+    server.server_close()
+    for connection in getattr(cache._local, "connections", {}).values():
+        connection.close()
+
+    # revalidation makes a single attempt, rather than going through the retries
+    cache.backoff = 10.0
+    assert cache.fetch(url(server)) == file_path
+    assert read(file_path) == server.state["body"]
+
+
+def test_cached_file_is_used_when_the_server_fails(server, cache):
+
+    file_path = cache.fetch(url(server))
+    server.state["faults"] = ["500"]
+
+    assert cache.fetch(url(server)) == file_path
+    assert read(file_path) == server.state["body"]
+    assert len(server.state["requests"]) == 2
@@ -0,0 +1,448 @@
+"""
+tests of dl_lodes against synthetic LODES files served from the local machine (see benchmarks/synthetic.py), checking
+its output for each file type, geography level, parse engine, and chunk size against a plain pandas reading of the
+same files, which filters and aggregates the GEOID strings in the way the first versions of lehd did
+"""
+
+import os
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lehd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import server
+import synthetic
+
+
+# a small version of the "ri" scale of the benchmarks
+synthetic.scales["test"] = {"state": "RI", "fips": "44", "neighbour": "25", "counties": 5, "blocks": 4000, "od_rows": 40000}
+
+lengths = {"S": 2, "C": 5, "CT": 11, "BG": 12, "B": 15}
+
+runs = [("pandas", None), ("pandas", 997), ("pyarrow", None), ("pyarrow", 997)]
+
+
+@pytest.fixture(scope = "module")
+def lodes(tmp_path_factory):
+
+    directory = str(tmp_path_factory.mktemp("lodes"))
+    synthetic.generate(directory, "test", years = [2015, 2016])
+    httpd, base_url = server.serve(directory)
+
+    settings = [(lehd.dl_lodes, "url_base"), (lehd.centroids, "url_base"), (lehd.cache, "directory"), (lehd.xwalk, "directory"), (lehd.blocks, "directory"), (lehd.store, "directory")]
+    saved = [(target, name, getattr(target, name)) for target, name in settings]
+    server.point(base_url)
+    lehd.cache.directory = os.path.join(directory, "downloads")
+    lehd.xwalk.directory = os.path.join(directory, "xwalk")
+    lehd.blocks.directory = os.path.join(directory, "blocks")
+    lehd.store.directory = os.path.join(directory, "parquet")
+    lehd.xwalk._arrays.clear()
+    lehd.blocks._arrays.clear()
+
+    yield os.path.join(directory, "lodes", "ri")
+
+    for target, name, value in saved:
+        setattr(target, name, value)
+    lehd.xwalk._arrays.clear()
+    lehd.blocks._arrays.clear()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(scope = "module")
+def places(lodes):
+
+    # the place of each block, from the crosswalks of both states, without the blocks outside any place
+    df = pd.concat([pd.read_csv(os.path.join(lodes, "..", st, st + "_xwalk.csv.gz"), dtype = str) for st in ["ri", "ma"]])
+    df = df[~df["stplc"].str.endswith("99999")]
+    return df.set_index("tabblk2010")["stplc"]
+
+
+@pytest.fixture(scope = "module")
+def sample(lodes):
+
+    # nested and mixed level locations from the blocks of the files: a county, a tract inside it, a block group
+    # and a block from other counties, and a place
+    blocks = np.sort(pd.read_csv(os.path.join(lodes, "wac", "ri_wac_S000_JT00_2016.csv.gz"), dtype = {"w_geocode": str})["w_geocode"].unique())
+    county = blocks[0][:5]
+    tract = blocks[0][:11]
+    other = [b for b in blocks if b[:5] != county]
+    return [county, tract, other[0][:12], other[-1], "4420000"]
+
+
+@pytest.fixture(scope = "module")
+def files(lodes):
+
+    # the rows of each file type, read once for all tests
+    files = {}
+    for kind, names in [("wac", ["ri_wac_S000_JT00_2016"]), ("rac", ["ri_rac_S000_JT00_2016"]), ("od", ["ri_od_aux_JT00_2016", "ri_od_main_JT00_2016"])]:
+        df = pd.concat([pd.read_csv(os.path.join(lodes, kind, name + ".csv.gz"), dtype = {"w_geocode": str, "h_geocode": str}) for name in names])
+        for column in ["w_geocode", "h_geocode"]:
+            if column in df.columns:
+                df[column] = df[column].str.zfill(15)
+        files[kind] = df
+    return files
+
+
+def geoids(blocks, gtype, places):
+
+    if gtype == "P":
+        return blocks.map(places)
+    return blocks.str[:lengths[gtype]]
+
+
+def located(blocks, locations, places):
+
+    mask = np.zeros(len(blocks), dtype = bool)
+    for location in locations:
+        if len(location) == 7:
+            mask |= (blocks.map(places) == location).to_numpy()
+        else:
+            mask |= blocks.str.startswith(location).to_numpy()
+    return mask
+
+
+def reference(df, sides, geography, places):
+
+    values = [c for c in df.columns if c not in ["w_geocode", "h_geocode", "createdate"]]
+    keys = [side + "_geoid_" + geography for side in sides]
+    for side, key in zip(sides, keys):
+        df[key] = geoids(df[side + "_geocode"], geography, places)
+    if geography != "B":
+        # the firm characteristics of WAC files are not summed
+        values = [value for value in values if value not in lehd.dl_lodes.firm_values]
+        df = df.dropna(subset = keys).groupby(keys)[values].sum().reset_index()
+    return canonical(df, keys, values)
+
+
+def stored(monkeypatch, enabled):
+
+    # reads the files through the columnar store, which is built on the first read of each file
+    if enabled:
+        pytest.importorskip("pyarrow")
+    monkeypatch.setattr(lehd.store, "enabled", enabled)
+
+
+def canonical(df, keys, values):
+
+    df = df[keys + values].astype(dict([(key, str) for key in keys] + [(value, np.int64) for value in values]))
+    return df.sort_values(keys).reset_index(drop = True)
+
+
+@pytest.mark.parametrize("store", [False, True])
+@pytest.mark.parametrize("engine, chunksize", runs)
+@pytest.mark.parametrize("geography", ["B", "BG", "CT", "C", "S", "P"])
+@pytest.mark.parametrize("kind", ["wac", "rac"])
+def test_wac_and_rac(files, places, sample, kind, geography, engine, chunksize, store, monkeypatch):
+
+    if engine == "pyarrow":
+        pytest.importorskip("pyarrow")
+    stored(monkeypatch, store)
+
+    side = "w" if kind == "wac" else "h"
+    df = files[kind]
+    expected = reference(df[located(df[side + "_geocode"], sample, places)], [side], geography, places)
+
+    out = getattr(lehd.dl_lodes, kind)(sample, 2016, geography, chunksize = chunksize, engine = engine)
+
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(canonical(out, list(expected.columns[:1]), list(expected.columns[1:])), expected)
+
+
+@pytest.mark.parametrize("store", [False, True])
+@pytest.mark.parametrize("engine, chunksize", runs)
+@pytest.mark.parametrize("geography", ["B", "BG", "CT", "C", "S", "P"])
+@pytest.mark.parametrize("query", [
+    {"origins": "sample"},
+    {"destinations": "sample"},
+    {"origins": "sample", "destinations": ["44"], "constrained": "yes"},
+    {"origins": "sample", "destinations": ["44"], "constrained": "no"}
+])
+def test_od(files, places, sample, query, geography, engine, chunksize, store, monkeypatch):
+
+    if engine == "pyarrow":
+        pytest.importorskip("pyarrow")
+    stored(monkeypatch, store)
+
+    query = dict((name, sample if value == "sample" else value) for name, value in query.items())
+    df = files["od"]
+    origin = located(df["h_geocode"], query["origins"], places) if "origins" in query else None
+    destination = located(df["w_geocode"], query["destinations"], places) if "destinations" in query else None
+    if origin is None:
+        mask = destination
+    elif destination is None:
+        mask = origin
+    else:
+        mask = origin & destination if query["constrained"] == "yes" else origin | destination
+    expected = reference(df[mask], ["h", "w"], geography, places)
+
+    out = lehd.dl_lodes.od(2016, geography, chunksize = chunksize, engine = engine, **query)
+
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(canonical(out, list(expected.columns[:2]), list(expected.columns[2:])), expected)
+
+
+@pytest.mark.parametrize("origin_states, destination_states, constrained, parts", [
+    (["RI"], [], "no", ["main"]),
+    (["MA"], [], "no", ["aux"]),
+    (["MA", "RI"], [], "no", ["aux", "main"]),
+    ([], ["RI"], "no", ["aux", "main"]),
+    ([], ["MA"], "no", []),
+    (["RI"], ["RI"], "yes", ["main"]),
+    (["RI"], ["RI"], "no", ["aux", "main"]),
+    (["MA"], ["RI"], "yes", ["aux"]),
+    (["MA"], ["RI"], "no", ["aux", "main"]),
+    (["RI"], ["MA"], "yes", []),
+    (["RI"], ["MA"], "no", ["main"]),
+    (["MA"], ["MA"], "yes", []),
+    (["MA"], ["MA"], "no", ["aux"]),
+    (["MA", "RI"], ["MA", "RI"], "yes", ["aux", "main"])
+])
+def test_od_parts(origin_states, destination_states, constrained, parts):
+
+    # the parts of Rhode Island's files that can hold flows between the origin and destination states
+    assert lehd.dl_lodes._od_parts("RI", origin_states, destination_states, constrained) == parts
+
+
+@pytest.mark.parametrize("kind", ["wac", "od"])
+def test_block_counts_are_int64(lodes, sample, kind):
+
+    # job counts are read as narrow unsigned integers, but returned as 64-bit integers, so differences can be negative
+    if kind == "wac":
+        out = lehd.dl_lodes.wac(sample, 2016, "B")
+    else:
+        out = lehd.dl_lodes.od(2016, "B", origins = sample)
+    values = [c for c in out.columns if "_geoid_" not in c]
+
+    assert (out[values].dtypes == np.int64).all()
+    assert (out["C000" if kind == "wac" else "S000"].diff().dropna() < 0).any()
+
+
+def test_crosswalk_stores_share_one_read(lodes, monkeypatch, tmp_path):
+
+    monkeypatch.setattr(lehd.xwalk, "directory", str(tmp_path / "xwalk"))
+    monkeypatch.setattr(lehd.blocks, "directory", str(tmp_path / "blocks"))
+    reads = []
+    read_xwalk = lehd.blocks.read_xwalk
+    monkeypatch.setattr(lehd.blocks, "read_xwalk", lambda state: reads.append(state) or read_xwalk(state))
+
+    # building the geography mappings also builds the block coordinates, from the same parsed crosswalk
+    lehd.xwalk.build("RI")
+    codes, lat, lon = [np.load(os.path.join(tmp_path, "blocks", "ri", name + ".npy")) for name in ["codes", "lat", "lon"]]
+    xwalk_codes, places = [np.load(os.path.join(tmp_path, "xwalk", "ri", name + ".npy")) for name in ["codes", "P"]]
+
+    df = pd.read_csv(os.path.join(lodes, "ri_xwalk.csv.gz"), dtype = {"tabblk2010": np.int64, "blklatdd": np.float32, "blklondd": np.float32, "stplc": str}).sort_values("tabblk2010")
+    assert reads == ["RI"]
+    assert (codes == df["tabblk2010"].to_numpy()).all() and (xwalk_codes == codes).all()
+    assert (lat == df["blklatdd"].to_numpy()).all() and (lon == df["blklondd"].to_numpy()).all()
+    assert (places == np.where(df["stplc"].str.endswith("99999"), -1, df["stplc"].astype(np.int64))).all()
+    assert not [name for folder in ["blocks", "xwalk"] for name in os.listdir(tmp_path / folder / "ri") if "tmp" in name]
+
+
+@pytest.mark.parametrize("kind", ["wac", "od"])
+def test_panel(sample, kind):
+
+    # a panel is the outputs of each year, concatenated with a year column
+    if kind == "wac":
+        out = lehd.dl_lodes.wac_panel(sample, [2015, 2016], "C")
+        years = [lehd.dl_lodes.wac(sample, year, "C") for year in [2015, 2016]]
+    else:
+        out = lehd.dl_lodes.od_panel([2015, 2016], "C", origins = sample)
+        years = [lehd.dl_lodes.od(year, "C", origins = sample) for year in [2015, 2016]]
+
+    labels = ["year", "seg", "type"] if kind == "wac" else ["year", "type"]
+    assert list(out.columns) == labels + list(years[0].columns)
+    assert list(out["year"].unique()) == [2015, 2016]
+    expected = pd.concat([df.assign(**dict(zip(labels, [year, "S000", "JT00"] if kind == "wac" else [year, "JT00"])))[labels + list(df.columns)] for year, df in zip([2015, 2016], years)], ignore_index = True)
+    pd.testing.assert_frame_equal(out, expected)
+
+
+def test_sparse_matrix(files, places, sample):
+
+    pytest.importorskip("scipy")
+
+    df = files["od"]
+    expected = reference(df[located(df["h_geocode"], sample, places)], ["h", "w"], "CT", places)
+
+    m = lehd.dl_lodes.od(2016, "CT", origins = sample, output = "sparse")
+
+    pd.testing.assert_frame_equal(canonical(m.to_frame(), list(expected.columns[:2]), list(expected.columns[2:])), expected)
+    rows = expected.groupby("h_geoid_CT")["S000"].sum()
+    columns = expected.groupby("w_geoid_CT")["S000"].sum()
+    assert (m.row_totals().reindex(rows.index) == rows).all() and m.row_totals().sum() == rows.sum()
+    assert (m.column_totals().reindex(columns.index) == columns).all() and m.column_totals().sum() == columns.sum()
+    assert (m.net_flows() == m.column_totals() - m.row_totals()).all() and m.net_flows().sum() == 0
+
+
+def test_sparse_matrix_from_codes():
+
+    pytest.importorskip("scipy")
+
+    # duplicate origin-destination pairs are summed, over the zones of both sides
+    m = lehd.od_matrix.from_codes(np.array([44001, 44003, 44001]), np.array([44003, 44003, 44003]), {"S000": [1, 2, 4]}, "C")
+
+    assert list(m.geoids) == ["44001", "44003"]
+    assert m["S000"].toarray().tolist() == [[0, 5], [0, 2]]
+    assert list(m.intrazonal()) == [0, 2]
+    assert list(m.net_flows()) == [-5, 5]
+
+
+def test_sparse_matrix_balance(sample):
+
+    pytest.importorskip("scipy")
+
+    m = lehd.dl_lodes.od(2016, "C", origins = sample, output = "sparse")
+
+    # targets with the same total as each other, but a different distribution than the flows
+    rows = m.row_totals().to_numpy() * np.linspace(0.5, 1.5, len(m.geoids))
+    columns = m.column_totals().to_numpy() * rows.sum() / m.column_totals().sum()
+    balanced = m.balance(rows, columns, tolerance = 1e-9, iterations = 1000)
+
+    np.testing.assert_allclose(np.asarray(balanced.sum(axis = 1)).ravel(), rows, rtol = 1e-6)
+    np.testing.assert_allclose(np.asarray(balanced.sum(axis = 0)).ravel(), columns, rtol = 1e-6)
+    assert balanced.nnz <= m["S000"].nnz
+
+
+@pytest.mark.parametrize("geography", ["C", "CT", "P"])
+def test_od_national(lodes, geography):
+
+    # the national aggregation of a state's files holds the flows to every workplace in the state
+    out = lehd.dl_lodes.od_national(2016, geography, states = ["RI"], processes = 2, chunksize = 997)
+    expected = lehd.dl_lodes.od(2016, geography, destinations = ["44"])
+
+    keys = ["h_geoid_" + geography, "w_geoid_" + geography]
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(canonical(out, keys, lehd.dl_lodes.od_values), canonical(expected, keys, lehd.dl_lodes.od_values))
+
+
+@pytest.mark.parametrize("geography", ["BG", "CT", "C", "S"])
+@pytest.mark.parametrize("kind", ["wac", "od"])
+def test_cube(files, places, sample, kind, geography, monkeypatch, tmp_path):
+
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(lehd.cube, "enabled", True)
+    monkeypatch.setattr(lehd.cube, "directory", str(tmp_path))
+    monkeypatch.setattr(lehd.cube, "chunksize", 997)
+
+    # locations at the level of the output geography or coarser, a county and a tract inside it for tracts and block groups
+    locations = {"BG": sample[:2], "CT": sample[:2], "C": sample[:1], "S": ["44"]}[geography]
+    side = "w" if kind == "wac" else "h"
+    df = files[kind]
+    expected = reference(df[located(df[side + "_geocode"], locations, places)], [side] if kind == "wac" else ["h", "w"], geography, places)
+
+    if kind == "wac":
+        out = lehd.dl_lodes.wac(locations, 2016, geography)
+        names = ["ri_wac_S000_JT00_2016"]
+    else:
+        out = lehd.dl_lodes.od(2016, geography, origins = locations)
+        names = ["ri_od_main_JT00_2016"]
+
+    assert lehd.cube.usable(locations, geography)
+    assert all(os.path.exists(lehd.cube.path(name, level)) for name in names for level in lehd.cube.levels)
+    keys = [c for c in expected.columns if "_geoid_" in c]
+    pd.testing.assert_frame_equal(canonical(out, keys, [c for c in expected.columns if c not in keys]), expected)
+
+
+def test_cube_rollups(lodes, monkeypatch, tmp_path):
+
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(lehd.cube, "directory", str(tmp_path))
+
+    # each level of the cube is the sum of the level below it
+    name = "ri_od_main_JT00_2016.csv.gz"
+    lehd.cube.build(name, lehd.dl_lodes.url_base + "ri/od/" + name, lehd.dl_lodes.schema["od"])
+    previous = None
+    for level in lehd.cube.levels:
+        df = pd.read_parquet(lehd.cube.path(name, level))
+        assert df["S000"].sum() == pd.read_csv(os.path.join(lodes, "od", name))["S000"].sum()
+        if previous is not None:
+            scale = 10 ** (lehd.utils.geoid_lengths[previous[0]] - lehd.utils.geoid_lengths[level])
+            rolled = previous[1].groupby([previous[1]["h_code"] // scale, previous[1]["w_code"] // scale])[lehd.dl_lodes.od_values].sum()
+            assert (rolled.to_numpy() == df.set_index(["h_code", "w_code"]).sort_index()[lehd.dl_lodes.od_values].to_numpy()).all()
+        previous = (level, df)
+    assert not [f for f in os.listdir(os.path.dirname(lehd.cube.path(name, "BG"))) if f.endswith(".tmp")]
+
+
+def test_query_plan(lodes, sample):
+
+    # flows from Rhode Island homes are all in the main file, and only the selected columns are read
+    q = lehd.query().od(2016).origins(["44"]).by("C").select(["S000", "SA01"])
+    plan = q.plan(sizes = False)
+
+    assert list(plan["file"]) == ["ri_od_main_JT00_2016.csv.gz"]
+    assert plan.attrs["columns"] == ["w_geocode", "h_geocode", "S000", "SA01"]
+    assert "files: 1" in q.explain(sizes = False)
+
+    out = q.collect()
+    expected = lehd.dl_lodes.od(2016, "C", origins = ["44"], columns = ["S000", "SA01"])
+    pd.testing.assert_frame_equal(out, expected)
+    assert list(q.plan(sizes = False)["source"]) == ["cache"]
+
+
+def test_query_panel_plan(lodes, sample):
+
+    # each year of a panel is a file, and a query for a tract is only planned in the file of its state
+    q = lehd.query().wac(year = [2015, 2016]).locations([sample[1]])
+    plan = q.plan()
+
+    assert list(plan["file"]) == ["ri_wac_S000_JT00_2015.csv.gz", "ri_wac_S000_JT00_2016.csv.gz"]
+    assert plan["bytes"].notna().all()
+    assert plan.attrs["columns"] is None
+    assert list(q.collect()["year"].unique()) == [2015, 2016]
+
+
+@pytest.mark.parametrize("geography", ["B", "C", "P"])
+@pytest.mark.parametrize("kind", ["wac", "od"])
+def test_arrow_output(sample, kind, geography):
+
+    pa = pytest.importorskip("pyarrow")
+
+    if kind == "wac":
+        table = lehd.dl_lodes.wac(sample, 2016, geography, output = "arrow")
+        expected = lehd.dl_lodes.wac(sample, 2016, geography)
+    else:
+        table = lehd.dl_lodes.od(2016, geography, origins = sample, output = "arrow")
+        expected = lehd.dl_lodes.od(2016, geography, origins = sample)
+
+    # the GEOID columns are dictionary encoded, and the metrics of the call are in the schema metadata
+    keys = [c for c in expected.columns if "_geoid_" in c]
+    assert all(pa.types.is_dictionary(table.schema.field(key).type) for key in keys)
+    assert json.loads(table.schema.metadata[b"lehd.metrics"])["stages"]["finalize"]["rows_out"] == table.num_rows
+    assert all(table.schema.field(c).type == pa.int64() for c in expected.columns if c not in keys)
+
+    values = [c for c in expected.columns if c not in keys]
+    pd.testing.assert_frame_equal(canonical(table.to_pandas(), keys, values), canonical(expected, keys, values))
+
+
+def test_peak_memory_of_a_call(sample):
+
+    if lehd.metrics.current_memory() is None:
+        pytest.skip("the current memory of the process is only measured on Linux")
+
+    # a large array raises the high-water mark of the process before the call, and is freed
+    data = np.ones(400 * 1024 * 1024 // 8)
+    del data
+
+    metrics = lehd.dl_lodes.wac(sample, 2016, "C").attrs["metrics"]
+
+    assert metrics["process_peak_memory"] >= 400 * 1024 * 1024
+    assert 0 < metrics["peak_memory"] < metrics["process_peak_memory"]
+
+
+@pytest.mark.parametrize("module, call, extra", [
+    ("scipy.sparse", lambda: lehd.od_matrix.from_codes(np.array([44001]), np.array([44003]), {"S000": [1]}, "C"), "sparse"),
+    ("geopandas", lambda: lehd.to_geo.wac(pd.DataFrame({"w_geoid_C": ["44001"], "C000": [1]})), "geo"),
+    ("pyarrow", lambda: lehd.dl_lodes._pyarrow(), "arrow")
+])
+def test_missing_optional_dependencies(module, call, extra, monkeypatch):
+
+    # a module set to None in sys.modules fails to import, as if it was not installed
+    monkeypatch.setitem(sys.modules, module, None)
+    with pytest.raises(Exception, match = r"pip install lehd\[" + extra + r"\]"):
+        call()
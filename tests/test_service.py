@@ -0,0 +1,149 @@
+"""
+tests of the query service, with the dl_lodes functions it calls replaced by stand-ins, so that the status codes,
+result cache, and coalescing of identical queries can be checked without any files
+"""
+
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lehd
+
+
+@pytest.fixture
+def calls(monkeypatch):
+
+    # the locations of each call to dl_lodes.wac, which is replaced by a stand-in that fails for one county
+    calls = []
+
+    def wac(locations, year = 2016, geography = "B", seg = "S000", type = "JT00", columns = None, engine = "pandas"):
+        calls.append(locations)
+        if locations == ["44001"]:
+            raise Exception("Failed to download ri_wac_S000_JT00_2016.csv.gz : connection refused")
+        return pd.DataFrame({"w_geoid_C": locations, "C000": np.arange(len(locations), dtype = np.int64)})
+
+    monkeypatch.setattr(lehd.dl_lodes, "wac", wac)
+    return calls
+
+
+@pytest.fixture
+def service(calls):
+
+    lehd.service.clear()
+    yield lehd.service
+    lehd.service.clear()
+
+
+@pytest.fixture
+def url(service):
+
+    httpd = service.server("127.0.0.1", 0)
+    threading.Thread(target = httpd.serve_forever, args = (0.05,), daemon = True).start()
+    yield "http://127.0.0.1:" + str(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def get(url):
+
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+@pytest.mark.parametrize("query", [
+    "/wac?locations=44&year=abc",
+    "/wac?locations=44&year=1990",
+    "/wac?locations=44&geography=XX",
+    "/wac?locations=44&seg=SX01",
+    "/wac?locations=44&type=JT09",
+    "/wac?locations=44&columns=C000,S000",
+    "/wac?locations=4x4",
+    "/wac?year=2016",
+    "/wac?locations=44&foo=1",
+    "/wac?locations=44&format=xml",
+    "/od?origins=44&constrained=maybe",
+    "/od?geography=C"
+])
+def test_invalid_queries(service, calls, url, query):
+
+    status, body = get(url + query)
+
+    assert status == 400
+    assert json.loads(body)["error"]
+    assert calls == []
+
+
+def test_failed_queries(service, url):
+
+    status, body = get(url + "/wac?locations=44001&geography=C")
+
+    assert status == 500
+    assert "connection refused" in json.loads(body)["error"]
+    assert service.metrics()["endpoints"]["wac"]["errors"] == 1
+
+
+def test_equivalent_queries_share_a_result(service, calls):
+
+    df, first = service.query("wac", {"locations": ["44007,44003"], "geography": ["c"]})
+    same, second = service.query("wac", {"geography": ["C"], "year": ["2016"], "locations": ["44003", "44007,44003"]})
+
+    assert (first, second) == ("miss", "hit")
+    assert same is df
+    assert calls == [["44003", "44007"]]
+
+
+def test_results_are_evicted_at_max_bytes(service, monkeypatch):
+
+    df, cache = service.query("wac", {"locations": ["44001000100"]})
+    size = int(df.memory_usage(index = True, deep = True).sum())
+    monkeypatch.setattr(service, "max_bytes", 2 * size)
+    service.clear()
+
+    # each result has the same size, so only the two most recently used fit
+    for location in ["44001000100", "44001000101", "44001000100", "44001000102"]:
+        service.query("wac", {"locations": [location]})
+
+    assert service.metrics()["cache"]["entries"] == 2
+    assert service.metrics()["cache"]["bytes"] <= service.max_bytes
+    assert service.query("wac", {"locations": ["44001000100"]})[1] == "hit"
+    assert service.query("wac", {"locations": ["44001000101"]})[1] == "miss"
+
+
+def test_identical_queries_are_coalesced(service, calls, monkeypatch):
+
+    started, release = threading.Event(), threading.Event()
+    wac = lehd.dl_lodes.wac
+
+    def slow_wac(*args, **kwargs):
+        started.set()
+        release.wait(10)
+        return wac(*args, **kwargs)
+
+    monkeypatch.setattr(lehd.dl_lodes, "wac", slow_wac)
+
+    results = {}
+    first = threading.Thread(target = lambda: results.setdefault("first", service.query("wac", {"locations": ["44"]})))
+    first.start()
+    started.wait(10)
+    second = threading.Thread(target = lambda: results.setdefault("second", service.query("wac", {"locations": ["44"]})))
+    second.start()
+
+    # the second query waits for the first, rather than computing the result again
+    time.sleep(0.2)
+    release.set()
+    first.join(10)
+    second.join(10)
+
+    assert results["first"][1] == "miss"
+    assert results["second"][1] == "coalesced"
+    assert results["second"][0] is results["first"][0]
+    assert len(calls) == 1
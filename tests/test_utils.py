@@ -0,0 +1,148 @@
+"""
+tests of the block code helpers of lehd.utils, checked against the string prefix matching and pandas groupby they
+replace. Places and county subdivisions, which are located through the geography crosswalk, are tested with dl_lodes
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lehd
+
+
+def prefix_mask(codes, geoids):
+
+    # the block codes whose 15 digit GEOID starts with any of the GEOIDs
+    blocks = pd.Series(codes).astype(str).str.zfill(15)
+    mask = np.zeros(len(codes), dtype = bool)
+    for geoid in geoids:
+        mask |= blocks.str.startswith(geoid).to_numpy()
+    return mask
+
+
+def random_codes(n, seed = 0):
+
+    # block codes in Rhode Island (44) and Massachusetts (25), spread over a few counties and tracts
+    rng = np.random.default_rng(seed)
+    state = rng.choice([25, 44], n)
+    county = rng.choice([1, 3, 5], n)
+    tract = rng.choice([100, 101, 201, 30100], n)
+    return state * 10 ** 13 + county * 10 ** 10 + tract * 10 ** 4 + rng.integers(1000, 5000, n)
+
+
+def test_ranges_of_a_county_inside_a_state():
+
+    starts, ends = lehd.utils.geoid_ranges(["44003", "44", "44007"])
+
+    assert list(starts) == [44 * 10 ** 13]
+    assert list(ends) == [45 * 10 ** 13]
+
+
+def test_ranges_of_nested_mixed_levels():
+
+    # a block group inside a tract, a block inside a county, and a separate block
+    geoids = ["440030201001", "44003020100", "440050301001005", "44005", "250010001001000"]
+    starts, ends = lehd.utils.geoid_ranges(geoids)
+
+    assert list(starts) == [250010001001000, 440030201000000, 440050000000000]
+    assert list(ends) == [250010001001001, 440030201010000, 440060000000000]
+
+
+def test_ranges_that_touch_are_merged():
+
+    starts, ends = lehd.utils.geoid_ranges(["44001000101", "44001000100"])
+
+    assert list(starts) == [440010001000000]
+    assert list(ends) == [440010001020000]
+
+
+def test_ranges_of_invalid_geoids():
+
+    with pytest.raises(Exception):
+        lehd.utils.geoid_ranges(["44", "4400"])
+
+
+def test_in_ranges_bounds():
+
+    starts, ends = lehd.utils.geoid_ranges(["44003", "440050301001"])
+    codes = np.array([440029999999999, 440030000000000, 440039999999999, 440040000000000, 440050301000999, 440050301001000, 440050301001999, 440050301002000])
+
+    assert list(lehd.utils.in_ranges(codes, starts, ends)) == [False, True, True, False, False, True, True, False]
+
+
+@pytest.mark.parametrize("geoids", [
+    ["44"],
+    ["44", "44003"],
+    ["44003", "44003030100", "440030301001"],
+    ["44001000100", "440010001001", "440050301001005", "25"],
+    ["250010001001000", "440030201001", "44005030100", "25003"]
+])
+def test_locator_matches_prefixes(geoids):
+
+    codes = random_codes(5000)
+    codes = np.concatenate([codes, lehd.utils.geoid_ranges(geoids)[0]])
+    mask, (starts, ends) = lehd.utils.locator(geoids)
+
+    expected = prefix_mask(codes, geoids)
+    assert (mask(codes) == expected).all()
+    assert (lehd.utils.in_ranges(codes, starts, ends) == expected).all()
+
+
+def test_sum_by_one_key():
+
+    codes = random_codes(2000)
+    df = pd.DataFrame({"S000": np.arange(2000, dtype = np.uint16), "SA01": np.ones(2000, dtype = np.uint16)})
+    keys = [codes // 10 ** 10]
+
+    out = lehd.utils.sum_by(keys, df, ["S000", "SA01"])
+    expected = df.groupby(keys[0])[["S000", "SA01"]].sum()
+
+    assert (out.sort_index().to_numpy() == expected.to_numpy()).all()
+    assert list(out.sort_index().index) == list(expected.index)
+    assert (out.dtypes == np.int64).all()
+
+
+def test_sum_by_two_keys():
+
+    h = random_codes(3000, 1) // 10 ** 4
+    w = random_codes(3000, 2) // 10 ** 10
+    df = pd.DataFrame({"S000": np.arange(3000) % 7})
+
+    out = lehd.utils.sum_by([h, w], df, ["S000"]).sort_index()
+    expected = df.groupby([h, w])[["S000"]].sum()
+
+    assert list(out.index) == list(expected.index)
+    assert list(out["S000"]) == list(expected["S000"])
+
+
+def test_sum_by_skips_negative_keys():
+
+    h = np.array([1, 2, -1, 2, 3, 1])
+    w = np.array([5, 5, 5, -1, 6, 5])
+    df = pd.DataFrame({"S000": [1, 2, 4, 8, 16, 32]})
+
+    out = lehd.utils.sum_by([h, w], df, ["S000"]).sort_index()
+
+    assert list(out.index) == [(1, 5), (2, 5), (3, 6)]
+    assert list(out["S000"]) == [33, 2, 16]
+
+
+@pytest.mark.parametrize("keys", [[np.array([-1, -2])], [np.array([-1, 2]), np.array([3, -4])]])
+def test_sum_by_without_valid_keys(keys):
+
+    df = pd.DataFrame({"S000": [1, 2], "SA01": [3, 4]})
+    out = lehd.utils.sum_by(keys, df, ["S000", "SA01"])
+
+    assert len(out) == 0
+    assert list(out.columns) == ["S000", "SA01"]
+    assert (out.dtypes == np.int64).all()
+    assert out.index.nlevels == len(keys)
+
+
+def test_sum_by_empty_dataframe():
+
+    df = pd.DataFrame({"S000": np.array([], dtype = np.uint16)})
+    out = lehd.utils.sum_by([np.array([], dtype = np.int64)] * 2, df, ["S000"])
+
+    assert len(out) == 0
+    assert out.index.nlevels == 2